@@ -1,23 +1,42 @@
+import json
 import logging
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import List
+from typing import Any, AsyncIterator, Dict, Iterator, List, Literal, Optional
 
-import pandas as pd
+import numpy as np
 from fastapi import FastAPI
-from pydantic import BaseModel
-from starlette.responses import JSONResponse, RedirectResponse
+from pydantic import BaseModel, Field
+from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 
 # Your existing modules
 from recommender.core import (
-    PreProcessor,
-    recommend_ub
+    ModelArrays,
+    MovieCatalog,
+    PrecomputedRecommendations,
+    recommend_ib,
+    recommend_mf,
+    recommend_precomputed,
+    recommend_ub_arrays,
+    recommend_ub_batch
 )
 from recommender.file_operations import (
     DataHandler,
-    pickle_object,
-    unpickle_object
+    ModelStore,
+    load_model,
+    load_model_metadata,
+    load_movie_catalog,
+    load_precomputed_recommendations
 )
-from recommender.utils import setup_logging
+from recommender.utils import LRUCache, metrics, setup_logging, timer
 
 # Setup logging
 logging_path: Path = Path("loggers")
@@ -26,42 +45,189 @@ setup_logging(logger_root_dir=logging_path, log_level="DEBUG")
 logger = logging.getLogger(__name__)
 logger.info("FastAPI App starting...")
 
+# Stage and request timings, exposed at /metrics. Disabling them removes the overhead of the instrumentation
+metrics.enabled = os.environ.get("RECSYS_METRICS", "1").lower() not in ("0", "false", "no")
+
+
+# Startup and shutdown of the server. The functions and state it uses are defined below
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """
+    Starts loading the model in the background once the server is up, see `load_initial_model`, and stops
+    following the serving pointer and the rebuilds when the server shuts down.
+    """
+    threading.Thread(target=load_initial_model, name="model-loader", daemon=True).start()
+    yield
+    stop_polling.set()
+    rebuild_executor.shutdown(wait=False, cancel_futures=True)
+
+
 # FastAPI application instance
 app = FastAPI(
     title="User-based Recommender API",
     description="This is a simple API that generates a list of recommended movies for a user.",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url=None
+    redoc_url=None,
+    lifespan=lifespan
 )
 
 # --- Global variables
 data_handler = DataHandler(input_folder=Path("./data") / 'ml-latest-small')
-movies_df: pd.DataFrame = data_handler.movies_df
-
-try:
-    user_ratings = unpickle_object(Path("./data/models/user_ratings.pkl"))
-    neighbors_u = unpickle_object(Path("./data/models/user_neighbors.pkl"))
-    logger.info("Pre-calculated ratings and neighbors loaded.")
 
-except FileNotFoundError:
-    logger.warning("Pre-calculated ratings and neighbors not found. Generating...")
+precomputed_path: Path = Path(os.environ.get("RECSYS_PRECOMPUTED", "./data/models/recommendations.parquet"))
+
+# Models are reused when built from the same data and options, and only calculated on a miss
+model_store = ModelStore(max_models=int(os.environ.get("RECSYS_MAX_MODELS", 5)))
+# Similar movies stored per movie and dimension of the embeddings, to serve the item-based and matrix
+# factorization modes. Disabled if 0
+preprocessor_options: Dict[str, Any] = dict(item_neighbors=int(os.environ.get("RECSYS_ITEM_NEIGHBORS", 0)),
+                                            factors=int(os.environ.get("RECSYS_FACTORS", 0)))
+
+# Recommendations calculated once the model is loaded, before reporting ready: a JSON file with a list of requests
+# like the ones of /api/v1/recommendations/, or else the default request of `RECSYS_WARMUP_USERS` users spread over
+# the model. The arrays of the model are also read once, unless `RECSYS_WARMUP_PAGE_IN=0`
+warmup_queries_path: Optional[str] = os.environ.get("RECSYS_WARMUP_QUERIES")
+warmup_users: int = int(os.environ.get("RECSYS_WARMUP_USERS", 20))
+warmup_page_in: bool = os.environ.get("RECSYS_WARMUP_PAGE_IN", "1").lower() not in ("0", "false", "no")
+
+# Pointer of the store to the model served by all the workers of these options. A worker installing a new model moves
+# it, and every worker polls it every `RECSYS_MODEL_POLL_INTERVAL` seconds to serve the same model. Disabled if 0
+serving_pointer: str = f"serving-{preprocessor_options['item_neighbors']}-{preprocessor_options['factors']}"
+model_poll_interval: float = float(os.environ.get("RECSYS_MODEL_POLL_INTERVAL", 2))
+
+
+def load_matching_precomputed(model_id: Optional[str]) -> Optional[PrecomputedRecommendations]:
+    """Loads the precomputed recommendations, if they were calculated with the model of `model_id`."""
+    if model_id is None or not precomputed_path.is_file():
+        return None
+    precomputed = load_precomputed_recommendations(precomputed_path)
+    if precomputed.model_id != model_id:
+        logger.warning(f"The precomputed recommendations of `{precomputed_path}` belong to another model. "
+                       f"Ignoring them.")
+        return None
+    return precomputed
+
+
+@dataclass(frozen=True)
+class ServingModel:
+    """The model served by the API. It is replaced as a whole, so a request never mixes two models."""
+    model: ModelArrays
+    movie_catalog: MovieCatalog
+    version: int
+    model_path: Optional[Path] = None
+    model_id: Optional[str] = None
+    precomputed: Optional[PrecomputedRecommendations] = None
+
+
+# The model is loaded in the background once the server is up, see `load_initial_model`
+serving: Optional[ServingModel] = None
+serving_lock = threading.Lock()
+# Held while the model of the serving pointer is loaded, so that it is loaded once, and set to stop polling it
+sync_lock = threading.Lock()
+stop_polling = threading.Event()
+
+
+class ModelNotReadyError(RuntimeError):
+    """Raised when a request needs the model before it is loaded."""
+
+
+@dataclass
+class Readiness:
+    """The loading of the initial model and its warm-up, reported by /ready."""
+    status: str = "LOADING"  # LOADING, WARMING_UP, READY or FAILURE
+    started_at: float = field(default_factory=time.time)
+    ready_at: Optional[float] = None
+    warmup_queries: int = 0
+    message: Optional[str] = None
+
+
+readiness = Readiness()
+
+# Cache of the recommendations, keyed by (user_id, neighbors_num, recommendations_num, mode, model version)
+recommendation_cache = LRUCache(max_size=int(os.environ.get("RECSYS_CACHE_SIZE", 10000)),
+                                ttl=float(os.environ.get("RECSYS_CACHE_TTL", 600)))
+
+
+def install_model(new_model: ModelArrays,
+                  new_movie_catalog: MovieCatalog,
+                  new_model_path: Optional[Path] = None,
+                  model_id: Optional[str] = None) -> None:
+    """
+    Serves a new model with a single reference swap and drops the recommendations of the previous one. `model_id`
+    must be the one loaded together with the model, see `load_model`.
+    """
+    global serving
+    precomputed = load_matching_precomputed(model_id)
+    with serving_lock:
+        version = 1 if serving is None else serving.version + 1
+        serving = ServingModel(model=new_model, movie_catalog=new_movie_catalog, version=version,
+                               model_path=new_model_path, model_id=model_id, precomputed=precomputed)
+        recommendation_cache.clear()
+    logger.info(f"Serving model version {serving.version}.")
+
+
+def sync_serving_model() -> bool:
+    """
+    Serves the model of the serving pointer, if it is not the served one, e.g. after another worker rebuilt the
+    model. A model rebuilt in the same folder, e.g. with `--force-calculate`, is recognized by its `model_id`.
+
+    Returns:
+        bool: Whether a new model was installed.
+    """
+    with sync_lock:
+        model_path = model_store.current(serving_pointer)
+        if model_path is None:
+            return False
+        current = serving
+        if current is not None and current.model_path == model_path and \
+                current.model_id == load_model_metadata(model_path).get("model_id"):
+            return False
+        logger.info(f"Loading the model {model_path.name} of the serving pointer...")
+        model, metadata = load_model(model_path)
+        install_model(model, load_movie_catalog(model_path), model_path, metadata.get("model_id"))
+        return True
+
+
+def poll_serving_pointer() -> None:
+    """Polls the serving pointer until the server stops, so that this worker serves the same model as the others."""
+    while not stop_polling.wait(model_poll_interval):
+        try:
+            sync_serving_model()
+        except Exception as e:
+            logger.exception(f"Error loading the model of the serving pointer: {str(e)}")
+
+
+@dataclass
+class RebuildJob:
+    """A model rebuild running in the background."""
+    job_id: str
+    data_path: str
+    status: str = "PENDING"  # PENDING, RUNNING, SUCCESS or FAILURE
+    submitted_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    model_version: Optional[int] = None
+    message: Optional[str] = None
 
-    # Preprocess ratings and calculate user neighbors
-    preprocessor = PreProcessor()
-    user_ratings, neighbors_u = preprocessor.preprocess(data_handler.ratings_df)
 
-    # Pickle the objects for future use
-    logger.warning("Saving pre-calculated ratings and neighbors under: `./data/models`")
-    pickle_object(user_ratings, Path("./data/models/user_ratings.pkl"))
-    pickle_object(neighbors_u, Path("./data/models/user_neighbors.pkl"))
+# Rebuilds run one at a time in a separate process, so they never block the event loop or compete with serving
+rebuild_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+rebuild_jobs: Dict[str, RebuildJob] = {}
+rebuild_futures: Dict[str, Future] = {}
 
 
 # Input validation classis
 class RecommendationRequest(BaseModel):
-    neighbors_num: int = 10
-    recommendations_num: int = 5
+    neighbors_num: int = Field(10, ge=0)
+    recommendations_num: int = Field(5, ge=0)
     user_id: int = 100
+    mode: Literal["user", "item", "mf"] = "user"
+
+
+class BatchRecommendationRequest(BaseModel):
+    neighbors_num: int = Field(10, ge=0)
+    recommendations_num: int = Field(5, ge=0)
+    user_ids: List[int]
 
 
 class Movie(BaseModel):
@@ -75,66 +241,198 @@ class DataPathRequest(BaseModel):
     data_path: str
 
 
-# Health check endpoint
+# Health check endpoint: the process is up, whether the model is loaded or not
 @app.get("/health")
 async def health() -> JSONResponse:
     logger.info("Health check request received.")
     return JSONResponse({"status": "UP"})
 
 
+# Readiness endpoint: the model is loaded and warmed up, so requests can be routed to this server
+@app.get("/ready")
+async def ready() -> JSONResponse:
+    current = serving
+    body = {**asdict(readiness), "model_version": None if current is None else current.version}
+    return JSONResponse(body, status_code=200 if readiness.status == "READY" else 503)
+
+
+# Recommendation cache statistics
+@app.get("/api/v1/cache/stats")
+async def cache_stats() -> JSONResponse:
+    current = serving
+    return JSONResponse({"model_version": None if current is None else current.version,
+                         **recommendation_cache.stats()})
+
+
+# Metrics in the Prometheus text format
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint() -> PlainTextResponse:
+    current = serving
+    metrics.set_gauge("ready", readiness.status == "READY", "Whether the model is loaded and warmed up.")
+    if current is None:
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+    model_gauges = {
+        "model_version": (current.version, "Version of the served model."),
+        "model_users": (len(current.model.user_ids), "Number of users with ratings in the served model."),
+        "model_users_with_neighbors": (int(np.count_nonzero(np.diff(current.model.neighbors_indptr))),
+                                       "Number of users with neighbors in the served model."),
+        "model_ratings": (int(current.model.ratings_indptr[-1]), "Number of ratings in the served model."),
+        "model_neighbors": (int(current.model.neighbors_indptr[-1]), "Number of neighbors in the served model."),
+        "model_bytes": (sum(getattr(current.model, name).nbytes for name in ModelArrays.array_names()),
+                        "Size of the arrays of the served model."),
+    }
+    cache = recommendation_cache.stats()
+    model_gauges.update({
+        "cache_entries": (cache["size"], "Number of cached recommendations."),
+        "cache_hits": (cache["hits"], "Number of recommendations served from the cache."),
+        "cache_misses": (cache["misses"], "Number of recommendations missing from the cache."),
+    })
+    for name, (value, help_text) in model_gauges.items():
+        metrics.set_gauge(name, value, help_text)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 # redirect to docs
 @app.get("/", include_in_schema=False)
 async def docs_redirect():
     return RedirectResponse(url="/docs")
 
 
-# Function to calculate user ratings and neighbors
-def calculate_neighbors(data_path: str):
-    global user_ratings, neighbors_u, movies_df
-    logger.info(f"Calculating user ratings and neighbors from data at {data_path}...")
+# Function to calculate user ratings and neighbors in the background
+def start_rebuild(data_path: str) -> RebuildJob:
+    input_folder = Path("./data") / data_path
+    DataHandler(input_folder=input_folder)  # fail fast if the files are missing
+
+    job = RebuildJob(job_id=uuid.uuid4().hex, data_path=data_path)
+    rebuild_jobs[job.job_id] = job
+    logger.info(f"Calculating user ratings and neighbors from data at {data_path} in job {job.job_id}...")
 
-    data_handler = DataHandler(input_folder=Path("./data") / data_path)
+    future = rebuild_executor.submit(model_store.get_or_build, input_folder, **preprocessor_options)
+    rebuild_futures[job.job_id] = future
+    future.add_done_callback(lambda done: finish_rebuild(job, done))
+    return job
 
-    # Preprocess ratings and calculate user neighbors
-    preprocessor = PreProcessor()
-    user_ratings, neighbors_u = preprocessor.preprocess(data_handler.ratings_df)
 
-    logger.info(f"Calculated user ratings and neighbors for {len(neighbors_u)} users.")
+def finish_rebuild(job: RebuildJob, future: Future) -> None:
+    """Installs the model built by a job. Runs in a background thread once the build process is done."""
+    try:
+        new_model_path = future.result()
+        logger.info(f"Calculated user ratings and neighbors under: `{new_model_path}`")
 
-    # Update default data path
-    movies_df = data_handler.movies_df
+        # Serve the new model and movies, in every worker: the others load it when they see the moved pointer
+        model_store.set_current(serving_pointer, new_model_path)
+        sync_serving_model()
+
+        job.status, job.model_version = "SUCCESS", serving.version
+        job.message = "User ratings and neighbors have been calculated and stored."
+    except Exception as e:
+        logger.error(f"Error calculating neighbors: {str(e)}")
+        job.status, job.message = "FAILURE", f"Error calculating neighbors: {str(e)}"
+    job.finished_at = time.time()
 
 
 # Helper function to generate recommendations
-def generate_recommendations(neighbors_num: int, recommendations_num: int, user_id: int) -> List[Movie]:
-    global movies_df
-    if user_ratings is None or neighbors_u is None or movies_df is None:
-        raise ValueError("User ratings and neighbors must be calculated first.")
-
-    logger.info(f"Generating recommendations for user {user_id}...")
-
-    # Generate recommendations using the user-based collaborative filtering function
-    recommended_movies = recommend_ub(
-        user=user_id,
-        movies_df=movies_df,
-        neighbors_u=neighbors_u,
-        user_ratings=user_ratings,
+def generate_recommendations(neighbors_num: int, recommendations_num: int, user_id: int,
+                             mode: str = "user") -> List[Movie]:
+    current = serving  # the same model for the whole request
+    if current is None:
+        raise ModelNotReadyError("The model is still loading, see /ready.")
+
+    # the item-based and factorization modes need the similar movies or the embeddings of the served model
+    if mode == "item" and not current.model.has_item_neighbors:
+        raise ValueError("The item mode is not supported: the server was started without RECSYS_ITEM_NEIGHBORS.")
+    if mode == "mf" and not current.model.has_factors:
+        raise ValueError("The mf mode is not supported: the server was started without RECSYS_FACTORS.")
+
+    cache_key = (user_id, neighbors_num, recommendations_num, mode, current.version)
+    cached_movies = recommendation_cache.get(cache_key)
+    if cached_movies is not None:
+        logger.info(f"Serving cached recommendations for user {user_id}.")
+        return cached_movies
+
+    # Look up the recommendations precomputed with the same model and number of neighbors
+    recommended_movies = None
+    if mode == "user" and current.precomputed is not None and current.precomputed.neighbor_num == neighbors_num:
+        recommended_movies = recommend_precomputed(
+            user=user_id,
+            movies_df=current.movie_catalog,
+            table=current.precomputed,
+            rec_num=recommendations_num
+        )
+
+    if recommended_movies is None and mode == "mf":
+        logger.info(f"Generating matrix factorization recommendations for user {user_id}...")
+
+        # Generate recommendations from the predicted ratings of the embeddings
+        recommended_movies = recommend_mf(
+            user=user_id,
+            movies_df=current.movie_catalog,
+            model=current.model,
+            neighbor_num=neighbors_num,
+            rec_num=recommendations_num
+        )
+
+    if recommended_movies is None and mode == "item":
+        logger.info(f"Generating item-based recommendations for user {user_id}...")
+
+        # Generate recommendations from the movies similar to the ones rated by the user
+        recommended_movies = recommend_ib(
+            user=user_id,
+            movies_df=current.movie_catalog,
+            model=current.model,
+            neighbor_num=neighbors_num,
+            rec_num=recommendations_num
+        )
+
+    if recommended_movies is None:
+        logger.info(f"Generating recommendations for user {user_id}...")
+
+        # Generate recommendations using the user-based collaborative filtering function
+        recommended_movies = recommend_ub_arrays(
+            user=user_id,
+            movies_df=current.movie_catalog,
+            model=current.model,
+            neighbor_num=neighbors_num,
+            rec_num=recommendations_num
+        )
+
+    # Return the list of movie titles as Movie models
+    movies = [Movie(**movie) for movie in recommended_movies]
+    recommendation_cache.put(cache_key, movies)
+    return movies
+
+
+# Helper function to generate the recommendations of many users
+def generate_batch_recommendations(neighbors_num: int, recommendations_num: int, user_ids: List[int]) -> Iterator[str]:
+    current = serving  # the same model for the whole request
+    if current is None:
+        raise ModelNotReadyError("The model is still loading, see /ready.")
+
+    logger.info(f"Generating recommendations for {len(user_ids)} users...")
+
+    # Score the users in batches and emit one JSON line per user as soon as its batch is done
+    recommendations = recommend_ub_batch(
+        users=user_ids,
+        movies_df=current.movie_catalog,
+        model=current.model,
         neighbor_num=neighbors_num,
         rec_num=recommendations_num
     )
-
-    # Return the list of movie titles as Movie models
-    return [Movie(**movie) for movie in recommended_movies]
+    return (json.dumps({"user_id": user_id, "recommendations": recommended_movies}) + "\n"
+            for user_id, recommended_movies in recommendations)
 
 
-# FastAPI route for calculating neighbors (user ratings & neighbors_u)
+# FastAPI route for calculating neighbors (user ratings & neighbors_u) in the background
 @app.put("/api/v1/update_neighbors/")
 async def update_neighbors_endpoint(request: DataPathRequest):
     try:
-        calculate_neighbors(data_path=request.data_path)
+        job = start_rebuild(data_path=request.data_path)
         return JSONResponse(
-            {"status": "SUCCESS",
-             "message": "User ratings and neighbors have been calculated and stored."}
+            {"status": "ACCEPTED",
+             "job_id": job.job_id,
+             "message": "User ratings and neighbors are being calculated. "
+                        f"Check the progress at /api/v1/update_neighbors/{job.job_id}"},
+            status_code=202
         )
 
     except Exception as e:
@@ -146,36 +444,178 @@ async def update_neighbors_endpoint(request: DataPathRequest):
         )
 
 
+# FastAPI route for the status of a neighbors calculation
+@app.get("/api/v1/update_neighbors/{job_id}")
+async def update_neighbors_status_endpoint(job_id: str):
+    job = rebuild_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(
+            {"status": "FAILURE",
+             "message": f"Unknown job: {job_id}"},
+            status_code=404
+        )
+    if job.status == "PENDING" and rebuild_futures[job_id].running():
+        job.status = "RUNNING"
+    return JSONResponse(asdict(job))
+
+
 # FastAPI route for generating recommendations
 @app.post("/api/v1/recommendations/", response_model=List[Movie])
 async def generate_recommendations_endpoint(request: RecommendationRequest):
+    metrics.increment("requests_total", help_text="Number of requests.", endpoint="recommendations")
     try:
         # Generate recommendations using stored user ratings and neighbors_u
-        recommended_movies = generate_recommendations(
+        with timer("request"):
+            recommended_movies = generate_recommendations(
+                neighbors_num=request.neighbors_num,
+                recommendations_num=request.recommendations_num,
+                user_id=request.user_id,
+                mode=request.mode
+            )
+
+        return recommended_movies
+
+    except ModelNotReadyError as e:
+        logger.warning(str(e))
+        metrics.increment("errors_total", help_text="Number of failed requests.", endpoint="recommendations")
+        return JSONResponse(
+            {"status": "FAILURE",
+             "message": str(e)},
+            status_code=503
+        )
+    except ValueError as e:
+        logger.exception(f"Error: {str(e)}")
+        metrics.increment("errors_total", help_text="Number of failed requests.", endpoint="recommendations")
+        return JSONResponse(
+            {"status": "FAILURE",
+             "message": f"An error occurred while generating recommendations: {str(e)}"},
+            status_code=400
+        )
+    except Exception as e:
+
+        logger.exception(f"Error generating recommendations: {str(e)}")
+        metrics.increment("errors_total", help_text="Number of failed requests.", endpoint="recommendations")
+        return JSONResponse(
+            {"status": "FAILURE",
+             "message": f"An error occurred while generating recommendations: {str(e)}"},
+            status_code=500
+        )
+
+
+# FastAPI route for generating the recommendations of many users, streamed as newline-delimited JSON
+@app.post("/api/v1/recommendations/batch")
+async def generate_batch_recommendations_endpoint(request: BatchRecommendationRequest):
+    metrics.increment("requests_total", help_text="Number of requests.", endpoint="recommendations_batch")
+    try:
+        recommended_movies = generate_batch_recommendations(
             neighbors_num=request.neighbors_num,
             recommendations_num=request.recommendations_num,
-            user_id=request.user_id
+            user_ids=request.user_ids
         )
+        return StreamingResponse(recommended_movies, media_type="application/x-ndjson")
 
-        return recommended_movies
-
+    except ModelNotReadyError as e:
+        logger.warning(str(e))
+        metrics.increment("errors_total", help_text="Number of failed requests.", endpoint="recommendations_batch")
+        return JSONResponse(
+            {"status": "FAILURE",
+             "message": str(e)},
+            status_code=503
+        )
     except ValueError as e:
         logger.exception(f"Error: {str(e)}")
+        metrics.increment("errors_total", help_text="Number of failed requests.", endpoint="recommendations_batch")
         return JSONResponse(
             {"status": "FAILURE",
-             "message": {f"An error occurred while generating recommendations: {str(e)}"}},
+             "message": f"An error occurred while generating recommendations: {str(e)}"},
             status_code=400
         )
     except Exception as e:
 
         logger.exception(f"Error generating recommendations: {str(e)}")
+        metrics.increment("errors_total", help_text="Number of failed requests.", endpoint="recommendations_batch")
         return JSONResponse(
             {"status": "FAILURE",
-             "message": {f"An error occurred while generating recommendations: {str(e)}"}},
+             "message": f"An error occurred while generating recommendations: {str(e)}"},
             status_code=500
         )
 
 
+def warmup_requests(model: ModelArrays) -> List[RecommendationRequest]:
+    """Returns the recommendation requests of the warm-up, from `RECSYS_WARMUP_QUERIES` or spread over the users."""
+    if warmup_queries_path is not None:
+        with open(warmup_queries_path) as f:
+            return [RecommendationRequest(**query) for query in json.load(f)]
+    num_users = min(warmup_users, len(model.user_ids))
+    users = model.user_ids[np.linspace(0, len(model.user_ids) - 1, num=num_users).astype(np.int64)]
+    return [RecommendationRequest(user_id=user) for user in users.tolist()]
+
+
+def page_in(current: ServingModel) -> int:
+    """Reads one byte per page of the memory-mapped arrays of the model and the catalog, and returns their size."""
+    arrays = [getattr(current.model, name) for name in ModelArrays.array_names()]
+    arrays += [current.movie_catalog.movie_ids, current.movie_catalog.titles, current.movie_catalog.genres,
+               current.movie_catalog.rows]
+    size = 0
+    for array in arrays:
+        if isinstance(array, np.memmap) and array.nbytes:
+            array.reshape(-1).view(np.uint8)[::mmap.PAGESIZE].sum()  # faults in every page
+            size += array.nbytes
+    return size
+
+
+def warm_up(current: ServingModel) -> None:
+    """Pages in the model and runs the warm-up requests, which fills the recommendation cache."""
+    readiness.status = "WARMING_UP"
+    with timer("warmup"):
+        if warmup_page_in:
+            logger.info(f"Paged in {page_in(current)} bytes of the model.")
+        for request in warmup_requests(current.model):
+            try:
+                generate_recommendations(neighbors_num=request.neighbors_num,
+                                         recommendations_num=request.recommendations_num,
+                                         user_id=request.user_id,
+                                         mode=request.mode)
+            except ValueError as e:
+                logger.warning(f"Warm-up request {request} failed: {str(e)}")
+            readiness.warmup_queries += 1
+    logger.info(f"Warmed up the model with {readiness.warmup_queries} requests.")
+
+
+def load_initial_model() -> None:
+    """
+    Loads the model of the serving pointer in the background, so that the server is up at once. Without a pointer,
+    e.g. on the first start, it points to the model of the default dataset, which is built in the rebuild process if
+    missing. The server reports ready once the model is loaded and warmed up, and then follows the pointer.
+    """
+    try:
+        if model_store.current(serving_pointer) is None:
+            fingerprint = model_store.fingerprint(data_handler.input_folder, **preprocessor_options)
+            initial_path = model_store.lookup(fingerprint)
+            if initial_path is None:
+                logger.info("No stored model found. Building it in the background...")
+                initial_path = rebuild_executor.submit(model_store.get_or_build, data_handler.input_folder,
+                                                       **preprocessor_options).result()
+            with model_store.build_lock():
+                # another worker may have pointed it to its own model meanwhile
+                if model_store.current(serving_pointer) is None:
+                    model_store.set_current(serving_pointer, initial_path)
+
+        # The model and the movie catalog are memory-mapped read-only from the store, so all the workers serving
+        # the same model share a single copy of them in the page cache instead of holding their own
+        sync_serving_model()
+        logger.info("Pre-calculated ratings and neighbors loaded.")
+
+        warm_up(serving)
+        readiness.status, readiness.ready_at = "READY", time.time()
+        logger.info(f"Ready to serve after {readiness.ready_at - readiness.started_at:.1f}s.")
+        if model_poll_interval > 0:
+            poll_serving_pointer()
+    except Exception as e:
+        logger.exception(f"Error loading the model: {str(e)}")
+        readiness.status, readiness.message = "FAILURE", f"Error loading the model: {str(e)}"
+
+
 # Main entry point for running the FastAPI app (if needed for development)
 if __name__ == "__main__":
     import uvicorn
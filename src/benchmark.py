@@ -0,0 +1,222 @@
+"""
+Benchmarks of the preprocessing and serving of the recommender on synthetic MovieLens-shaped datasets.
+
+Times each stage, and measures its peak memory with `tracemalloc` in a second run, for every dataset size and
+neighbor engine, and writes the results to a JSON file. Given the results of a previous run as a baseline, it
+reports the stages that got slower and exits with an error, e.g. to catch regressions before deploying:
+
+    python src/benchmark.py --sizes 1e4 1e5 1e6 --output benchmarks.json
+    python src/benchmark.py --sizes 1e4 1e5 1e6 --output new.json --baseline benchmarks.json
+"""
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy
+
+from recommender.core import (
+    ModelArrays,
+    MovieCatalog,
+    PreProcessor,
+    recommend_mf,
+    recommend_ub,
+    recommend_ub_arrays,
+    recommend_ub_batch
+)
+from recommender.file_operations import load_model_arrays, save_model_arrays
+from recommender.utils import generate_ratings
+
+logger = logging.getLogger(__name__)
+
+
+def measure(func: Callable[[], Any], memory: bool = True) -> Tuple[Any, float, Optional[float]]:
+    """
+    Runs a function, timing it, and runs it again under `tracemalloc` for its peak memory, so that the tracing does
+    not slow down the timed run.
+
+    Returns:
+        Tuple[Any, float, Optional[float]]: The result of the function, its duration in seconds and its peak memory
+            in MiB, or `None` if the memory is not measured.
+    """
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    if not memory:
+        return result, seconds, None
+
+    del result
+    tracemalloc.start()
+    try:
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def benchmark_dataset(size: int, args: Namespace) -> List[Dict[str, Any]]:
+    """Runs all the stages on a synthetic dataset of about `size` ratings and returns their measurements."""
+    num_users = max(size // args.ratings_per_user, 10)
+    num_movies = max(int(num_users * args.movies_per_user), 1000)
+    ratings_df, movies_df = generate_ratings(num_users, num_movies, args.ratings_per_user, args.skew, args.seed)
+    dataset = {"size": size, "users": num_users, "movies": num_movies, "ratings": len(ratings_df),
+               "skew": args.skew}
+    logger.info(f"Benchmarking {dataset}")
+
+    results: List[Dict[str, Any]] = []
+
+    def record(stage: str, func: Callable[[], Any], engine: Optional[str] = None, calls: int = 1) -> Any:
+        result, seconds, peak_mb = measure(func, memory=not args.no_memory)
+        results.append({"size": size, "stage": stage, "engine": engine, "seconds": seconds,
+                        "ms_per_call": 1000 * seconds / calls, "peak_mb": peak_mb, "dataset": dataset})
+        logger.info(f"{stage:<22} {engine or '':<10} {seconds:10.4f}s"
+                    + ("" if peak_mb is None else f" {peak_mb:10.1f} MiB"))
+        return result
+
+    preprocessor = PreProcessor(min_rating_num=args.min_rating_num)
+    user_ratings = record("load_user_ratings", lambda: preprocessor._load_user_ratings(ratings_df))
+
+    neighbors_u = None
+    for engine in args.engines:
+        if engine == 'pairwise' and num_users > args.max_pairwise_users:
+            logger.info(f"Skipping the pairwise engine for {num_users} users")
+            continue
+        engine_preprocessor = PreProcessor(min_rating_num=args.min_rating_num, neighbor_engine=engine,
+                                           max_neighbors=args.max_neighbors, n_jobs=args.n_jobs)
+        neighbors = record("get_user_neighbors", lambda: engine_preprocessor.get_user_neighbors(user_ratings),
+                           engine=engine)
+        # recommend with exact neighbors, unless only the approximate ones are benchmarked
+        if neighbors_u is None or engine != 'minhash':
+            neighbors_u = neighbors
+    if neighbors_u is None:
+        return results
+
+    model = record("model_from_dicts", lambda: ModelArrays.from_dicts(user_ratings, neighbors_u))
+    if args.factors > 0:
+        factor_preprocessor = PreProcessor(min_rating_num=args.min_rating_num, factors=args.factors)
+        neighbor_model = model
+        model = record("add_factors", lambda: factor_preprocessor.add_factors(neighbor_model, ratings_df))
+    with tempfile.TemporaryDirectory() as folder:
+        record("save_model_arrays", lambda: save_model_arrays(model, Path(folder) / 'model'))
+        record("load_model_arrays", lambda: load_model_arrays(Path(folder) / 'model'))
+        record("load_model_in_memory", lambda: load_model_arrays(Path(folder) / 'model', mmap_mode=None))
+
+    catalog = MovieCatalog.from_frame(movies_df)
+    users = np.random.default_rng(args.seed).choice(model.user_ids, size=min(args.users, len(model.user_ids)),
+                                                   replace=False).tolist()
+    serving = dict(neighbor_num=args.neighbors_num, rec_num=args.recommendations_num)
+    record("recommend_ub", lambda: [recommend_ub(user, catalog, neighbors_u, user_ratings, **serving)
+                                    for user in users], calls=len(users))
+    record("recommend_ub_arrays", lambda: [recommend_ub_arrays(user, catalog, model, **serving)
+                                           for user in users], calls=len(users))
+    record("recommend_ub_batch", lambda: list(recommend_ub_batch(users, catalog, model, **serving)),
+           calls=len(users))
+    if model.has_factors:
+        record("recommend_mf", lambda: [recommend_mf(user, catalog, model, **serving) for user in users],
+               calls=len(users))
+    return results
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float,
+            min_seconds: float) -> List[Dict[str, Any]]:
+    """
+    Compares the durations of the stages with the ones of a baseline run.
+
+    Returns:
+        List[Dict[str, Any]]: The stages more than `tolerance` slower than in the baseline, ignoring the ones
+            shorter than `min_seconds` in both runs, since they are dominated by noise.
+    """
+    previous = {(r["size"], r["stage"], r["engine"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = previous.get((result["size"], result["stage"], result["engine"]))
+        if base is None or max(result["seconds"], base["seconds"]) < min_seconds:
+            continue
+        ratio = result["seconds"] / base["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append({**result, "baseline_seconds": base["seconds"], "ratio": ratio})
+    return regressions
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Benchmark the recommender on synthetic datasets.")
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1e4, 1e5],
+                        help='Approximate numbers of ratings of the datasets, e.g. 1e4 up to 1e7.')
+    parser.add_argument('--ratings-per-user', type=int, default=100, help='Mean number of ratings per user.')
+    parser.add_argument('--movies-per-user', type=float, default=0.4,
+                        help='Number of movies per user (at least 1000 movies).')
+    parser.add_argument('--skew', type=float, default=1.0, help='Exponent of the Zipf popularity of the movies.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic datasets.')
+    parser.add_argument('--engines', type=str, nargs='+', default=list(PreProcessor.neighbor_engines),
+                        choices=PreProcessor.neighbor_engines, help='Neighbor engines to benchmark.')
+    parser.add_argument('--max-pairwise-users', type=int, default=1000,
+                        help='Largest number of users benchmarked with the quadratic pairwise engine.')
+    parser.add_argument('--min-rating-num', type=int, default=5, help='Minimum number of ratings of a user.')
+    parser.add_argument('--max-neighbors', type=int, default=50, help='Maximum number of neighbors per user.')
+    parser.add_argument('--n-jobs', type=int, default=1, help='Number of processes of the sparse engine.')
+    parser.add_argument('--factors', type=int, default=32,
+                        help='Dimension of the embeddings of the matrix factorization. Skipped if 0.')
+    parser.add_argument('--users', type=int, default=200, help='Number of users to recommend movies to.')
+    parser.add_argument('--neighbors-num', type=int, default=10, help='Neighbors considered per recommendation.')
+    parser.add_argument('--recommendations-num', type=int, default=10, help='Recommendations per user.')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the peak memory measurements.')
+    parser.add_argument('--output', type=str, default='benchmarks.json', help='JSON file of the results.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON file of a previous run to compare the results with.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown over the baseline reported as a regression.')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='Stages shorter than this in both runs are not compared.')
+    return parser.parse_args()
+
+
+def main(args: Namespace) -> int:
+    """Runs the benchmarks, writes their results and returns the exit code: 1 if there are regressions."""
+    results: List[Dict[str, Any]] = []
+    for size in args.sizes:
+        results.extend(benchmark_dataset(int(size), args))
+
+    report = {"created_at": datetime.now(timezone.utc).isoformat(),
+              "environment": {"python": platform.python_version(),
+                              "platform": platform.platform(),
+                              "cpu_count": os.cpu_count(),
+                              "numpy": np.__version__,
+                              "pandas": pd.__version__,
+                              "scipy": scipy.__version__},
+              "arguments": vars(args),
+              "results": results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Benchmark results have been written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        for regression in regressions:
+            logger.error(f"Regression of {regression['stage']} {regression['engine'] or ''} at size "
+                         f"{regression['size']}: {regression['seconds']:.4f}s vs "
+                         f"{regression['baseline_seconds']:.4f}s ({regression['ratio']:.2f}x)")
+        if regressions:
+            return 1
+        logger.info(f"No regressions compared with {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    # the progress and results of the benchmark are reported at INFO, while the library only reports warnings so
+    # that its logs of every recommendation do not add to the measured timings
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+    sys.exit(main(parse_args()))
@@ -1,18 +1,33 @@
 """
 Main function of the module to run the pipeline needed for recommendations.
 """
+import json
 import logging
 from argparse import Namespace
+from itertools import chain
 from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
 
 from recommender.core import (
+    IncrementalNeighbors,
+    ModelArrays,
     PreProcessor,
-    recommend_ub
+    recommend_ib,
+    recommend_mf,
+    recommend_ub_arrays
 )
 from recommender.file_operations import (
     DataHandler,
-    unpickle_object,
-    pickle_object
+    ModelStore,
+    load_model_arrays,
+    load_model_metadata,
+    pickle_object,
+    precompute_recommendations,
+    save_model_arrays,
+    unpickle_object
 )
 from recommender.utils import (
     RecArgumentParser,
@@ -28,6 +43,81 @@ setup_logging(logger_root_dir=logging_path,
 logger = logging.getLogger(__name__)
 logger.info("Main App starting...")
 
+# columns of the ratings of a delta file, and their dtypes
+RATING_DTYPES: Dict[str, Any] = {'userId': np.int64, 'movieId': np.int64, 'rating': np.float32}
+RATING_COLUMNS: List[str] = list(RATING_DTYPES)
+
+
+def _applied_deltas(model_path: Path) -> Tuple[List[str], pd.DataFrame]:
+    """
+    Returns the content hashes and the ratings of the deltas applied, in order, to the model of a dataset to get the
+    given model. Both are empty for the model of the dataset itself.
+    """
+    try:
+        with open(model_path / "deltas.json") as f:
+            hashes = json.load(f)["deltas"]
+    except FileNotFoundError:
+        return [], pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in RATING_DTYPES.items()})
+    return hashes, pd.read_parquet(model_path / "ratings_deltas.parquet")
+
+
+def apply_ratings_delta(preprocessor: PreProcessor,
+                        data_handler: DataHandler,
+                        delta_path: Path,
+                        model_store: ModelStore,
+                        preprocessor_options: Dict[str, Any]) -> Path:
+    """
+    Updates the neighbors of a dataset with the ratings of a delta file, recalculating only the affected users.
+
+    The deltas are applied on top of each other: each one is applied to the latest model of the dataset and options,
+    kept by a pointer of the store named after the fingerprint of the model of the dataset. Each delta model is
+    stored under the fingerprint of the model it was applied to and of the delta, next to the incremental state of
+    its neighbors and to all the delta ratings applied since the model of the dataset, from which the next delta
+    continues. A delta already applied to the latest model is not applied again. The incremental state of the
+    model of the dataset is built from the full ratings the first time.
+    """
+    base_path = model_store.get_or_build(data_handler.input_folder, **preprocessor_options)
+    delta_hash = data_handler.content_hash(delta_path)
+
+    # a single process at a time extends the chain of deltas of the store
+    with model_store.build_lock():
+        previous_path = model_store.current(base_path.name) or base_path
+        hashes, deltas_df = _applied_deltas(previous_path)
+        if delta_hash in hashes:
+            logger.info(f"The ratings of {str(delta_path)} have already been applied")
+            return previous_path
+
+        fingerprint = model_store.fingerprint(data_handler.input_folder, load_model_metadata(previous_path)["model_id"],
+                                              delta_hash, **preprocessor_options)
+        model_path = model_store.lookup(fingerprint)
+        if model_path is None:
+            try:
+                state: IncrementalNeighbors = unpickle_object(previous_path / "incremental_neighbors.pkl")
+            except FileNotFoundError:
+                logger.warning("No incremental state found. Calculating it from all the ratings...")
+                state = preprocessor.incremental_neighbors(
+                    preprocessor._load_user_ratings(data_handler.iter_ratings()))
+                pickle_object(state, previous_path / "incremental_neighbors.pkl")
+
+            delta_df = pd.read_csv(delta_path, usecols=RATING_COLUMNS, dtype=RATING_DTYPES)
+            state.apply_delta(preprocessor._load_user_ratings(delta_df))
+            deltas_df = pd.concat([deltas_df, delta_df], ignore_index=True)
+
+            # Save the updated model for future use, with what the next delta continues from
+            model_path = model_store.model_folder(fingerprint)
+            model = ModelArrays.from_dicts(state.user_ratings, state.neighbors_u, preprocessor.polarity_weights)
+            model = preprocessor.add_factors(preprocessor.add_item_neighbors(model),
+                                             chain(data_handler.iter_ratings(), [deltas_df]))
+            save_model_arrays(model, model_path, data_handler.movie_catalog)
+            pickle_object(state, model_path / "incremental_neighbors.pkl")
+            deltas_df.to_parquet(model_path / "ratings_deltas.parquet", index=False)
+            with open(model_path / "deltas.json", "w") as f:
+                json.dump({"deltas": hashes + [delta_hash]}, f)
+
+        model_store.set_current(base_path.name, model_path)
+        model_store.evict(keep=[model_path, base_path])
+    return model_path
+
 
 def main(input_args: InputArguments):
     """Main function to call all the function of the module needed."""
@@ -37,27 +127,45 @@ def main(input_args: InputArguments):
     )
 
     # --- Calculate user neighbors ---
-    # Try loading the pickle files if force read is not provided
-    try:
-        if input_args.force_calculate:
-            raise FileNotFoundError()
-        user_ratings = unpickle_object(Path("./data/models/user_ratings.pkl"))
-        neighbors_u = unpickle_object(Path("./data/models/user_neighbors.pkl"))
-    except FileNotFoundError:
+    # Reuse the stored model of this dataset and options, unless force calculate is provided
+    model_store = ModelStore()
+    preprocessor_options = dict(neighbor_engine=input_args.neighbor_engine,
+                                similarity=input_args.similarity,
+                                item_neighbors=input_args.item_neighbors,
+                                factors=input_args.factors,
+                                max_neighbors=input_args.max_neighbors,
+                                n_jobs=input_args.n_jobs)
+    if input_args.ratings_delta is not None:
+        model_path = apply_ratings_delta(PreProcessor(**preprocessor_options), data_handler,
+                                         Path(input_args.ratings_delta), model_store, preprocessor_options)
+    else:
+        model_path = model_store.get_or_build(data_handler.input_folder, force=input_args.force_calculate,
+                                              **preprocessor_options)
+    model = load_model_arrays(model_path)
+
+    # precompute the recommended movies of all the users
+    if input_args.precompute is not None:
+        users = None if input_args.users_file is None else np.loadtxt(input_args.users_file, dtype=np.int64, ndmin=1)
+        precompute_recommendations(model_folder=model_path,
+                                   output_path=Path(input_args.precompute),
+                                   users=users,
+                                   neighbor_num=input_args.neighbors_num,
+                                   rec_num=input_args.recommendations_num,
+                                   n_jobs=input_args.n_jobs)
+        return
 
-        preprocessor = PreProcessor()
-        user_ratings, neighbors_u = preprocessor.preprocess(data_handler.ratings_df)
-        # Pickle the objects for future use
-        pickle_object(user_ratings, Path("./data/models/user_ratings.pkl"))
-        pickle_object(neighbors_u, Path("./data/models/user_neighbors.pkl"))
-
-    # find recommended movies
-    recommended_movies = recommend_ub(user=100,
-                                      movies_df=data_handler.movies_df,
-                                      neighbors_u=neighbors_u,
-                                      user_ratings=user_ratings,
-                                      neighbor_num=input_args.neighbors_num,
-                                      rec_num=input_args.recommendations_num)
+    # find recommended movies, from the embeddings or the similar movies if they were calculated
+    if input_args.factors > 0:
+        recommend = recommend_mf
+    elif input_args.item_neighbors > 0:
+        recommend = recommend_ib
+    else:
+        recommend = recommend_ub_arrays
+    recommended_movies = recommend(user=100,
+                                   movies_df=data_handler.movie_catalog,
+                                   model=model,
+                                   neighbor_num=input_args.neighbors_num,
+                                   rec_num=input_args.recommendations_num)
 
     for movie in recommended_movies:
         print(movie['title'])
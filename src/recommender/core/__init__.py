@@ -1,9 +1,33 @@
 from recommender.core.engine import (
     PreProcessor,
-    recommend_ub
+    recommend_ib,
+    recommend_mf,
+    recommend_precomputed,
+    recommend_ub,
+    recommend_ub_arrays,
+    recommend_ub_batch,
+    top_movies_batch
+)
+from recommender.core.incremental import (
+    IncrementalNeighbors
+)
+from recommender.core.model import (
+    ModelArrays,
+    MovieCatalog,
+    PrecomputedRecommendations
 )
 
 __all__ = [
+    "IncrementalNeighbors",
+    "ModelArrays",
+    "MovieCatalog",
+    "PrecomputedRecommendations",
     "PreProcessor",
-    "recommend_ub"
+    "recommend_ib",
+    "recommend_mf",
+    "recommend_precomputed",
+    "recommend_ub",
+    "recommend_ub_arrays",
+    "recommend_ub_batch",
+    "top_movies_batch"
 ]
\ No newline at end of file
@@ -1,12 +1,37 @@
 import logging
+import weakref
 from collections import defaultdict
+from dataclasses import replace
 from itertools import combinations
-from typing import Callable, Dict, Set, List, Tuple, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Tuple, Optional, Union
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from tqdm import tqdm
 from typing_extensions import TypedDict
 
+from recommender.core.factorization import als_factorize
+from recommender.core.incremental import IncrementalNeighbors
+from recommender.core.kernels import SIMILARITY_KERNELS, build_rating_matrix, kernel_neighbors
+from recommender.core.model import (
+    POLARITIES,
+    POLARITY_CODES,
+    POLARITY_WEIGHTS,
+    ModelArrays,
+    MovieCatalog,
+    PrecomputedRecommendations,
+    polarity_weights_array
+)
+from recommender.core.similarity import (
+    NeighborRetention,
+    inverted_index_jaccard_neighbors,
+    item_jaccard_neighbors,
+    minhash_jaccard_neighbors,
+    sparse_jaccard_neighbors
+)
+from recommender.utils.metrics import timer
+
 logger = logging.getLogger(__name__)
 
 
@@ -21,16 +46,125 @@ class MovieRecommendation(TypedDict):
 class PreProcessor:
     """A class used to preprocess movie ratings data."""
 
+    # engines available for the calculation of the user neighbors
+    neighbor_engines: Tuple[str, ...] = ('pairwise', 'sparse', 'minhash', 'inverted')
+
+    # similarity metrics of the users: the Jaccard coefficient of their discretized ratings, calculated by the
+    # `neighbor_engine`, or one of the blocked matrix kernels over their raw ratings
+    similarity_metrics: Tuple[str, ...] = ('jaccard', *SIMILARITY_KERNELS)
+
+    # discretizers mapping a whole array of ratings to their polarity codes at once. The other discretizers map
+    # one rating to its polarity, 'N', 'A' or 'P'
+    vectorized_discretizers: Tuple[str, ...] = ('discretize_ratings',)
+
     def __init__(self,
                  min_rating_num: int = 5,
-                 discretize_func: str = 'discretize_rating'):
+                 discretize_func: str = 'discretize_ratings',
+                 neighbor_engine: str = 'pairwise',
+                 max_neighbors: Optional[int] = None,
+                 min_similarity: float = 0.0,
+                 min_overlap: int = 1,
+                 n_jobs: int = 1,
+                 lsh_bands: int = 64,
+                 lsh_rows: int = 2,
+                 polarity_weights: Optional[Mapping[str, float]] = None,
+                 similarity: str = 'jaccard',
+                 item_neighbors: int = 0,
+                 item_min_overlap: int = 2,
+                 factors: int = 0,
+                 als_iterations: int = 10,
+                 als_regularization: float = 0.2,
+                 als_min_item_ratings: int = 5):
         """
         Args:
             min_rating_num (int): Minimum number of ratings required for a comparison.
-            discretize_func (str): The name of the function to be used for discetizing the ratings
+            discretize_func (str): The name of the method used to discretize the ratings, either one of
+                `vectorized_discretizers`, mapping an array of ratings to their int8 polarity codes, or a method
+                mapping a single rating to its polarity, like `discretize_rating`.
+            neighbor_engine (str): The engine used to calculate the user neighbors. One of `pairwise` (compare
+                every pair of users one by one), `sparse` (a single sparse matrix product over all users),
+                `minhash` (approximate neighbors, with exact similarities, through MinHash Locality Sensitive Hashing)
+                or `inverted` (only the pairs of users sharing a rating, with prefix filtering for `min_similarity`).
+            max_neighbors (Optional[int]): Maximum number of neighbors kept per user. Since the recommendations only
+                use the first neighbors of each user, this bounds the size of the neighbors without affecting them.
+                Keeps all the neighbors if `None`.
+            min_similarity (float): Minimum similarity required for a pair of users to be neighbors.
+            min_overlap (int): Minimum number of common ratings required for a pair of users to be neighbors.
+            n_jobs (int): Number of processes used by the `sparse` engine. `-1` uses all the available cores.
+            lsh_bands (int): Number of bands of the `minhash` signatures. More bands find more neighbors.
+            lsh_rows (int): Number of hash values per band of the `minhash` signatures. More rows compare fewer
+                pairs of users.
+            polarity_weights (Optional[Mapping[str, float]]): The weight of the vote of a neighbor for each
+                polarity, `{'N': -2, 'A': -1, 'P': 2}` by default. Missing polarities keep their default weight.
+            similarity (str): The similarity metric of the users, one of `similarity_metrics`. `jaccard` compares
+                their discretized ratings with the `neighbor_engine`, while `cosine`, `adjusted_cosine` (centered
+                by the mean rating of each movie), `pearson` (over the movies rated by both users) and
+                `weighted_jaccard` compare their raw ratings with blocked matrix products, whatever the engine.
+            item_neighbors (int): Number of most similar movies kept for each movie, for the item-based
+                recommendations of `recommend_ib`. `0` does not calculate them.
+            item_min_overlap (int): Minimum number of users giving the same polarity to two movies for them to be
+                similar. Filters out the similarities of movies with very few ratings.
+            factors (int): Dimension of the user and item embeddings factorizing the raw ratings, for the
+                recommendations of `recommend_mf`. `0` does not calculate them.
+            als_iterations (int): Number of Alternating Least Squares iterations of the factorization.
+            als_regularization (float): Weight of the L2 regularization of the embeddings, scaled by their number
+                of ratings.
+            als_min_item_ratings (int): Minimum number of ratings of a movie for its embedding to be fitted. The
+                movies with fewer ratings are predicted by their mean rating, shrunk towards the global mean.
         """
         self.min_rating_num: int = min_rating_num
         self.discretize_func = discretize_func
+        try:
+            self.polarity_weights: np.ndarray = polarity_weights_array(polarity_weights)
+        except ValueError as e:
+            logger.error(str(e))
+            raise
+
+        if neighbor_engine not in self.neighbor_engines:
+            error_msg = f"The provided `neighbor_engine` is not supported: {neighbor_engine}"
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        self.neighbor_engine: str = neighbor_engine
+        self.max_neighbors: Optional[int] = max_neighbors
+        self.min_similarity: float = min_similarity
+        self.min_overlap: int = min_overlap
+        self.n_jobs: int = n_jobs
+        self.lsh_bands: int = lsh_bands
+        self.lsh_rows: int = lsh_rows
+
+        if similarity not in self.similarity_metrics:
+            error_msg = f"The provided `similarity` is not supported: {similarity}"
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        self.similarity: str = similarity
+        self.item_neighbors: int = item_neighbors
+        self.item_min_overlap: int = item_min_overlap
+        self.factors: int = factors
+        self.als_iterations: int = als_iterations
+        self.als_regularization: float = als_regularization
+        self.als_min_item_ratings: int = als_min_item_ratings
+
+    def model_options(self) -> Dict[str, Any]:
+        """
+        Returns the options affecting the calculated ratings and neighbors, e.g. to identify the models built
+        with them. The number of processes is left out, since it does not change the results.
+        """
+        return {"min_rating_num": self.min_rating_num,
+                "discretize_func": self.discretize_func,
+                "neighbor_engine": self.neighbor_engine,
+                "max_neighbors": self.max_neighbors,
+                "min_similarity": self.min_similarity,
+                "min_overlap": self.min_overlap,
+                "lsh_bands": self.lsh_bands,
+                "lsh_rows": self.lsh_rows,
+                "polarity_weights": dict(zip(POLARITIES, self.polarity_weights.tolist())),
+                "similarity": self.similarity,
+                "item_neighbors": self.item_neighbors,
+                "item_min_overlap": self.item_min_overlap,
+                "factors": self.factors,
+                "als_iterations": self.als_iterations,
+                "als_regularization": self.als_regularization,
+                "als_min_item_ratings": self.als_min_item_ratings}
 
     @staticmethod
     def discretize_rating(rating: float) -> str:
@@ -43,43 +177,133 @@ class PreProcessor:
             return 'P'  # Positive
         return 'A'  # Average
 
-    def _load_user_ratings(self,
-                           ratings_df: pd.DataFrame,
-                           discretize_func: str = 'discretize_rating'
-                           ) -> Dict[int, Dict[int, str]]:
+    @staticmethod
+    def discretize_ratings(ratings: np.ndarray) -> np.ndarray:
         """
-        Loads all the ratings submitted by each user and discretizes them.
+        Converts an array of ratings to their int8 polarity codes at once, with the same thresholds as
+        `discretize_rating`: 0 (N) below 3, 1 (A) for 3 and 2 (P) above 3.
+        """
+        return (np.sign(np.asarray(ratings) - 3) + 1).astype(np.int8)
+
+    def rating_codes(self, ratings: np.ndarray, discretize_func: Optional[str] = None) -> np.ndarray:
+        """
+        Discretizes an array of ratings to their int8 polarity codes.
 
         Args:
-            discretize_func (str): The name of the function used to discretize ratings.
-            ratings_df: The DataFrame containing columns 'userId', 'movieId', 'rating'.
+            ratings (np.ndarray): The ratings.
+            discretize_func (Optional[str]): The name of the method used to discretize the ratings. The
+                `discretize_func` of the preprocessor if `None`.
 
         Returns:
-            Dict[int, MovieRatings]: A dictionary mapping each user to a dictionary of movie IDs and
-                their discretized ratings.
+            np.ndarray: The polarity code of each rating, see `POLARITY_CODES`.
         """
-        logger.info("Processing User Ratings:")
+        discretize_func = self.discretize_func if discretize_func is None else discretize_func
         try:
-            discretize_function: Callable[[float], str] = getattr(self, discretize_func)
+            discretize_function: Callable = getattr(self, discretize_func)
         except AttributeError:
             error_msg = f"The provided `discretize_func` for the user ratings is not supported: {discretize_func}"
             logger.error(error_msg)
             raise AttributeError(error_msg)
 
-        distinct_users: Set[int] = set(ratings_df['userId'])
+        if discretize_func in self.vectorized_discretizers:
+            return discretize_function(ratings)
+        # discretize each distinct rating value only once and map the whole array at once
+        rating_values, rating_codes = np.unique(ratings, return_inverse=True)
+        value_codes = np.array([POLARITY_CODES[discretize_function(rating)] for rating in rating_values.tolist()],
+                               dtype=np.int8)
+        return value_codes[rating_codes.reshape(-1)]
+
+    def _load_rating_arrays(self,
+                            ratings_df: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+                            discretize_func: Optional[str] = None
+                            ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Loads all the ratings and discretizes them, as compact arrays grouped by user.
+
+        The ratings can also be given as an iterable of chunks, e.g. from `DataHandler.iter_ratings`, in which
+        case each chunk is reduced to arrays of user IDs, movie IDs, ratings and polarity codes as soon as it is
+        read, without materializing the full DataFrame.
+
+        Args:
+            ratings_df: The DataFrame, or the chunks of it, containing columns 'userId', 'movieId', 'rating'.
+            discretize_func (Optional[str]): The name of the method used to discretize ratings. The
+                `discretize_func` of the preprocessor if `None`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: The user IDs, movie IDs, raw ratings and polarity
+                codes, sorted by user ID and keeping the original order of the ratings of each user.
+        """
+        chunks = [ratings_df] if isinstance(ratings_df, pd.DataFrame) else ratings_df
+        user_parts: List[np.ndarray] = []
+        movie_parts: List[np.ndarray] = []
+        rating_parts: List[np.ndarray] = []
+        code_parts: List[np.ndarray] = []
+        for chunk in chunks:
+            user_parts.append(chunk['userId'].to_numpy())
+            movie_parts.append(chunk['movieId'].to_numpy())
+            rating_parts.append(chunk['rating'].to_numpy())
+            code_parts.append(self.rating_codes(rating_parts[-1], discretize_func))
+        if not user_parts:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32),
+                    np.empty(0, dtype=np.int8))
+
+        # group the ratings of each user in contiguous slices, keeping their original order
+        user_ids = np.concatenate(user_parts)
+        order = np.argsort(user_ids, kind='stable')
+        return (user_ids[order], np.concatenate(movie_parts)[order], np.concatenate(rating_parts)[order],
+                np.concatenate(code_parts)[order])
+
+    @staticmethod
+    def _user_ratings_from_arrays(user_ids: np.ndarray,
+                                  movie_ids: np.ndarray,
+                                  codes: np.ndarray
+                                  ) -> Dict[int, Dict[int, str]]:
+        """Builds the `{userId: {movieId: polarity}}` dictionaries from rating arrays grouped by user."""
+        movies: List[int] = movie_ids.tolist()
+        polarities: List[str] = np.array(POLARITIES, dtype=object)[codes].tolist()
+
+        distinct_users, starts = np.unique(user_ids, return_index=True)
+        ends = np.append(starts[1:], len(user_ids))
 
         user_ratings: Dict[int, Dict[int, str]] = {}
 
-        # load and discretize ratings
-        for userId in tqdm(distinct_users, desc="Loading User Ratings..."):
-            my_ratings = ratings_df[ratings_df['userId'] == userId][['movieId', 'rating']]
-            user_ratings[userId] = dict(zip(my_ratings['movieId'], my_ratings['rating'].apply(discretize_function)))
+        # load the discretized ratings of each user
+        for userId, start, end in tqdm(zip(distinct_users.tolist(), starts.tolist(), ends.tolist()),
+                                       total=len(distinct_users), desc="Loading User Ratings..."):
+            user_ratings[userId] = dict(zip(movies[start:end], polarities[start:end]))
 
         return user_ratings
 
+    def _load_user_ratings(self,
+                           ratings_df: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+                           discretize_func: Optional[str] = None
+                           ) -> Dict[int, Dict[int, str]]:
+        """
+        Loads all the ratings submitted by each user and discretizes them.
+
+        The ratings are grouped by user in a single pass and discretized a whole column at a time, so the cost
+        grows linearly with the number of ratings. They can also be given as an iterable of chunks, see
+        `_load_rating_arrays`.
+
+        Args:
+            discretize_func (Optional[str]): The name of the method used to discretize ratings. The
+                `discretize_func` of the preprocessor if `None`.
+            ratings_df: The DataFrame, or the chunks of it, containing columns 'userId', 'movieId', 'rating'.
+
+        Returns:
+            Dict[int, MovieRatings]: A dictionary mapping each user to a dictionary of movie IDs and
+                their discretized ratings.
+        """
+        logger.info("Processing User Ratings:")
+        user_ids, movie_ids, _, codes = self._load_rating_arrays(ratings_df, discretize_func)
+        return self._user_ratings_from_arrays(user_ids, movie_ids, codes)
+
     @staticmethod
     def _get_user_neighbors(user_ratings: Dict[int, Dict[int, str]],
-                            min_rating_num: int = 5
+                            min_rating_num: int = 5,
+                            max_neighbors: Optional[int] = None,
+                            min_similarity: float = 0.0,
+                            min_overlap: int = 1
                             ) -> Dict[int, List[Tuple[int, float]]]:
         """
         Compute rating-based similarity between every two pairs of users using Jaccard coefficient.
@@ -87,16 +311,23 @@ class PreProcessor:
         Args:
             user_ratings (Dict[int, MovieRatings]): Ratings submitted by each user.
             min_rating_num (int): Minimum number of ratings required for a comparison.
+            max_neighbors (Optional[int]): Maximum number of neighbors kept per user. Keeps all of them if `None`.
+            min_similarity (float): Minimum similarity required for a pair of users to be neighbors.
+            min_overlap (int): Minimum number of common ratings required for a pair of users to be neighbors.
 
         Returns:
             Dict[int, List[Tuple[int, float]]]: A dictionary mapping each user to a list of tuples containing neighbor
                 user IDs and their similarity scores.
         """
         logger.info("Calculating user Neighbors")
-        pairs = list(combinations(list(user_ratings.keys()), 2))
-        usim = defaultdict(dict)
-
-        for u1, u2 in tqdm(pairs, desc="Calculating User Neighbors"):
+        users = list(enumerate(user_ratings.keys()))
+        pairs = combinations(users, 2)
+        usim = NeighborRetention(max_neighbors=max_neighbors,
+                                 min_similarity=min_similarity,
+                                 min_overlap=min_overlap)
+
+        for (r1, u1), (r2, u2) in tqdm(pairs, total=len(users) * (len(users) - 1) // 2,
+                                       desc="Calculating User Neighbors"):
             s1 = set(user_ratings[u1].items())
             s2 = set(user_ratings[u2].items())
 
@@ -108,20 +339,144 @@ class PreProcessor:
 
             jacc = len(inter) / len(union)
 
-            if jacc > 0:
-                usim[u1][u2] = jacc
-                usim[u2][u1] = jacc
+            if usim.accepts(jacc, len(inter)):
+                usim.push(u1, u2, r2, jacc)
+                usim.push(u2, u1, r1, jacc)
+
+        with timer("neighbors_sort"):
+            return usim.neighbors()
+
+    def get_user_neighbors(self,
+                           user_ratings: Dict[int, Dict[int, str]],
+                           rating_arrays: Optional[Tuple[np.ndarray, ...]] = None
+                           ) -> Dict[int, List[Tuple[int, float]]]:
+        """
+        Calculate the neighbors of each user using the selected `similarity` and `neighbor_engine`.
+
+        Args:
+            user_ratings (Dict[int, MovieRatings]): Ratings submitted by each user.
+            rating_arrays (Optional[Tuple[np.ndarray, ...]]): The user IDs, movie IDs and raw ratings, as
+                returned by `_load_rating_arrays`. Only needed by the similarities over the raw ratings.
+
+        Returns:
+            Dict[int, List[Tuple[int, float]]]: A dictionary mapping each user to a list of tuples containing neighbor
+                user IDs and their similarity scores.
+        """
+        options = dict(min_rating_num=self.min_rating_num,
+                       max_neighbors=self.max_neighbors,
+                       min_similarity=self.min_similarity,
+                       min_overlap=self.min_overlap)
+        if self.similarity != 'jaccard':
+            if rating_arrays is None:
+                error_msg = f"The `{self.similarity}` similarity needs the raw ratings of the users"
+                logger.error(error_msg)
+                raise ValueError(error_msg)
+            with timer("similarity"):
+                return kernel_neighbors(*rating_arrays[:3], metric=self.similarity, **options)
+
+        options['user_ratings'] = user_ratings
+        with timer("similarity"):
+            if self.neighbor_engine == 'sparse':
+                return sparse_jaccard_neighbors(n_jobs=self.n_jobs, **options)
+            if self.neighbor_engine == 'minhash':
+                return minhash_jaccard_neighbors(bands=self.lsh_bands, rows=self.lsh_rows, **options)
+            if self.neighbor_engine == 'inverted':
+                return inverted_index_jaccard_neighbors(**options)
+            return self._get_user_neighbors(**options)
+
+    def incremental_neighbors(self,
+                              user_ratings: Dict[int, Dict[int, str]]
+                              ) -> IncrementalNeighbors:
+        """
+        Calculate the neighbors of each user, keeping the state needed to update them with new ratings.
+
+        Args:
+            user_ratings (Dict[int, MovieRatings]): Ratings submitted by each user.
 
-        return {user: sorted(usim[user].items(), key=lambda x: x[1], reverse=True) for user in usim}
+        Returns:
+            IncrementalNeighbors: The neighbors of each user, to be updated with `apply_delta`.
+
+        Raises:
+            ValueError: If the similarity is not the Jaccard coefficient, the only one maintained incrementally.
+        """
+        if self.similarity != 'jaccard':
+            error_msg = f"The neighbors of the `{self.similarity}` similarity cannot be updated incrementally"
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        return IncrementalNeighbors(user_ratings=user_ratings,
+                                    min_rating_num=self.min_rating_num,
+                                    max_neighbors=self.max_neighbors,
+                                    min_similarity=self.min_similarity,
+                                    min_overlap=self.min_overlap)
+
+    def add_item_neighbors(self, model: ModelArrays) -> ModelArrays:
+        """
+        Calculate the `item_neighbors` most similar movies of each movie, from the ratings of the model.
+
+        Args:
+            model (ModelArrays): The model of the user ratings and neighbors.
+
+        Returns:
+            ModelArrays: The model with its item neighbors, for `recommend_ib`. The same model if `item_neighbors`
+                is 0.
+        """
+        if self.item_neighbors <= 0:
+            return model
+        with timer("item_similarity"):
+            indptr, items, sims = item_jaccard_neighbors(model.ratings_indptr, model.ratings_movies,
+                                                         model.ratings_codes, len(model.movie_ids),
+                                                         max_neighbors=self.item_neighbors,
+                                                         min_overlap=self.item_min_overlap)
+        return replace(model, item_neighbors_indptr=indptr, item_neighbors_items=items, item_neighbors_sims=sims)
+
+    def add_factors(self,
+                    model: ModelArrays,
+                    ratings_df: Union[pd.DataFrame, Iterable[pd.DataFrame]]
+                    ) -> ModelArrays:
+        """
+        Factorize the raw ratings of the users of the model in `factors` dimensional embeddings, with ALS.
+
+        Args:
+            model (ModelArrays): The model of the user ratings and neighbors.
+            ratings_df (Union[pd.DataFrame, Iterable[pd.DataFrame]]): The DataFrame, or the chunks of it, with the
+                raw ratings the model was built from, e.g. `DataHandler.iter_ratings()`. Only read if `factors`
+                is positive.
+
+        Returns:
+            ModelArrays: The model with its embeddings, for `recommend_mf`. The same model if `factors` is 0.
+
+        Raises:
+            ValueError: If the ratings do not have the users and movies of the model.
+        """
+        if self.factors <= 0:
+            return model
+        with timer("rating_load"):
+            user_ids, movie_ids, ratings, _ = self._load_rating_arrays(ratings_df)
+            users, matrix = build_rating_matrix(user_ids, movie_ids, ratings, min_rating_num=1)
+        if not np.array_equal(users, model.user_ids) or matrix.shape[1] != len(model.movie_ids):
+            error_msg = "The ratings to factorize do not match the users and movies of the model."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+
+        with timer("factorization"):
+            user_factors, item_factors, item_biases = als_factorize(matrix,
+                                                                    factors=self.factors,
+                                                                    iterations=self.als_iterations,
+                                                                    regularization=self.als_regularization,
+                                                                    min_item_ratings=self.als_min_item_ratings)
+        rating_range = np.array([matrix.data.min(), matrix.data.max()] if matrix.nnz else [], dtype=np.float32)
+        return replace(model, user_factors=user_factors, item_factors=item_factors, item_biases=item_biases,
+                       rating_range=rating_range)
 
     def preprocess(self,
-                   ratings_df: pd.DataFrame
+                   ratings_df: Union[pd.DataFrame, Iterable[pd.DataFrame]]
                    ) -> Tuple[Dict[int, Dict[int, str]], Dict[int, List[Tuple[int, float]]]]:
         """
         Calculate neighbors for each user based on their rating similarities.
 
         Args:
-            ratings_df (pd.DataFrame): The DataFrame containing columns 'userId', 'movieId', 'rating'.
+            ratings_df (Union[pd.DataFrame, Iterable[pd.DataFrame]]): The DataFrame, or the chunks of it, containing
+                columns 'userId', 'movieId', 'rating'.
 
         Returns:
             A Tuple of:
@@ -131,24 +486,50 @@ class PreProcessor:
                 user IDs and their similarity scores.
         """
         # process user ratings and calculate neighbors
-        user_ratings = self._load_user_ratings(ratings_df)
-        neighbors_u = self._get_user_neighbors(user_ratings=user_ratings,
-                                               min_rating_num=self.min_rating_num)
+        logger.info("Processing User Ratings:")
+        with timer("rating_load"):
+            rating_arrays = self._load_rating_arrays(ratings_df)
+            user_ratings = self._user_ratings_from_arrays(rating_arrays[0], rating_arrays[1], rating_arrays[3])
+        neighbors_u = self.get_user_neighbors(user_ratings, rating_arrays)
         return user_ratings, neighbors_u
 
 
+# the catalogs built from the movie DataFrames given to the recommenders, by frame id, with a weak reference to
+# their frame which drops them once the frame is garbage collected
+_frame_catalogs: Dict[int, Tuple[weakref.ref, MovieCatalog]] = {}
+
+
+def _as_catalog(movies_df: Union[pd.DataFrame, MovieCatalog]) -> MovieCatalog:
+    """
+    Returns the movie catalog, building it if a movies DataFrame is given instead.
+
+    The catalog of a DataFrame is built once and cached as long as the frame is alive, so a frame modified in
+    place afterwards must be given as a new frame or a new `MovieCatalog`.
+    """
+    if isinstance(movies_df, MovieCatalog):
+        return movies_df
+    key = id(movies_df)
+    cached = _frame_catalogs.get(key)
+    if cached is not None and cached[0]() is movies_df:
+        return cached[1]
+    catalog = MovieCatalog.from_frame(movies_df)
+    _frame_catalogs[key] = (weakref.ref(movies_df, lambda _: _frame_catalogs.pop(key, None)), catalog)
+    return catalog
+
+
 def recommend_ub(user: int,
-                 movies_df: pd.DataFrame,
+                 movies_df: Union[pd.DataFrame, MovieCatalog],
                  neighbors_u: Dict[int, List[Tuple[int, float]]],
                  user_ratings: Dict[int, Dict[int, str]],
                  neighbor_num: int,
-                 rec_num: int
+                 rec_num: int,
+                 polarity_weights: Optional[np.ndarray] = None
                  ) -> List[MovieRecommendation]:
     """
     Delivers user-based recommendations. Given a specific user:
     - Find the user's `neighbor_num` most similar users.
     - Go over all the movies rated by all neighbors.
-    - Each movie gets a weighted score based on neighbor ratings and similarity:
+    - Each movie gets a weighted score based on neighbor ratings and similarity: by default
       +2 for positive, -2 for negative, -1 for neutral (scaled by similarity).
     - Sort movies by their scores in descending order.
     - Recommend movies not already rated by the user.
@@ -156,17 +537,23 @@ def recommend_ub(user: int,
 
     Args:
         user (int): User ID for whom recommendations are being generated.
-        movies_df (pd.DataFrame): DataFrame containing movie details with movie IDs as the index.
+        movies_df (Union[pd.DataFrame, MovieCatalog]): The movie details, preferably as a prebuilt `MovieCatalog`.
+            A DataFrame with movie IDs as the index is converted to a catalog on its first use.
         neighbors_u (Dict[int, List[Tuple[int, float]]]): Dictionary mapping user IDs
             to a list of (neighbor ID, similarity) tuples.
         user_ratings (dict): Dictionary mapping user IDs to their movie ratings {movie_id: 'P'/'N'/'A'}.
         neighbor_num (int): Number of most similar neighbors to consider.
         rec_num (int): Number of recommendations to make.
+        polarity_weights (Optional[np.ndarray]): The weight of each polarity code, e.g.
+            `PreProcessor.polarity_weights`. The default weights if `None`.
 
     Returns:
-        None
+        List[MovieRecommendation]: The recommended movies in decreasing order of score, excluding the ones already
+        rated by the user. Empty if the user has no neighbors or `rec_num` is not positive.
     """
     logger.info(f"Calculating recommended movies for user: {user}")
+    weights = POLARITY_WEIGHTS if polarity_weights is None else polarity_weights
+    polarity_weight: Dict[str, float] = {pol: weights[code].item() for pol, code in POLARITY_CODES.items()}
 
     top_k: List[Tuple[int, float]] = neighbors_u.get(user, [])[:neighbor_num]  # get the top k neighbors of this user
     if not top_k:
@@ -175,32 +562,30 @@ def recommend_ub(user: int,
 
     votes = defaultdict(int)  # count the votes per movie
 
-    for neighbor, sim_val in top_k:  # for each neighbor
-        logger.debug(f"Processing neighbor {neighbor} with similarity {sim_val:.2f}")
-        for mid, pol in user_ratings[neighbor].items():  # for each movie rated by this neighbor
-
-            if pol == 'P':  # positive neighbor rating
-                votes[mid] += 2 * sim_val
-            elif pol == 'N':  # negative
-                votes[mid] -= 2 * sim_val
-            else:  # average
-                votes[mid] -= 1 * sim_val
+    with timer("scoring"):
+        for neighbor, sim_val in top_k:  # for each neighbor
+            logger.debug(f"Processing neighbor {neighbor} with similarity {sim_val:.2f}")
+            for mid, pol in user_ratings[neighbor].items():  # for each movie rated by this neighbor
+                votes[mid] += polarity_weight[pol] * sim_val  # weighted by the polarity of the neighbor rating
 
     # sort the movies in desc order
-    srt: List[Tuple[int, float]] = sorted(votes.items(), key=lambda x: x[1], reverse=True)
+    with timer("ranking"):
+        srt: List[Tuple[int, float]] = sorted(votes.items(), key=lambda x: x[1], reverse=True)
 
     cnt = 0  # count number of recommendations made
+    my_ratings: Dict[int, str] = user_ratings[user]
+    catalog: MovieCatalog = _as_catalog(movies_df)
 
     already_rated = defaultdict(str)
     recommendations: List[MovieRecommendation] = []
 
     for mov, score in srt:  # for each movie
+        if cnt >= rec_num:
+            break  # stop once you 've made enough recommendations
 
-        movie: pd.Series = movies_df.loc[mov]  # get the movie
-        title: str = movie['title']
-        genres: str = movie['genres']
+        title, genres = catalog.movie(mov)  # get the movie
 
-        rating: Optional[str] = user_ratings[user].get(mov, None)  # check if the user has already rated the movie
+        rating: Optional[str] = my_ratings.get(mov, None)  # check if the user has already rated the movie
 
         if rating:  # movie already rated
             already_rated[title] = rating  # store the rating
@@ -216,11 +601,371 @@ def recommend_ub(user: int,
                                 )
         )
 
-        if cnt == rec_num:
-            break  # stop once you 've made enough recommendations
-
     # Log the results
     logger.debug(dict(already_rated))
-    logger.info(recommendations)
+    logger.debug(recommendations)
+
+    return recommendations
+
+
+def recommend_ub_arrays(user: int,
+                        movies_df: Union[pd.DataFrame, MovieCatalog],
+                        model: ModelArrays,
+                        neighbor_num: int,
+                        rec_num: int
+                        ) -> List[MovieRecommendation]:
+    """
+    Delivers the user-based recommendations of `recommend_ub`, vectorized over an array-backed model. They match
+    up to the float32 similarities of the model, which can change the last rounded decimal of a score, and the order
+    of the movies with tied scores, which is by movie index here:
+    - Gather the ratings of the user's `neighbor_num` most similar users at once.
+    - Map their polarities to the `polarity_weights` of the model, by default +2 (positive), -2 (negative) and
+      -1 (neutral), scaled by similarity.
+    - Scatter-add the weighted votes in a dense score vector over all the movies.
+    - Mask the movies not rated by any neighbor and the movies already rated by the user.
+    - Select the `rec_num` best movies with a partial sort.
+
+    Args:
+        user (int): User ID for whom recommendations are being generated.
+        movies_df (Union[pd.DataFrame, MovieCatalog]): The movie details, preferably as a prebuilt `MovieCatalog`.
+            A DataFrame with movie IDs as the index is converted to a catalog on its first use.
+        model (ModelArrays): The array-backed user ratings and neighbors.
+        neighbor_num (int): Number of most similar neighbors to consider.
+        rec_num (int): Number of recommendations to make.
+
+    Returns:
+        List[MovieRecommendation]: The recommended movies, by descending score.
+    """
+    logger.info(f"Calculating recommended movies for user: {user}")
+
+    with timer("neighbor_fetch"):
+        index = model.user_index(user)
+        if index is None or model.neighbors_indptr[index] == model.neighbors_indptr[index + 1]:
+            logger.warning(f"No similar neighbors found for user {user}")
+            return []
+
+        # the top k neighbors of this user
+        start = model.neighbors_indptr[index]
+        end = min(start + max(neighbor_num, 0), model.neighbors_indptr[index + 1])
+        neighbors = model.neighbors_users[start:end]
+        sims = model.neighbors_sims[start:end].astype(np.float64)
+
+        # positions of all the ratings of the neighbors
+        starts, ends = model.ratings_indptr[neighbors], model.ratings_indptr[neighbors + 1]
+        lengths = ends - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    with timer("scoring"):
+        # weighted votes per movie, accumulated in the same order as `recommend_ub`
+        movies = model.ratings_movies[positions]
+        votes = model.polarity_weights[model.ratings_codes[positions]] * np.repeat(sims, lengths)
+        scores = np.bincount(movies, weights=votes, minlength=len(model.movie_ids))
+
+        # candidates are the movies voted by a neighbor and not rated by the user
+        candidates = np.zeros(len(model.movie_ids), dtype=bool)
+        candidates[movies] = True
+        candidates[model.ratings_movies[model.ratings_indptr[index]:model.ratings_indptr[index + 1]]] = False
+        candidate_ids = np.flatnonzero(candidates)
+
+    k = min(rec_num, len(candidate_ids))
+    if k <= 0:
+        return []
+    with timer("ranking"):
+        top = candidate_ids[_top_k(candidate_ids, scores[candidate_ids], k)]
+
+    with timer("metadata_lookup"):
+        recommendations = _movie_recommendations(movies_df, model.movie_ids[top], scores[top])
+
+    logger.debug(recommendations)
+    return recommendations
+
+
+def _top_k(candidates: np.ndarray, scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns the positions of the `k` best scores, by descending score. Ties are always broken by the candidate
+    index, since all the candidates scoring at least as the k-th best one are sorted.
+    """
+    kth_score = -np.partition(-scores, k - 1)[k - 1]
+    top = np.flatnonzero(scores >= kth_score)
+    return top[np.lexsort((candidates[top], -scores[top]))][:k]
+
+
+def _movie_recommendations(movies_df: Union[pd.DataFrame, MovieCatalog],
+                           movie_ids: np.ndarray,
+                           scores: np.ndarray
+                           ) -> List[MovieRecommendation]:
+    """Returns the recommendations of the given movies and scores, with the details of the movies."""
+    catalog = _as_catalog(movies_df)
+    rows = catalog.index(movie_ids)  # get the movies
+    return [
+        MovieRecommendation(movieId=mov,
+                            title=title,
+                            movie_genres=genres,
+                            recommendedScore=round(score, 3))
+        for mov, title, genres, score in zip(movie_ids.tolist(), catalog.titles[rows].tolist(),
+                                             catalog.genres[rows].tolist(), scores.tolist())
+    ]
+
+
+def recommend_ib(user: int,
+                 movies_df: Union[pd.DataFrame, MovieCatalog],
+                 model: ModelArrays,
+                 neighbor_num: int,
+                 rec_num: int
+                 ) -> List[MovieRecommendation]:
+    """
+    Delivers item-based recommendations, from the precomputed similar movies of the movies rated by the user:
+    - Gather the `neighbor_num` most similar movies of each movie rated by the user.
+    - Each similar movie gets the similarity scaled by the `polarity_weights` of the user's rating of the movie it
+      is similar to, so that the movies similar to the ones the user disliked are pushed down.
+    - Recommend the `rec_num` best movies not already rated by the user.
+
+    Only the ratings of the user are read, so the cost grows with the length of the user's history and not with
+    the ratings of other users. The similar movies also change much more slowly than the user neighbors, so the
+    model stays valid longer between rebuilds.
+
+    Args:
+        user (int): User ID for whom recommendations are being generated.
+        movies_df (Union[pd.DataFrame, MovieCatalog]): The movie details, preferably as a prebuilt `MovieCatalog`.
+        model (ModelArrays): The array-backed model, with its item neighbors.
+        neighbor_num (int): Number of most similar movies to consider per rated movie.
+        rec_num (int): Number of recommendations to make.
 
+    Returns:
+        List[MovieRecommendation]: The recommended movies, by descending score.
+
+    Raises:
+        ValueError: If the item neighbors of the model were not calculated.
+    """
+    if not model.has_item_neighbors:
+        error_msg = "The item neighbors of the model must be calculated first, see `PreProcessor.item_neighbors`."
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    logger.info(f"Calculating item-based recommended movies for user: {user}")
+
+    with timer("neighbor_fetch"):
+        index = model.user_index(user)
+        if index is None:
+            logger.warning(f"No ratings found for user {user}")
+            return []
+
+        # the top similar movies of each movie rated by the user
+        rated = model.ratings_movies[model.ratings_indptr[index]:model.ratings_indptr[index + 1]]
+        codes = model.ratings_codes[model.ratings_indptr[index]:model.ratings_indptr[index + 1]]
+        starts = model.item_neighbors_indptr[rated]
+        lengths = np.minimum(model.item_neighbors_indptr[rated + 1] - starts, max(neighbor_num, 0))
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    with timer("scoring"):
+        # weighted votes per similar movie, over the similar movies only
+        votes = np.repeat(model.polarity_weights[codes], lengths) * model.item_neighbors_sims[positions]
+        candidates, inverse = np.unique(model.item_neighbors_items[positions], return_inverse=True)
+        scores = np.bincount(inverse, weights=votes, minlength=len(candidates))
+
+        # candidates are the similar movies not rated by the user
+        unrated = ~np.isin(candidates, rated)
+        candidates, scores = candidates[unrated], scores[unrated]
+
+    k = min(rec_num, len(candidates))
+    if k <= 0:
+        logger.warning(f"No similar movies found for user {user}")
+        return []
+    with timer("ranking"):
+        top = _top_k(candidates, scores, k)
+
+    with timer("metadata_lookup"):
+        recommendations = _movie_recommendations(movies_df, model.movie_ids[candidates[top]], scores[top])
+
+    logger.debug(recommendations)
     return recommendations
+
+
+def recommend_mf(user: int,
+                 movies_df: Union[pd.DataFrame, MovieCatalog],
+                 model: ModelArrays,
+                 neighbor_num: int,
+                 rec_num: int
+                 ) -> List[MovieRecommendation]:
+    """
+    Delivers recommendations from the matrix factorization of the ratings: the predicted rating of every movie is
+    its bias plus the dot product of the user and item embeddings, a single matrix-vector product, and the
+    `rec_num` best movies not already rated by the user are recommended, with their predicted rating as score.
+    The movies are ranked by their raw predictions, but the scores are clipped to the rating range of the model,
+    since the predictions of the best movies may overshoot the highest rating. `neighbor_num` is ignored.
+
+    Args:
+        user (int): User ID for whom recommendations are being generated.
+        movies_df (Union[pd.DataFrame, MovieCatalog]): The movie details, preferably as a prebuilt `MovieCatalog`.
+        model (ModelArrays): The array-backed model, with its embeddings.
+        neighbor_num (int): Unused, since the embeddings summarize all the ratings. Kept so that the recommenders
+            are interchangeable.
+        rec_num (int): Number of recommendations to make.
+
+    Returns:
+        List[MovieRecommendation]: The recommended movies, by descending score.
+
+    Raises:
+        ValueError: If the embeddings of the model were not calculated.
+    """
+    if not model.has_factors:
+        error_msg = "The embeddings of the model must be calculated first, see `PreProcessor.factors`."
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    logger.info(f"Calculating factorization recommended movies for user: {user}")
+
+    index = model.user_index(user)
+    if index is None:
+        logger.warning(f"No ratings found for user {user}")
+        return []
+
+    with timer("scoring"):
+        scores = model.item_factors @ model.user_factors[index] + model.item_biases
+        scores[model.ratings_movies[model.ratings_indptr[index]:model.ratings_indptr[index + 1]]] = -np.inf
+
+    k = min(rec_num, len(scores) - int(model.ratings_indptr[index + 1] - model.ratings_indptr[index]))
+    if k <= 0:
+        return []
+    with timer("ranking"):
+        top = _top_k(np.arange(len(scores)), scores, k)
+
+    predictions = scores[top].astype(np.float64)
+    if len(model.rating_range) == 2:  # models saved by older versions have no rating range
+        predictions = np.clip(predictions, *model.rating_range.tolist())
+    with timer("metadata_lookup"):
+        recommendations = _movie_recommendations(movies_df, model.movie_ids[top], predictions)
+
+    logger.debug(recommendations)
+    return recommendations
+
+
+def top_movies_batch(users: Iterable[int],
+                     model: ModelArrays,
+                     neighbor_num: int,
+                     rec_num: int,
+                     batch_size: int = 256
+                     ) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Scores `batch_size` users at once and yields the IDs and scores of the best movies of each user, without
+    their details. See `recommend_ub_batch` for the scoring.
+
+    Args:
+        users (Iterable[int]): User IDs for whom recommendations are being generated.
+        model (ModelArrays): The array-backed user ratings and neighbors.
+        neighbor_num (int): Number of most similar neighbors to consider.
+        rec_num (int): Number of recommendations to make per user.
+        batch_size (int): Number of users scored at once.
+
+    Yields:
+        Tuple[int, np.ndarray, np.ndarray]: Each user ID with the IDs and the float64 scores of its recommended
+            movies, by descending score, in the order of `users`.
+    """
+    users = list(users)
+    num_movies = len(model.movie_ids)
+    neighbor_num = max(neighbor_num, 0)
+
+    for batch_start in range(0, len(users), batch_size):
+        batch = users[batch_start:batch_start + batch_size]
+        logger.info(f"Calculating recommended movies for {len(batch)} users")
+        with timer("batch_scoring"):
+            indices = np.array([-1 if index is None else index for index in map(model.user_index, batch)],
+                               dtype=np.int64)
+            known = indices >= 0
+
+            # (batch x users) similarities of the top k neighbors of each user
+            starts = np.where(known, model.neighbors_indptr[indices], 0)
+            ends = np.where(known, np.minimum(starts + neighbor_num, model.neighbors_indptr[indices + 1]), 0)
+            lengths = ends - starts
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            indptr = np.concatenate(([0], np.cumsum(lengths)))
+            neighbors, columns = np.unique(model.neighbors_users[positions], return_inverse=True)
+            similarities = sparse.csr_matrix((model.neighbors_sims[positions].astype(np.float64), columns, indptr),
+                                             shape=(len(batch), len(neighbors)))
+            voters = similarities.copy()
+            voters.data = np.ones(len(voters.data), dtype=np.int32)
+
+            # dense (batch x movies) scores, with the movies not voted or already rated masked out. Only the
+            # ratings of the neighbors of the batch are read
+            votes, voted = model.rating_rows(neighbors)
+            scores = (similarities @ votes).toarray()
+            candidates = (voters @ voted).toarray() > 0
+            rated = model.rating_rows(np.where(known, indices, 0))[1].toarray() > 0
+            candidates &= ~(rated & known[:, None])
+            scores[~candidates] = -np.inf
+
+            # score of the k-th best movie of each user, so that ties are always broken by the movie index
+            k = max(min(rec_num, num_movies), 0)
+            kth_scores = -np.partition(-scores, k - 1, axis=1)[:, k - 1] if k > 0 else np.full(len(batch), np.inf)
+
+        for row, user in enumerate(batch):
+            with timer("ranking"):
+                best = np.flatnonzero((scores[row] >= kth_scores[row]) & np.isfinite(scores[row]))
+                best = best[np.lexsort((best, -scores[row, best]))][:k]
+            yield user, model.movie_ids[best], scores[row, best]
+
+
+def recommend_ub_batch(users: Iterable[int],
+                       movies_df: Union[pd.DataFrame, MovieCatalog],
+                       model: ModelArrays,
+                       neighbor_num: int,
+                       rec_num: int,
+                       batch_size: int = 256
+                       ) -> Iterator[Tuple[int, List[MovieRecommendation]]]:
+    """
+    Delivers the user-based recommendations of many users, scoring `batch_size` users at once:
+    - Build the (batch x users) matrix with the similarities of the top `neighbor_num` neighbors of each user.
+    - Multiply it with the (users x movies) matrix of the polarity weights of every rating, which gives the
+      scores of all the movies for the whole batch.
+    - Mask the movies not rated by any neighbor and the movies already rated by each user.
+    - Select the `rec_num` best movies of each user with a partial sort.
+
+    The recommendations are yielded as soon as each batch is scored, so they can be streamed.
+
+    Args:
+        users (Iterable[int]): User IDs for whom recommendations are being generated.
+        movies_df (Union[pd.DataFrame, MovieCatalog]): The movie details, preferably as a prebuilt `MovieCatalog`.
+        model (ModelArrays): The array-backed user ratings and neighbors.
+        neighbor_num (int): Number of most similar neighbors to consider.
+        rec_num (int): Number of recommendations to make per user.
+        batch_size (int): Number of users scored at once.
+
+    Yields:
+        Tuple[int, List[MovieRecommendation]]: Each user ID with its recommended movies, by descending score,
+            in the order of `users`. Users without neighbors get no recommendations.
+    """
+    for user, movie_ids, scores in top_movies_batch(users, model, neighbor_num, rec_num, batch_size):
+        with timer("metadata_lookup"):
+            recommendations = _movie_recommendations(movies_df, movie_ids, scores)
+        yield user, recommendations
+
+
+def recommend_precomputed(user: int,
+                          movies_df: Union[pd.DataFrame, MovieCatalog],
+                          table: PrecomputedRecommendations,
+                          rec_num: int
+                          ) -> Optional[List[MovieRecommendation]]:
+    """
+    Delivers the recommendations of a user from a table precomputed offline with `table.neighbor_num` neighbors.
+
+    Since the precomputed movies are sorted by descending score, the best `rec_num` of them are the same as
+    the ones `recommend_ub_arrays` would return for any `rec_num` up to `table.rec_num`.
+
+    Args:
+        user (int): User ID for whom recommendations are being delivered.
+        movies_df (Union[pd.DataFrame, MovieCatalog]): The movie details, preferably as a prebuilt `MovieCatalog`.
+        table (PrecomputedRecommendations): The precomputed recommendations.
+        rec_num (int): Number of recommendations to deliver.
+
+    Returns:
+        Optional[List[MovieRecommendation]]: The recommended movies, by descending score, or `None` if the user
+            is not in the table or `rec_num` is larger than the number of precomputed recommendations.
+    """
+    if rec_num > table.rec_num:
+        return None
+    with timer("precomputed_lookup"):
+        found = table.lookup(user)
+    if found is None:
+        return None
+
+    with timer("metadata_lookup"):
+        rec_num = max(rec_num, 0)
+        return _movie_recommendations(movies_df, found[0][:rec_num], found[1][:rec_num])
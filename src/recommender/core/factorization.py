@@ -0,0 +1,124 @@
+"""
+Matrix factorization of the raw ratings with Alternating Least Squares (ALS).
+"""
+import logging
+from typing import Tuple
+
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# largest number of cells of the factors gathered for the ratings of a block of rows, and of the matrices of their
+# normal equations, built at once
+_MAX_BLOCK_CELLS = 1 << 22
+
+
+def als_factorize(ratings: sparse.csr_matrix,
+                  factors: int = 32,
+                  iterations: int = 10,
+                  regularization: float = 0.2,
+                  bias_regularization: float = 10.0,
+                  min_item_ratings: int = 1,
+                  seed: int = 0
+                  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Factorizes the (users x movies) rating matrix as `item_biases[movie] + user_factors[user] @ item_factors[movie]`.
+
+    The bias of each movie is its mean rating, shrunk towards the global mean for the movies with few ratings by
+    `bias_regularization`. The factors are then fitted to the remaining residuals by Alternating Least Squares,
+    with the weighted regularization of ALS-WR: each iteration solves the regularized least squares of every
+    user for fixed item factors, then of every movie for fixed user factors. The normal equations are built and
+    solved for a block of users or movies at once.
+
+    Args:
+        ratings (sparse.csr_matrix): The (users x movies) matrix of the raw ratings, e.g. from
+            `build_rating_matrix`.
+        factors (int): The dimension of the embeddings.
+        iterations (int): Number of ALS iterations.
+        regularization (float): Weight of the L2 regularization of each embedding, scaled by its number of ratings.
+        bias_regularization (float): Number of global mean ratings added to the ratings of each movie for its bias.
+        min_item_ratings (int): Minimum number of ratings of a movie for its factors to be fitted. The embeddings of
+            the movies with fewer ratings stay zero, so that their predicted rating is their shrunk bias instead of
+            an overfitted one.
+        seed (int): The seed of the random initial item factors.
+
+    Returns:
+        A Tuple of:
+        - np.ndarray: The float32 (users x factors) user embeddings.
+        - np.ndarray: The float32 (movies x factors) item embeddings.
+        - np.ndarray: The float32 bias of each movie.
+    """
+    logger.info(f"Factorizing {ratings.nnz} ratings with {factors} factors")
+    ratings = sparse.csr_matrix(ratings, dtype=np.float64)
+
+    global_mean = ratings.data.mean() if ratings.nnz else 0.0
+    movie_counts = np.bincount(ratings.indices, minlength=ratings.shape[1])
+    movie_sums = np.bincount(ratings.indices, weights=ratings.data, minlength=ratings.shape[1])
+    item_biases = global_mean + (movie_sums - movie_counts * global_mean) / (movie_counts + bias_regularization)
+
+    # the factors are only fitted to the ratings of the movies with at least `min_item_ratings` ratings, so the
+    # other movies keep zero factors and are predicted by their bias alone
+    supported = movie_counts[ratings.indices] >= min_item_ratings
+    rows = np.repeat(np.arange(ratings.shape[0]), np.diff(ratings.indptr))[supported]
+    columns = ratings.indices[supported]
+    residuals = sparse.csr_matrix((ratings.data[supported] - item_biases[columns], (rows, columns)),
+                                  shape=ratings.shape)
+    residuals_by_movie = residuals.T.tocsr()
+
+    rng = np.random.default_rng(seed)
+    user_factors = np.zeros((ratings.shape[0], factors))
+    item_factors = rng.normal(0.0, 0.1, size=(ratings.shape[1], factors))
+    for _ in tqdm(range(iterations), desc="Factorizing Ratings"):
+        user_factors = _least_squares(residuals, item_factors, regularization)
+        item_factors = _least_squares(residuals_by_movie, user_factors, regularization)
+
+    return user_factors.astype(np.float32), item_factors.astype(np.float32), item_biases.astype(np.float32)
+
+
+def _least_squares(targets: sparse.csr_matrix, fixed: np.ndarray, regularization: float) -> np.ndarray:
+    """
+    Solves the regularized least squares of every row of `targets` for the fixed factors of its columns.
+
+    The row `r` with the ratings `t` of the columns `c` gets the factors solving
+    `(fixed[c].T @ fixed[c] + regularization * len(c) * I) @ x = fixed[c].T @ t`. The rows of a block are grouped
+    by their width, the next power of two of their number of ratings, and the factors of the columns of each row of
+    a group are gathered in a zero padded (rows x width x factors) array, so that the matrices of the systems of
+    the group are a single batched product and are solved at once. The right-hand sides of the block are a single
+    sparse product. The blocks hold about `_MAX_BLOCK_CELLS` cells of the gathered factors and of the matrices of
+    the systems.
+
+    Returns:
+        np.ndarray: The float64 (rows x factors) solutions. Rows without ratings get zero factors.
+    """
+    num_rows, num_factors = targets.shape[0], fixed.shape[1]
+    indptr, indices = targets.indptr, targets.indices
+    counts = np.diff(indptr)
+    widths = np.where(counts > 0, 2 ** np.ceil(np.log2(np.maximum(counts, 1))).astype(np.int64), 0)
+    solutions = np.zeros((num_rows, num_factors))
+    block_ratings = max(_MAX_BLOCK_CELLS // num_factors, 1)
+    block_rows = max(_MAX_BLOCK_CELLS // (num_factors * num_factors), 1)
+    # the padding gathers the factors of a zero column
+    padded = np.vstack((fixed, np.zeros((1, num_factors))))
+
+    start = 0
+    while start < num_rows:
+        # as many rows as fit in a block, and at least one
+        end = int(np.searchsorted(indptr, indptr[start] + block_ratings, side='right')) - 1
+        end = min(max(end, start + 1), start + block_rows, num_rows)
+        rhs = targets[start:end] @ fixed
+
+        for width in np.unique(widths[start:end]).tolist():
+            if width == 0:
+                continue  # rows without ratings
+            rows = start + np.flatnonzero(widths[start:end] == width)
+            offsets = np.arange(width)
+            positions = np.minimum(indptr[rows, None] + offsets, len(indices) - 1)
+            gathered = padded[np.where(offsets < counts[rows, None], indices[positions], len(fixed))]
+
+            gram = np.matmul(gathered.transpose(0, 2, 1), gathered)
+            gram.reshape(len(rows), -1)[:, ::num_factors + 1] += regularization * counts[rows, None]
+            solutions[rows] = np.linalg.solve(gram, rhs[rows - start, :, None])[:, :, 0]
+        start = end
+    return solutions
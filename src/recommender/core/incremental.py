@@ -0,0 +1,203 @@
+"""
+Incremental maintenance of the user neighbors when new ratings arrive.
+"""
+import heapq
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from recommender.core.similarity import sparse_jaccard_neighbors
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalNeighbors:
+    """
+    Keeps the user neighbors up to date with deltas of new or changed ratings, without recomputing all the pairs.
+
+    Besides the ratings and the neighbors, it keeps an inverted index from each `(movieId, polarity)` token to the
+    users having it, from which the intersections of a user with all the others are counted on demand. The memory
+    is linear in the number of ratings, unlike the intersections of all the pairs of users.
+
+    A user with changed ratings gets its neighbors recalculated. Every user it overlaps with, before or after the
+    change, only gets the entry of the changed user moved within its neighbor list, as the similarity of that single
+    pair changed. The neighbors of such a user are recalculated only when the changed user drops out of a full list,
+    since a user left out of the list may then take its place.
+
+    The neighbors are always identical to the ones `PreProcessor._get_user_neighbors` would calculate from
+    scratch over the updated ratings, with new users ordered after the existing ones.
+    """
+
+    def __init__(self,
+                 user_ratings: Dict[int, Dict[int, str]],
+                 min_rating_num: int = 5,
+                 max_neighbors: Optional[int] = None,
+                 min_similarity: float = 0.0,
+                 min_overlap: int = 1):
+        """
+        Args:
+            user_ratings (Dict[int, MovieRatings]): Ratings submitted by each user.
+            min_rating_num (int): Minimum number of ratings required for a comparison.
+            max_neighbors (Optional[int]): Maximum number of neighbors kept per user. Keeps all of them if `None`.
+            min_similarity (float): Minimum similarity required for a pair of users to be neighbors.
+            min_overlap (int): Minimum number of common ratings required for a pair of users to be neighbors.
+        """
+        self.min_rating_num: int = min_rating_num
+        self.max_neighbors: Optional[int] = max_neighbors
+        self.min_similarity: float = min_similarity
+        self.min_overlap: int = max(min_overlap, 1)
+
+        self.user_ratings: Dict[int, Dict[int, str]] = {user: dict(ratings) for user, ratings in user_ratings.items()}
+        self._rank: Dict[int, int] = {user: rank for rank, user in enumerate(self.user_ratings)}
+        self._postings: Dict[Tuple[int, str], Set[int]] = defaultdict(set)
+        for user, ratings in self.user_ratings.items():
+            for token in ratings.items():
+                self._postings[token].add(user)
+
+        self.neighbors_u: Dict[int, List[Tuple[int, float]]] = sparse_jaccard_neighbors(
+            self.user_ratings,
+            min_rating_num=min_rating_num,
+            max_neighbors=max_neighbors,
+            min_similarity=min_similarity,
+            min_overlap=self.min_overlap
+        )
+
+    def _count_overlaps(self, user: int) -> Dict[int, int]:
+        """Counts the common tokens of a user with every other user sharing at least one of them."""
+        overlaps = Counter()
+        for token in self.user_ratings[user].items():
+            overlaps.update(self._postings[token])
+        overlaps.pop(user, None)
+        return overlaps
+
+    def _key(self, user: int, other: int, common: int) -> Optional[Tuple[float, int, int]]:
+        """
+        Returns the sort key of `other` among the neighbors of `user`, by descending similarity and then by rank,
+        or `None` if they are not neighbors.
+        """
+        size, other_size = len(self.user_ratings[user]), len(self.user_ratings[other])
+        if size < self.min_rating_num or other_size < self.min_rating_num or common < self.min_overlap:
+            return None
+        jacc = common / (size + other_size - common)
+        return None if jacc < self.min_similarity else (-jacc, self._rank[other], other)
+
+    def _update_neighbors(self, user: int, overlaps: Optional[Dict[int, int]] = None) -> None:
+        """Recalculates the neighbors of a user from its intersections with all the other users."""
+        if overlaps is None:
+            overlaps = self._count_overlaps(user)
+        keys = (self._key(user, other, common) for other, common in overlaps.items())
+        keys = [key for key in keys if key is not None]
+        keys = sorted(keys) if self.max_neighbors is None else heapq.nsmallest(self.max_neighbors, keys)
+        if keys:
+            self.neighbors_u[user] = [(other, -jacc) for jacc, _, other in keys]
+        else:
+            self.neighbors_u.pop(user, None)
+
+    def _neighbor_key(self, neighbor: int, jacc: float) -> Tuple[float, int, int]:
+        """Returns the sort key of a kept neighbor."""
+        return -jacc, self._rank[neighbor], neighbor
+
+    def _position(self, neighbors: List[Tuple[int, float]], key: Tuple[float, int, int]) -> int:
+        """Returns the position of a sort key among the sorted neighbors of a user, with a binary search."""
+        low, high = 0, len(neighbors)
+        while low < high:
+            middle = (low + high) // 2
+            if self._neighbor_key(*neighbors[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _move_neighbor(self,
+                       user: int,
+                       other: int,
+                       old_key: Optional[Tuple[float, int, int]],
+                       key: Optional[Tuple[float, int, int]]
+                       ) -> bool:
+        """
+        Moves `other` among the neighbors of `user` from the place of its sort key before a change of its ratings
+        to the place of its new one. `None` keys are the ones of users which are not neighbors.
+
+        Returns:
+            bool: Whether the neighbors of `user` changed.
+        """
+        if old_key == key:
+            return False
+        neighbors = self.neighbors_u.get(user, [])
+        full = bool(neighbors) and self.max_neighbors is not None and len(neighbors) >= self.max_neighbors
+
+        # `other` may also have been left out of a full list
+        position = None if old_key is None else self._position(neighbors, old_key)
+        if position is not None and (position == len(neighbors) or neighbors[position][0] != other):
+            position = None
+
+        if position is not None:
+            last_key = self._neighbor_key(*neighbors[-1])
+            del neighbors[position]
+            # the users left out of a full list rank after its last neighbor, and one of them may now rank
+            # before `other`
+            if full and (key is None or key > last_key):
+                self._update_neighbors(user)
+                return True
+        elif key is None or (full and key > self._neighbor_key(*neighbors[-1])):
+            return False
+
+        if key is not None:
+            neighbors.insert(self._position(neighbors, key), (other, -key[0]))
+            if self.max_neighbors is not None:
+                del neighbors[self.max_neighbors:]
+        if neighbors:
+            self.neighbors_u[user] = neighbors
+        else:
+            self.neighbors_u.pop(user, None)
+        return True
+
+    def apply_delta(self, delta_ratings: Dict[int, Dict[int, str]]) -> Set[int]:
+        """
+        Applies new or changed ratings and updates the neighbors of the users affected by them.
+
+        The users with changed ratings are applied one at a time, so that the neighbors are consistent with the
+        ratings applied so far after each of them.
+
+        Args:
+            delta_ratings (Dict[int, MovieRatings]): The new or changed discretized ratings of each user, as
+                returned by `PreProcessor._load_user_ratings` for the delta.
+
+        Returns:
+            Set[int]: The users whose neighbors were updated.
+        """
+        touched: Set[int] = set()
+        updated: Set[int] = set()
+
+        for user, ratings in delta_ratings.items():
+            if user not in self.user_ratings:
+                self.user_ratings[user] = {}
+                self._rank[user] = len(self._rank)
+            my_ratings = self.user_ratings[user]
+            changes = [(movie, polarity) for movie, polarity in ratings.items() if my_ratings.get(movie) != polarity]
+            if not changes:
+                continue
+
+            # the users sharing a token with the user before the changes may share none afterwards
+            previous = self._count_overlaps(user)
+            old_keys = {other: self._key(other, user, common) for other, common in previous.items()}
+            for movie, polarity in changes:
+                old_polarity = my_ratings.get(movie)
+                if old_polarity is not None:
+                    self._postings[(movie, old_polarity)].discard(user)
+                self._postings[(movie, polarity)].add(user)
+                my_ratings[movie] = polarity
+            overlaps = self._count_overlaps(user)
+
+            # the size of the user changes its similarity with every user it overlaps with
+            self._update_neighbors(user, overlaps)
+            touched.add(user)
+            for other in old_keys.keys() | overlaps.keys():
+                key = self._key(other, user, overlaps.get(other, 0))
+                if self._move_neighbor(other, user, old_keys.get(other), key):
+                    updated.add(other)
+
+        updated |= touched
+        logger.info(f"Applied the new ratings of {len(touched)} users, updating the neighbors of {len(updated)} "
+                    f"users")
+        return updated
@@ -0,0 +1,275 @@
+"""
+Similarity metrics over the raw ratings, calculated as blocked matrix products.
+"""
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple, Type
+
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+from recommender.core.similarity import pairs_to_neighbors, sort_top_pairs
+
+logger = logging.getLogger(__name__)
+
+# largest number of (user, user) or (movie, user) cells calculated at once, which bounds the rows of a block
+_MAX_BLOCK_CELLS = 1 << 22
+
+
+def build_rating_matrix(user_ids: np.ndarray,
+                        movie_ids: np.ndarray,
+                        ratings: np.ndarray,
+                        min_rating_num: int = 5
+                        ) -> Tuple[List[int], sparse.csr_matrix]:
+    """
+    Builds the sparse (users x movies) matrix of the raw ratings of every eligible user.
+
+    Users with less than `min_rating_num` ratings are skipped. If a user rated a movie more than once, the last
+    rating is kept, as in `PreProcessor._load_user_ratings`.
+
+    Args:
+        user_ids (np.ndarray): The user ID of each rating.
+        movie_ids (np.ndarray): The movie ID of each rating.
+        ratings (np.ndarray): The ratings.
+        min_rating_num (int): Minimum number of ratings required for a comparison.
+
+    Returns:
+        A Tuple of:
+        - List[int]: The sorted user IDs, one for each row of the matrix.
+        - sparse.csr_matrix: A (users x movies) float64 matrix with the rating of each user for each movie.
+    """
+    order = np.lexsort((movie_ids, user_ids))
+    user_ids, movie_ids, ratings = user_ids[order], movie_ids[order], ratings[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (user_ids[1:] != user_ids[:-1]) | (movie_ids[1:] != movie_ids[:-1])
+    user_ids, movie_ids, ratings = user_ids[last], movie_ids[last], ratings[last]
+
+    users, user_rows, counts = np.unique(user_ids, return_inverse=True, return_counts=True)
+    _, movie_cols = np.unique(movie_ids, return_inverse=True)
+    eligible = counts >= min_rating_num
+    rows = np.cumsum(eligible) - 1
+    keep = eligible[user_rows]
+
+    matrix = sparse.csr_matrix((ratings[keep].astype(np.float64), (rows[user_rows[keep]], movie_cols[keep])),
+                               shape=(int(eligible.sum()), int(movie_cols.max(initial=-1)) + 1))
+    return users[eligible].tolist(), matrix
+
+
+class SimilarityKernel(ABC):
+    """
+    A similarity metric between users, calculated for a block of users against all the users at once.
+
+    The kernel precomputes what it needs from the (users x movies) rating matrix when created, and `similarity`
+    returns dense (block x users) arrays, each one the product of a sparse matrix of all the users with the dense
+    block, so no pair of users is visited in Python.
+    """
+
+    # whether `similarity` uses the number of movies rated by both users of each pair
+    needs_overlap: bool = False
+
+    def __init__(self, ratings: sparse.csr_matrix):
+        """
+        Args:
+            ratings (sparse.csr_matrix): The (users x movies) matrix of the raw ratings.
+        """
+        self.ratings: sparse.csr_matrix = ratings
+        self.rated: sparse.csr_matrix = sparse.csr_matrix((np.ones(ratings.nnz), ratings.indices, ratings.indptr),
+                                                          shape=ratings.shape)
+
+    @staticmethod
+    def product(left: sparse.csr_matrix, right: sparse.csr_matrix, start: int, end: int) -> np.ndarray:
+        """Returns the dense (block x users) product of the rows `start:end` of `left` with `right` transposed."""
+        return np.ascontiguousarray((right @ left[start:end].T.toarray()).T)
+
+    def overlap(self, start: int, end: int) -> np.ndarray:
+        """Returns the number of movies rated by both users, for the users `start:end` against all the users."""
+        return self.product(self.rated, self.rated, start, end)
+
+    @abstractmethod
+    def similarity(self, start: int, end: int, overlap: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Returns the similarity of the users `start:end` with all the users.
+
+        Args:
+            start (int): The first row of the block.
+            end (int): The row after the last row of the block.
+            overlap (Optional[np.ndarray]): The number of movies rated by both users of each pair, as returned by
+                `overlap`. Only given to the kernels which `needs_overlap`.
+
+        Returns:
+            np.ndarray: The (block x users) similarities.
+        """
+
+
+def _divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """Divides two arrays, with a 0 wherever the denominator is not positive."""
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+
+class CosineKernel(SimilarityKernel):
+    """Cosine of the rating vectors of the users, the movies not rated counting as 0."""
+
+    def __init__(self, ratings: sparse.csr_matrix):
+        super().__init__(ratings)
+        self.vectors: sparse.csr_matrix = self.rating_vectors(ratings)
+        self.norms: np.ndarray = np.sqrt(np.asarray(self.vectors.multiply(self.vectors).sum(axis=1)).ravel())
+
+    def rating_vectors(self, ratings: sparse.csr_matrix) -> sparse.csr_matrix:
+        """Returns the vectors compared by the cosine: the raw ratings."""
+        return ratings
+
+    def similarity(self, start: int, end: int, overlap: Optional[np.ndarray] = None) -> np.ndarray:
+        dot = self.product(self.vectors, self.vectors, start, end)
+        return _divide(dot, np.outer(self.norms[start:end], self.norms))
+
+
+class AdjustedCosineKernel(CosineKernel):
+    """
+    Cosine of the rating vectors of the users after subtracting the mean rating of each movie, so that the
+    popularity of the movies does not make all the users look alike.
+    """
+
+    def rating_vectors(self, ratings: sparse.csr_matrix) -> sparse.csr_matrix:
+        """Returns the ratings minus the mean rating of their movie."""
+        counts = np.bincount(ratings.indices, minlength=ratings.shape[1])
+        means = _divide(np.bincount(ratings.indices, weights=ratings.data, minlength=ratings.shape[1]),
+                        counts.astype(np.float64))
+        return sparse.csr_matrix((ratings.data - means[ratings.indices], ratings.indices, ratings.indptr),
+                                 shape=ratings.shape)
+
+
+class PearsonKernel(SimilarityKernel):
+    """
+    Pearson correlation of the raw ratings of each pair of users over the movies they both rated.
+
+    The sums over the common movies of both users are products of the rating, squared rating and binary
+    matrices, so the per-pair means are exact without visiting the pairs.
+    """
+
+    needs_overlap = True
+
+    def __init__(self, ratings: sparse.csr_matrix):
+        super().__init__(ratings)
+        self.squares: sparse.csr_matrix = ratings.multiply(ratings).tocsr()
+
+    def similarity(self, start: int, end: int, overlap: Optional[np.ndarray] = None) -> np.ndarray:
+        sum_x = self.product(self.ratings, self.rated, start, end)
+        sum_y = self.product(self.rated, self.ratings, start, end)
+        sum_xx = self.product(self.squares, self.rated, start, end)
+        sum_yy = self.product(self.rated, self.squares, start, end)
+        sum_xy = self.product(self.ratings, self.ratings, start, end)
+
+        covariance = overlap * sum_xy - sum_x * sum_y
+        variances = np.clip(overlap * sum_xx - sum_x ** 2, 0, None) * np.clip(overlap * sum_yy - sum_y ** 2, 0, None)
+        return _divide(covariance, np.sqrt(variances))
+
+
+class WeightedJaccardKernel(SimilarityKernel):
+    """
+    Weighted Jaccard of the raw ratings: the sum of the smaller rating over the sum of the larger rating of every
+    movie, the movies not rated counting as 0.
+
+    Each rating is expanded to one column per distinct rating value it reaches, weighted by the step to that
+    value, so that a single product sums `min(a, b)` over the common movies. The sum of the larger ratings
+    follows from the totals of both users.
+    """
+
+    def __init__(self, ratings: sparse.csr_matrix):
+        super().__init__(ratings)
+        values = np.unique(ratings.data)
+        steps = np.diff(values, prepend=0.0)
+        levels = np.searchsorted(values, ratings.data) + 1  # the number of values reached by each rating
+
+        row_of = np.repeat(np.arange(ratings.shape[0]), np.diff(ratings.indptr))
+        expanded = np.repeat(np.arange(ratings.nnz), levels)
+        level = np.arange(len(expanded)) - np.repeat(np.cumsum(levels) - levels, levels)
+        shape = (ratings.shape[0], ratings.shape[1] * len(values))
+        columns = ratings.indices[expanded].astype(np.int64) * len(values) + level
+        self.weighted_levels: sparse.csr_matrix = sparse.csr_matrix((steps[level], (row_of[expanded], columns)),
+                                                                    shape=shape)
+        self._levels_t: sparse.csr_matrix = sparse.csr_matrix((np.ones(len(expanded)),
+                                                               (row_of[expanded], columns)), shape=shape).T.tocsr()
+        self.totals: np.ndarray = np.asarray(ratings.sum(axis=1)).ravel()
+
+    def similarity(self, start: int, end: int, overlap: Optional[np.ndarray] = None) -> np.ndarray:
+        # a sparse product, since a dense block over all the expanded columns would be several times larger
+        sum_min = (self.weighted_levels[start:end] @ self._levels_t).toarray()
+        sum_max = self.totals[start:end, None] + self.totals[None, :] - sum_min
+        return _divide(sum_min, sum_max)
+
+
+# similarity metrics over the raw ratings, by name
+SIMILARITY_KERNELS: Dict[str, Type[SimilarityKernel]] = {
+    'cosine': CosineKernel,
+    'adjusted_cosine': AdjustedCosineKernel,
+    'pearson': PearsonKernel,
+    'weighted_jaccard': WeightedJaccardKernel,
+}
+
+
+def kernel_neighbors(user_ids: np.ndarray,
+                     movie_ids: np.ndarray,
+                     ratings: np.ndarray,
+                     metric: str = 'cosine',
+                     min_rating_num: int = 5,
+                     max_neighbors: Optional[int] = None,
+                     min_similarity: float = 0.0,
+                     min_overlap: int = 1,
+                     block_size: int = 1024
+                     ) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Compute the similarity between every two users with one of the `SIMILARITY_KERNELS`.
+
+    The similarities of `block_size` users with all the others are calculated at once as dense arrays, with
+    fewer users per block when there are many users, and only the retained neighbors of each block are kept. As
+    with the Jaccard engines, the neighbors need a positive similarity, and ties are resolved in favour of the
+    user with the smallest ID.
+
+    Args:
+        user_ids (np.ndarray): The user ID of each rating.
+        movie_ids (np.ndarray): The movie ID of each rating.
+        ratings (np.ndarray): The raw ratings.
+        metric (str): The name of the similarity metric, one of `SIMILARITY_KERNELS`.
+        min_rating_num (int): Minimum number of ratings required for a comparison.
+        max_neighbors (Optional[int]): Maximum number of neighbors kept per user. Keeps all of them if `None`.
+        min_similarity (float): Minimum similarity required for a pair of users to be neighbors.
+        min_overlap (int): Minimum number of common ratings required for a pair of users to be neighbors.
+        block_size (int): Maximum number of users compared with all the others at once.
+
+    Returns:
+        Dict[int, List[Tuple[int, float]]]: A dictionary mapping each user to a list of tuples containing neighbor
+            user IDs and their similarity scores.
+    """
+    if metric not in SIMILARITY_KERNELS:
+        error_msg = f"The provided similarity metric is not supported: {metric}"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+
+    logger.info(f"Calculating user Neighbors with the {metric} similarity")
+    users, matrix = build_rating_matrix(np.asarray(user_ids), np.asarray(movie_ids), np.asarray(ratings),
+                                        min_rating_num)
+    num_users = len(users)
+    kernel = SIMILARITY_KERNELS[metric](matrix)
+    block_size = max(1, min(block_size, _MAX_BLOCK_CELLS // max(num_users, matrix.shape[1], 1)))
+
+    neighbors_u: Dict[int, List[Tuple[int, float]]] = {}
+    for start in tqdm(range(0, num_users, block_size), desc="Calculating User Neighbors"):
+        end = min(start + block_size, num_users)
+        # a positive similarity implies a common movie, so the overlap is only calculated when it matters
+        overlap = kernel.overlap(start, end) if kernel.needs_overlap or min_overlap > 1 else None
+        sims = kernel.similarity(start, end, overlap)
+
+        keep = (sims > 0) & (sims >= min_similarity)
+        if overlap is not None:
+            keep &= overlap >= max(min_overlap, 1)
+        keep[np.arange(end - start), np.arange(start, end)] = False
+        if max_neighbors is not None and max_neighbors < num_users:
+            # only the candidates at least as similar as the k-th best one of their row, ties included
+            masked = np.where(keep, sims, -np.inf)
+            kth = np.partition(masked, num_users - max_neighbors, axis=1)[:, num_users - max_neighbors]
+            keep &= masked >= kth[:, None]
+
+        rows, cols = np.nonzero(keep)
+        pairs_to_neighbors(users, *sort_top_pairs(rows + start, cols, sims[rows, cols], max_neighbors), neighbors_u)
+    return neighbors_u
@@ -0,0 +1,345 @@
+"""
+Array-backed representation of the user ratings and neighbors used for the recommendations.
+"""
+from dataclasses import MISSING, dataclass, field, fields
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# int8 codes of the discretized ratings
+POLARITY_CODES: Dict[str, int] = {'N': 0, 'A': 1, 'P': 2}
+POLARITIES: Tuple[str, ...] = tuple(sorted(POLARITY_CODES, key=POLARITY_CODES.get))
+
+# default weight of the vote of a neighbor for each polarity code: -2 for negative, -1 for average and +2 for
+# positive
+POLARITY_WEIGHTS: np.ndarray = np.array([-2.0, -1.0, 2.0])
+
+
+def polarity_weights_array(polarity_weights: Optional[Mapping[str, float]] = None) -> np.ndarray:
+    """
+    Returns the weights of the polarities as an array indexed by polarity code.
+
+    Args:
+        polarity_weights (Optional[Mapping[str, float]]): The weight of each polarity, e.g.
+            `{'N': -2, 'A': -1, 'P': 2}`. Missing polarities keep their default weight.
+
+    Returns:
+        np.ndarray: The float64 weight of each polarity code.
+    """
+    weights = POLARITY_WEIGHTS.copy()
+    for polarity, weight in (polarity_weights or {}).items():
+        if polarity not in POLARITY_CODES:
+            raise ValueError(f"Unknown polarity `{polarity}`, expected one of {list(POLARITY_CODES)}")
+        weights[POLARITY_CODES[polarity]] = weight
+    return weights
+
+
+@dataclass(frozen=True)
+class ModelArrays:
+    """
+    The user ratings and neighbors stored in flat arrays, in CSR layout, instead of nested dictionaries.
+
+    Users and movies are referred to by their dense index, i.e. their position in `user_ids` and `movie_ids`.
+    The ratings of the user with index `u` are the `ratings_movies[ratings_indptr[u]:ratings_indptr[u + 1]]`
+    movies with the polarity codes of `ratings_codes` at the same positions. Similarly, the neighbors of `u` are
+    found in `neighbors_users` and `neighbors_sims`, sorted by descending similarity. The vote of a neighbor
+    for a movie is its similarity scaled by the `polarity_weights` of the code of its rating.
+
+    The most similar movies of the movie with index `i`, used by the item-based recommendations, are the
+    `item_neighbors_items[item_neighbors_indptr[i]:item_neighbors_indptr[i + 1]]` movies, with the similarities
+    of `item_neighbors_sims`. They are empty unless calculated with `PreProcessor.add_item_neighbors`.
+
+    The embeddings of the matrix factorization, used by `recommend_mf`, are the rows of `user_factors` and
+    `item_factors`, and the predicted rating of a movie is its `item_biases` plus the dot product of the user and
+    item embeddings, clipped to the lowest and highest rating of `rating_range`. They are empty unless calculated
+    with `PreProcessor.add_factors`.
+    """
+    user_ids: np.ndarray  # int64, sorted
+    movie_ids: np.ndarray  # int64, sorted
+    ratings_indptr: np.ndarray  # int64
+    ratings_movies: np.ndarray  # int32
+    ratings_codes: np.ndarray  # int8
+    neighbors_indptr: np.ndarray  # int64
+    neighbors_users: np.ndarray  # int32
+    neighbors_sims: np.ndarray  # float32
+    polarity_weights: np.ndarray = field(default_factory=POLARITY_WEIGHTS.copy)  # float64, by polarity code
+    item_neighbors_indptr: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))  # int64
+    item_neighbors_items: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))  # int32
+    item_neighbors_sims: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))  # float32
+    user_factors: np.ndarray = field(default_factory=lambda: np.empty((0, 0), dtype=np.float32))  # float32
+    item_factors: np.ndarray = field(default_factory=lambda: np.empty((0, 0), dtype=np.float32))  # float32
+    item_biases: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))  # float32
+    rating_range: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))  # float32, (min, max)
+
+    @classmethod
+    def array_names(cls) -> List[str]:
+        """Returns the names of the arrays of the model."""
+        return [field.name for field in fields(cls)]
+
+    @classmethod
+    def optional_array_names(cls) -> List[str]:
+        """Returns the names of the arrays with a default, which models saved by older versions may lack."""
+        return [field.name for field in fields(cls) if field.default_factory is not MISSING]
+
+    @property
+    def has_item_neighbors(self) -> bool:
+        """Whether the similar movies of each movie were calculated, for the item-based recommendations."""
+        return len(self.item_neighbors_indptr) == len(self.movie_ids) + 1
+
+    @property
+    def has_factors(self) -> bool:
+        """Whether the user and item embeddings were calculated, for the matrix factorization recommendations."""
+        return (len(self.user_factors) == len(self.user_ids) and len(self.item_factors) == len(self.movie_ids)
+                and len(self.item_biases) == len(self.movie_ids) and len(self.movie_ids) > 0)
+
+    @classmethod
+    def from_dicts(cls,
+                   user_ratings: Dict[int, Dict[int, str]],
+                   neighbors_u: Dict[int, List[Tuple[int, float]]],
+                   polarity_weights: Optional[np.ndarray] = None
+                   ) -> 'ModelArrays':
+        """
+        Converts the dictionaries returned by `PreProcessor.preprocess` to arrays.
+
+        Args:
+            user_ratings (Dict[int, MovieRatings]): Ratings submitted by each user.
+            neighbors_u (Dict[int, List[Tuple[int, float]]]): Dictionary mapping user IDs
+                to a list of (neighbor ID, similarity) tuples.
+            polarity_weights (Optional[np.ndarray]): The weight of each polarity code, e.g.
+                `PreProcessor.polarity_weights`. The default weights if `None`.
+
+        Returns:
+            ModelArrays: The array-backed model.
+        """
+        user_ids = np.array(sorted(user_ratings), dtype=np.int64)
+        movie_ids = np.unique(np.fromiter((movie for ratings in user_ratings.values() for movie in ratings),
+                                          dtype=np.int64))
+
+        ratings_indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        ratings_indptr[1:] = np.cumsum([len(user_ratings[user]) for user in user_ids.tolist()])
+        ratings_movies = np.searchsorted(movie_ids, np.fromiter(
+            (movie for user in user_ids.tolist() for movie in user_ratings[user]), dtype=np.int64,
+            count=ratings_indptr[-1])).astype(np.int32)
+        ratings_codes = np.fromiter(
+            (POLARITY_CODES[pol] for user in user_ids.tolist() for pol in user_ratings[user].values()),
+            dtype=np.int8, count=ratings_indptr[-1])
+
+        neighbors_indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        neighbors_indptr[1:] = np.cumsum([len(neighbors_u.get(user, [])) for user in user_ids.tolist()])
+        neighbors = [neighbor for user in user_ids.tolist() for neighbor in neighbors_u.get(user, [])]
+        neighbors_users = np.searchsorted(user_ids, np.array([neighbor for neighbor, _ in neighbors],
+                                                             dtype=np.int64)).astype(np.int32)
+        neighbors_sims = np.array([sim for _, sim in neighbors], dtype=np.float32)
+
+        return cls(user_ids=user_ids,
+                   movie_ids=movie_ids,
+                   ratings_indptr=ratings_indptr,
+                   ratings_movies=ratings_movies,
+                   ratings_codes=ratings_codes,
+                   neighbors_indptr=neighbors_indptr,
+                   neighbors_users=neighbors_users,
+                   neighbors_sims=neighbors_sims,
+                   polarity_weights=np.asarray(POLARITY_WEIGHTS if polarity_weights is None else polarity_weights,
+                                               dtype=np.float64))
+
+    def user_index(self, user: int) -> Optional[int]:
+        """Returns the dense index of a user ID, or `None` if the user is unknown."""
+        index = int(np.searchsorted(self.user_ids, user))
+        if index < len(self.user_ids) and self.user_ids[index] == user:
+            return index
+        return None
+
+    def rating_rows(self, rows: np.ndarray) -> Tuple[sparse.csr_matrix, sparse.csr_matrix]:
+        """
+        Returns the ratings of the users with the given indices as sparse (rows x movies) matrices.
+
+        Only the ratings of these users are read, so the matrices of a batch of users are built without copying
+        the ratings of the whole model, which stay memory-mapped and shared by all the processes serving it.
+
+        Args:
+            rows (np.ndarray): The dense indices of the users.
+
+        Returns:
+            A Tuple of:
+            - sparse.csr_matrix: The weight of the polarity of each rating.
+            - sparse.csr_matrix: A binary matrix with a 1 for each rating.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.ratings_indptr[rows]
+        lengths = self.ratings_indptr[rows + 1] - starts
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths)
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+
+        movies, shape = self.ratings_movies[positions], (len(rows), len(self.movie_ids))
+        return (sparse.csr_matrix((self.polarity_weights[self.ratings_codes[positions]], movies, indptr), shape=shape),
+                sparse.csr_matrix((np.ones(len(positions), dtype=np.int32), movies, indptr), shape=shape))
+
+    @property
+    def user_ratings(self) -> 'UserRatingsView':
+        """A read-only `{userId: {movieId: polarity}}` view of the ratings, as returned by `PreProcessor`."""
+        return UserRatingsView(self)
+
+    @property
+    def neighbors_u(self) -> 'NeighborsView':
+        """A read-only `{userId: [(neighborId, similarity)]}` view of the neighbors, as returned by `PreProcessor`."""
+        return NeighborsView(self)
+
+
+class UserRatingsView(Mapping):
+    """Dictionary-like access to the ratings of a `ModelArrays`, materializing only the requested users."""
+
+    def __init__(self, model: ModelArrays):
+        self.model: ModelArrays = model
+
+    def __getitem__(self, user: int) -> Dict[int, str]:
+        index = self.model.user_index(user)
+        if index is None:
+            raise KeyError(user)
+        start, end = self.model.ratings_indptr[index], self.model.ratings_indptr[index + 1]
+        movies = self.model.movie_ids[self.model.ratings_movies[start:end]].tolist()
+        return dict(zip(movies, (POLARITIES[code] for code in self.model.ratings_codes[start:end].tolist())))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.model.user_ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self.model.user_ids)
+
+
+class NeighborsView(Mapping):
+    """Dictionary-like access to the neighbors of a `ModelArrays`, materializing only the requested users."""
+
+    def __init__(self, model: ModelArrays):
+        self.model: ModelArrays = model
+
+    def __getitem__(self, user: int) -> List[Tuple[int, float]]:
+        index = self.model.user_index(user)
+        if index is None:
+            raise KeyError(user)
+        start, end = self.model.neighbors_indptr[index], self.model.neighbors_indptr[index + 1]
+        if start == end:
+            raise KeyError(user)
+        neighbors = self.model.user_ids[self.model.neighbors_users[start:end]].tolist()
+        return list(zip(neighbors, self.model.neighbors_sims[start:end].tolist()))
+
+    def __iter__(self) -> Iterator[int]:
+        has_neighbors = np.diff(self.model.neighbors_indptr) > 0
+        return iter(self.model.user_ids[has_neighbors].tolist())
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(np.diff(self.model.neighbors_indptr)))
+
+
+@dataclass(frozen=True)
+class MovieCatalog:
+    """
+    The movie details in arrays, so that the title and genres of the recommended movies are plain array reads
+    instead of pandas row lookups.
+
+    The movie with dense index `i` has the ID `movie_ids[i]`, the title `titles[i]` and the genres `genres[i]`.
+    `rows` maps each movie ID directly to its dense index (-1 for unknown IDs).
+    """
+    movie_ids: np.ndarray  # int64, sorted
+    titles: np.ndarray
+    genres: np.ndarray
+    rows: np.ndarray  # int32, indexed by movie ID
+
+    @classmethod
+    def from_frame(cls, movies_df: pd.DataFrame) -> 'MovieCatalog':
+        """
+        Builds the catalog from the movies DataFrame.
+
+        Args:
+            movies_df (pd.DataFrame): DataFrame containing movie details with movie IDs as the index.
+
+        Returns:
+            MovieCatalog: The movie catalog.
+        """
+        movies_df = movies_df.sort_index()
+        movie_ids = movies_df.index.to_numpy(dtype=np.int64)
+        if len(movie_ids) and movie_ids[0] < 0:
+            raise ValueError(f"Movie IDs must be non-negative, but got {movie_ids[0]}")
+        rows = np.full(movie_ids.max() + 1 if len(movie_ids) else 0, -1, dtype=np.int32)
+        rows[movie_ids] = np.arange(len(movie_ids), dtype=np.int32)
+        return cls(movie_ids=movie_ids,
+                   titles=movies_df['title'].to_numpy(dtype=object),
+                   genres=movies_df['genres'].to_numpy(dtype=object),
+                   rows=rows)
+
+    def index(self, movie_ids: np.ndarray) -> np.ndarray:
+        """
+        Returns the dense index of each of the given movie IDs.
+
+        Raises:
+            KeyError: If any of the movies is not in the catalog.
+        """
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        known = (movie_ids >= 0) & (movie_ids < len(self.rows))
+        rows = np.full(movie_ids.shape, -1, dtype=np.int32)
+        rows[known] = self.rows[movie_ids[known]]
+        if (rows < 0).any():
+            raise KeyError(movie_ids[rows < 0].tolist())
+        return rows
+
+    def movie(self, movie_id: int) -> Tuple[str, str]:
+        """Returns the title and genres of a movie."""
+        row = int(self.index(np.array([movie_id]))[0])
+        return self.titles[row], self.genres[row]
+
+
+@dataclass(frozen=True)
+class PrecomputedRecommendations:
+    """
+    The top-N recommendations of many users, computed offline, for direct lookups while serving.
+
+    The recommendations of the user `user_ids[i]` are the `movie_ids[indptr[i]:indptr[i + 1]]` movies with the
+    scores of `scores` at the same positions, by descending score. They were calculated with the model
+    identified by `model_id`, considering `neighbor_num` neighbors and keeping up to `rec_num` movies per user.
+    """
+    user_ids: np.ndarray  # int64, sorted
+    indptr: np.ndarray  # int64
+    movie_ids: np.ndarray  # int64
+    scores: np.ndarray  # float32
+    model_id: str
+    neighbor_num: int
+    rec_num: int
+
+    @classmethod
+    def from_columns(cls,
+                     users: np.ndarray,
+                     ranks: np.ndarray,
+                     movies: np.ndarray,
+                     scores: np.ndarray,
+                     model_id: str,
+                     neighbor_num: int,
+                     rec_num: int
+                     ) -> 'PrecomputedRecommendations':
+        """
+        Builds the lookup arrays from the (user ID, rank, movie ID, score) columns of the precomputed table.
+
+        Returns:
+            PrecomputedRecommendations: The precomputed recommendations.
+        """
+        order = np.lexsort((ranks, users))
+        users = np.asarray(users, dtype=np.int64)[order]
+        user_ids, counts = np.unique(users, return_counts=True)
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        return cls(user_ids=user_ids,
+                   indptr=indptr,
+                   movie_ids=np.asarray(movies, dtype=np.int64)[order],
+                   scores=np.asarray(scores, dtype=np.float32)[order],
+                   model_id=model_id,
+                   neighbor_num=neighbor_num,
+                   rec_num=rec_num)
+
+    def lookup(self, user: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Returns the movie IDs and scores recommended to a user, or `None` if the user is not in the table."""
+        index = int(np.searchsorted(self.user_ids, user))
+        if index == len(self.user_ids) or self.user_ids[index] != user:
+            return None
+        start, end = self.indptr[index], self.indptr[index + 1]
+        return self.movie_ids[start:end], self.scores[start:end]
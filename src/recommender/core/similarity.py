@@ -0,0 +1,587 @@
+"""
+Engines computing the user neighbors based on their rating similarities.
+"""
+import heapq
+import logging
+import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+from recommender.utils.metrics import timer
+
+logger = logging.getLogger(__name__)
+
+
+class NeighborRetention:
+    """
+    Keeps the most similar neighbors of each user while the similarities are being calculated.
+
+    When `max_neighbors` is set every user gets a bounded min-heap, so the memory grows with the number of users
+    times `max_neighbors` instead of the number of user pairs. Ties are resolved in favour of the neighbor that
+    comes first in the ordering of the users (its `rank`), as done by the full sort.
+    """
+
+    def __init__(self,
+                 max_neighbors: Optional[int] = None,
+                 min_similarity: float = 0.0,
+                 min_overlap: int = 1):
+        """
+        Args:
+            max_neighbors (Optional[int]): Maximum number of neighbors kept per user. Keeps all of them if `None`.
+            min_similarity (float): Minimum similarity required for a pair of users to be neighbors.
+            min_overlap (int): Minimum number of common ratings required for a pair of users to be neighbors.
+        """
+        if max_neighbors is not None and max_neighbors < 1:
+            raise ValueError(f"`max_neighbors` must be a positive integer, but got {max_neighbors}")
+        self.max_neighbors: Optional[int] = max_neighbors
+        self.min_similarity: float = min_similarity
+        self.min_overlap: int = max(min_overlap, 1)
+        self._heaps: Dict[int, List[Tuple[float, int, int]]] = {}
+
+    def accepts(self, similarity: float, overlap: int) -> bool:
+        """Checks whether a pair of users with the given similarity and overlap qualifies as neighbors."""
+        return overlap >= self.min_overlap and similarity > 0 and similarity >= self.min_similarity
+
+    def push(self, user: int, neighbor: int, rank: int, similarity: float) -> None:
+        """
+        Offers a neighbor to a user, keeping it only if it is among the `max_neighbors` most similar ones.
+
+        Args:
+            user (int): The user ID.
+            neighbor (int): The neighbor user ID.
+            rank (int): The position of the neighbor in the ordering of the users, used to break ties.
+            similarity (float): The similarity between the user and the neighbor.
+        """
+        heap = self._heaps.setdefault(user, [])
+        entry = (similarity, -rank, neighbor)
+        if self.max_neighbors is None or len(heap) < self.max_neighbors:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def neighbors(self) -> Dict[int, List[Tuple[int, float]]]:
+        """Returns the retained neighbors of each user, sorted by descending similarity."""
+        return {user: [(neighbor, sim) for sim, _, neighbor in sorted(heap, reverse=True)]
+                for user, heap in self._heaps.items()}
+
+
+def _build_token_matrix(user_ratings: Dict[int, Dict[int, str]],
+                        min_rating_num: int = 5
+                        ) -> Tuple[List[int], sparse.csr_matrix]:
+    """
+    Encodes the `(movieId, polarity)` tokens of every eligible user as a sparse binary matrix.
+
+    Users with less than `min_rating_num` ratings are skipped. The order of the users follows the order
+    of `user_ratings`.
+
+    Args:
+        user_ratings (Dict[int, MovieRatings]): Ratings submitted by each user.
+        min_rating_num (int): Minimum number of ratings required for a comparison.
+
+    Returns:
+        A Tuple of:
+        - List[int]: The user IDs, one for each row of the matrix.
+        - sparse.csr_matrix: A (users x tokens) binary matrix, with a 1 for each token of the user.
+    """
+    users: List[int] = []
+    indptr: List[int] = [0]
+    indices: List[int] = []
+    vocabulary: Dict[Tuple[int, str], int] = {}
+
+    for user, ratings in user_ratings.items():
+        if len(ratings) < min_rating_num:
+            continue
+        users.append(user)
+        indices.extend(vocabulary.setdefault(token, len(vocabulary)) for token in ratings.items())
+        indptr.append(len(indices))
+
+    data = np.ones(len(indices), dtype=np.int32)
+    matrix = sparse.csr_matrix((data, np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+                               shape=(len(users), len(vocabulary)))
+    return users, matrix
+
+
+def sort_top_pairs(rows: np.ndarray,
+                   cols: np.ndarray,
+                   sims: np.ndarray,
+                   max_neighbors: Optional[int] = None
+                   ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sorts the `(row, col, similarity)` triples per row by descending similarity and keeps the first
+    `max_neighbors` of each row. Ties are resolved in favour of the smallest column.
+
+    Args:
+        rows (np.ndarray): The row of each triple, e.g. the index of a user.
+        cols (np.ndarray): The column of each triple, e.g. the index of a neighbor of the user.
+        sims (np.ndarray): The similarity of each triple.
+        max_neighbors (Optional[int]): Maximum number of triples kept per row. Keeps all of them if `None`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The rows, columns and similarities of the kept triples, sorted
+            by row and then by descending similarity.
+    """
+    order = np.lexsort((cols, -sims, rows))
+    rows, cols, sims = rows[order], cols[order], sims[order]
+    if max_neighbors is not None:
+        position = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+        keep = position < max_neighbors
+        rows, cols, sims = rows[keep], cols[keep], sims[keep]
+    return rows, cols, sims
+
+
+class _TopPairs:
+    """
+    Collects `(row, col, similarity)` triples in batches and keeps the `max_neighbors` most similar of each row.
+
+    The collected triples are merged whenever they exceed a few times the final size, to keep the memory bounded.
+    """
+
+    def __init__(self, num_rows: int, max_neighbors: Optional[int] = None):
+        self.max_neighbors: Optional[int] = max_neighbors
+        self.max_pending: Optional[int] = None if max_neighbors is None else 4 * num_rows * max_neighbors
+        self._triples: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._pending: int = 0
+
+    def add(self, rows: np.ndarray, cols: np.ndarray, sims: np.ndarray) -> None:
+        """Adds a batch of triples."""
+        self._triples.append((rows, cols, sims))
+        self._pending += len(rows)
+        if self.max_pending is not None and self._pending > self.max_pending:
+            self._triples = [self.result()]
+            self._pending = len(self._triples[0][0])
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the retained triples, sorted per row by descending similarity."""
+        if not self._triples:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return sort_top_pairs(*map(np.concatenate, zip(*self._triples)), self.max_neighbors)
+
+
+def _jaccard_block(tokens: sparse.csr_matrix,
+                   sizes: np.ndarray,
+                   row_block: Tuple[int, int],
+                   col_block: Tuple[int, int],
+                   max_neighbors: Optional[int] = None,
+                   min_similarity: float = 0.0,
+                   min_overlap: int = 1
+                   ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calculates the Jaccard coefficient between the users of two row blocks of the token matrix.
+
+    If the blocks are disjoint, the triples of the transposed block are returned as well, so that each pair of
+    blocks needs to be multiplied only once.
+
+    Returns:
+        The `(user, neighbor, similarity)` triples, as row indices of the token matrix, with at most
+        `max_neighbors` triples per user.
+    """
+    (row_start, row_end), (col_start, col_end) = row_block, col_block
+    inter = (tokens[row_start:row_end] @ tokens[col_start:col_end].T).tocoo()
+    rows = inter.row.astype(np.int64) + row_start
+    cols = inter.col.astype(np.int64) + col_start
+    common = inter.data
+    jacc = common / (sizes[rows] + sizes[cols] - common)
+
+    keep = (rows != cols) & (common >= max(min_overlap, 1)) & (jacc >= min_similarity)
+    rows, cols, jacc = rows[keep], cols[keep], jacc[keep]
+    if row_end <= col_start or col_end <= row_start:
+        rows, cols, jacc = np.concatenate((rows, cols)), np.concatenate((cols, rows)), np.concatenate((jacc, jacc))
+    return sort_top_pairs(rows, cols, jacc, max_neighbors)
+
+
+def pairs_to_neighbors(users: List[int],
+                       rows: np.ndarray,
+                       cols: np.ndarray,
+                       sims: np.ndarray,
+                       neighbors_u: Dict[int, List[Tuple[int, float]]]
+                       ) -> None:
+    """
+    Adds the sorted `(user, neighbor, similarity)` triples to the neighbors of each user.
+
+    Args:
+        users (List[int]): The user IDs, by index.
+        rows (np.ndarray): The index of the user of each triple, as sorted by `sort_top_pairs`.
+        cols (np.ndarray): The index of the neighbor of each triple.
+        sims (np.ndarray): The similarity of each triple.
+        neighbors_u (Dict[int, List[Tuple[int, float]]]): The neighbors of each user, updated in place with the
+            `(neighbor ID, similarity)` lists of the users of the triples.
+    """
+    with timer("neighbors_sort"):
+        users = np.asarray(users)
+        row_users, starts = np.unique(rows, return_index=True)
+        ends = np.append(starts[1:], len(rows))
+        neighbor_ids = users[cols].tolist()
+        sims = sims.tolist()
+        for row, start, end in zip(row_users.tolist(), starts.tolist(), ends.tolist()):
+            neighbors_u[users[row].item()] = list(zip(neighbor_ids[start:end], sims[start:end]))
+
+
+# token matrix shared with the worker processes of the parallel engine
+_worker_tokens: Optional[sparse.csr_matrix] = None
+
+
+def _init_worker(folder: str, shape: Tuple[int, int]) -> None:
+    """Attaches a worker process to the memory-mapped token matrix, which is shared read-only by all workers."""
+    global _worker_tokens
+    arrays = [np.load(Path(folder) / f"{name}.npy", mmap_mode='r') for name in ('data', 'indices', 'indptr')]
+    _worker_tokens = sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def _jaccard_block_worker(row_block: Tuple[int, int],
+                          col_block: Tuple[int, int],
+                          **options
+                          ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Calculates a pair of blocks in a worker process."""
+    sizes = np.diff(_worker_tokens.indptr)
+    return _jaccard_block(_worker_tokens, sizes, row_block, col_block, **options)
+
+
+def sparse_jaccard_neighbors(user_ratings: Dict[int, Dict[int, str]],
+                             min_rating_num: int = 5,
+                             max_neighbors: Optional[int] = None,
+                             min_similarity: float = 0.0,
+                             min_overlap: int = 1,
+                             block_size: int = 1024,
+                             n_jobs: int = 1
+                             ) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Compute the Jaccard coefficient between every two users with sparse matrix products.
+
+    The intersections of all pairs are given by the product of the token matrix with its transpose, while
+    the unions are derived from the number of tokens of each user. The product is calculated for `block_size`
+    users at a time and only the retained neighbors of each block are kept. The output is identical to the one of
+    `PreProcessor._get_user_neighbors`.
+
+    When `n_jobs` is not 1, the pairs of blocks are distributed to a pool of processes which read the token
+    matrix from memory-mapped files, and their top neighbors are merged at the end.
+
+    Args:
+        user_ratings (Dict[int, MovieRatings]): Ratings submitted by each user.
+        min_rating_num (int): Minimum number of ratings required for a comparison.
+        max_neighbors (Optional[int]): Maximum number of neighbors kept per user. Keeps all of them if `None`.
+        min_similarity (float): Minimum similarity required for a pair of users to be neighbors.
+        min_overlap (int): Minimum number of common ratings required for a pair of users to be neighbors.
+        block_size (int): Number of users multiplied with all the others at once.
+        n_jobs (int): Number of processes used. `-1` uses all the available cores.
+
+    Returns:
+        Dict[int, List[Tuple[int, float]]]: A dictionary mapping each user to a list of tuples containing neighbor
+            user IDs and their similarity scores.
+    """
+    logger.info("Calculating user Neighbors using the sparse engine")
+    users, tokens = _build_token_matrix(user_ratings, min_rating_num)
+    options = dict(max_neighbors=max_neighbors,
+                   min_similarity=min_similarity,
+                   min_overlap=min_overlap)
+    blocks = [(start, min(start + block_size, len(users))) for start in range(0, len(users), block_size)]
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+
+    neighbors_u: Dict[int, List[Tuple[int, float]]] = {}
+    if n_jobs == 1 or len(blocks) < 2:
+        # every block against all the users, so that the neighbors of a block are complete
+        sizes = np.diff(tokens.indptr)
+        for block in tqdm(blocks, desc="Calculating User Neighbors"):
+            rows, cols, sims = _jaccard_block(tokens, sizes, block, (0, len(users)), **options)
+            pairs_to_neighbors(users, rows, cols, sims, neighbors_u)
+        return neighbors_u
+
+    logger.info(f"Distributing {len(blocks)} user blocks to {n_jobs} processes")
+    block_pairs = [(row_block, col_block) for i, row_block in enumerate(blocks) for col_block in blocks[i:]]
+    top_pairs = _TopPairs(len(users), max_neighbors)
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name in ('data', 'indices', 'indptr'):
+            np.save(Path(folder) / f"{name}.npy", getattr(tokens, name))
+
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(folder, tokens.shape)) as executor:
+            futures = [executor.submit(_jaccard_block_worker, row_block, col_block, **options)
+                       for row_block, col_block in block_pairs]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Calculating User Neighbors"):
+                top_pairs.add(*future.result())
+
+    pairs_to_neighbors(users, *top_pairs.result(), neighbors_u)
+    return neighbors_u
+
+
+def item_jaccard_neighbors(ratings_indptr: np.ndarray,
+                           ratings_movies: np.ndarray,
+                           ratings_codes: np.ndarray,
+                           num_movies: int,
+                           max_neighbors: int = 50,
+                           min_similarity: float = 0.0,
+                           min_overlap: int = 2,
+                           block_size: int = 1024
+                           ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute the most similar movies of every movie with the Jaccard coefficient of their `(userId, polarity)`
+    tokens, i.e. how often the same users gave both movies the same polarity.
+
+    The similarities are sparse products of the (movies x tokens) matrix with its transpose, `block_size` movies
+    at a time, and only the `max_neighbors` most similar movies of each movie are kept, so the result is a pruned
+    item-item matrix. Ties are resolved in favour of the movie with the smallest index.
+
+    Args:
+        ratings_indptr (np.ndarray): The CSR row pointers of the ratings of each user, as in `ModelArrays`.
+        ratings_movies (np.ndarray): The movie index of each rating.
+        ratings_codes (np.ndarray): The polarity code of each rating.
+        num_movies (int): The number of movies.
+        max_neighbors (int): Maximum number of similar movies kept per movie.
+        min_similarity (float): Minimum similarity required for a pair of movies to be neighbors.
+        min_overlap (int): Minimum number of common tokens required for a pair of movies to be neighbors.
+        block_size (int): Number of movies multiplied with all the others at once.
+
+    Returns:
+        A Tuple of:
+        - np.ndarray: The int64 CSR row pointers of the similar movies of each movie.
+        - np.ndarray: The int32 indices of the similar movies, by descending similarity.
+        - np.ndarray: The float32 similarities.
+    """
+    logger.info("Calculating item Neighbors")
+    users = np.repeat(np.arange(len(ratings_indptr) - 1, dtype=np.int64), np.diff(ratings_indptr))
+    tokens = sparse.csr_matrix((np.ones(len(ratings_movies), dtype=np.int32),
+                                (ratings_movies, users * 3 + ratings_codes)),
+                               shape=(num_movies, 3 * (len(ratings_indptr) - 1)))
+    sizes = np.diff(tokens.indptr)
+
+    items: List[np.ndarray] = []
+    sims: List[np.ndarray] = []
+    counts = np.zeros(num_movies, dtype=np.int64)
+    for start in tqdm(range(0, num_movies, block_size), desc="Calculating Item Neighbors"):
+        block = (start, min(start + block_size, num_movies))
+        rows, cols, block_sims = _jaccard_block(tokens, sizes, block, (0, num_movies), max_neighbors,
+                                                min_similarity, min_overlap)
+        counts += np.bincount(rows, minlength=num_movies)
+        items.append(cols.astype(np.int32))
+        sims.append(block_sims.astype(np.float32))
+
+    indptr = np.zeros(num_movies + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(counts)
+    return (indptr, np.concatenate(items) if items else np.empty(0, dtype=np.int32),
+            np.concatenate(sims) if sims else np.empty(0, dtype=np.float32))
+
+
+# Mersenne prime used by the universal hash functions of MinHash
+_MINHASH_PRIME = (1 << 31) - 1
+
+
+def _minhash_signatures(tokens: sparse.csr_matrix,
+                        num_hashes: int,
+                        seed: int = 0
+                        ) -> np.ndarray:
+    """
+    Calculates the MinHash signature of each row of the token matrix.
+
+    Each of the `num_hashes` hash functions is a random universal hash `(a * token + b) mod p` and the signature
+    keeps the minimum hash value over the tokens of the user. Rows without any token get a unique signature, so
+    they never collide with any other row.
+
+    Returns:
+        np.ndarray: A (users x num_hashes) array with the signatures.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _MINHASH_PRIME, num_hashes, dtype=np.int64)
+    b = rng.integers(0, _MINHASH_PRIME, num_hashes, dtype=np.int64)
+
+    indices = tokens.indices.astype(np.int64)
+    sizes = np.diff(tokens.indptr)
+    non_empty = sizes > 0
+    starts = tokens.indptr[:-1][non_empty]
+
+    signatures = np.empty((tokens.shape[0], num_hashes), dtype=np.int64)
+    signatures[~non_empty] = _MINHASH_PRIME + np.flatnonzero(~non_empty)[:, None]
+
+    # hash a few functions at a time to keep the (ratings x hashes) intermediate array small
+    chunk = max(1, min(num_hashes, (1 << 25) // max(len(indices), 1)))
+    for start in range(0, num_hashes, chunk):
+        hashed = (indices[:, None] * a[start:start + chunk] + b[start:start + chunk]) % _MINHASH_PRIME
+        if len(starts):
+            signatures[non_empty, start:start + chunk] = np.minimum.reduceat(hashed, starts, axis=0)
+    return signatures
+
+
+def _lsh_candidates(signatures: np.ndarray, bands: int, rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Buckets the users by each band of their signatures and returns the distinct pairs of users that share
+    at least one bucket.
+
+    Returns:
+        The `(user, other user)` candidate pairs, as row indices with `user < other user`.
+    """
+    num_users = signatures.shape[0]
+    pair_keys: List[np.ndarray] = []
+    for band in range(bands):
+        _, bucket = np.unique(signatures[:, band * rows:(band + 1) * rows], axis=0, return_inverse=True)
+        bucket = bucket.ravel()
+        members = np.argsort(bucket, kind='stable')
+        sizes = np.bincount(bucket)
+        bounds = np.concatenate(([0], np.cumsum(sizes)))
+
+        for bucket_id in np.flatnonzero(sizes > 1).tolist():
+            users = members[bounds[bucket_id]:bounds[bucket_id + 1]]
+            first, second = np.triu_indices(len(users), k=1)
+            pair_keys.append(users[first].astype(np.int64) * num_users + users[second])
+
+    if not pair_keys:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    keys = np.unique(np.concatenate(pair_keys))
+    return keys // num_users, keys % num_users
+
+
+def minhash_jaccard_neighbors(user_ratings: Dict[int, Dict[int, str]],
+                              min_rating_num: int = 5,
+                              max_neighbors: Optional[int] = None,
+                              min_similarity: float = 0.0,
+                              min_overlap: int = 1,
+                              bands: int = 64,
+                              rows: int = 2,
+                              seed: int = 0,
+                              batch_size: int = 1 << 20
+                              ) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Approximate the neighbors of every user with MinHash signatures and banded Locality Sensitive Hashing.
+
+    The signature of each user is split in `bands` bands of `rows` hash values and two users become candidates
+    when they share all the values of at least one band. A pair with Jaccard coefficient `s` is a candidate with
+    probability `1 - (1 - s^rows)^bands`, so more bands raise the recall while more rows per band reduce the
+    candidates. The exact Jaccard coefficient is then calculated for the candidate pairs only, therefore the
+    similarities of the returned neighbors are exact, but some neighbors may be missed.
+
+    Args:
+        user_ratings (Dict[int, MovieRatings]): Ratings submitted by each user.
+        min_rating_num (int): Minimum number of ratings required for a comparison.
+        max_neighbors (Optional[int]): Maximum number of neighbors kept per user. Keeps all of them if `None`.
+        min_similarity (float): Minimum similarity required for a pair of users to be neighbors.
+        min_overlap (int): Minimum number of common ratings required for a pair of users to be neighbors.
+        bands (int): Number of bands of the signatures.
+        rows (int): Number of hash values in each band.
+        seed (int): Seed of the random hash functions.
+        batch_size (int): Number of candidate pairs verified at once.
+
+    Returns:
+        Dict[int, List[Tuple[int, float]]]: A dictionary mapping each user to a list of tuples containing neighbor
+            user IDs and their similarity scores.
+    """
+    logger.info(f"Calculating user Neighbors using MinHash LSH with {bands} bands of {rows} rows")
+    users, tokens = _build_token_matrix(user_ratings, min_rating_num)
+    sizes = np.diff(tokens.indptr)
+
+    signatures = _minhash_signatures(tokens, bands * rows, seed)
+    first, second = _lsh_candidates(signatures, bands, rows)
+    logger.info(f"Verifying {len(first)} candidate pairs of users")
+
+    # exact Jaccard coefficient of the candidate pairs
+    common = np.empty(len(first), dtype=np.int64)
+    for start in tqdm(range(0, len(first), batch_size), desc="Calculating User Neighbors"):
+        end = start + batch_size
+        common[start:end] = np.asarray(tokens[first[start:end]].multiply(tokens[second[start:end]]).sum(axis=1)).ravel()
+    jacc = common / (sizes[first] + sizes[second] - common)
+
+    keep = (common >= max(min_overlap, 1)) & (jacc >= min_similarity)
+    first, second, jacc = first[keep], second[keep], jacc[keep]
+    pair_rows, pair_cols, pair_sims = sort_top_pairs(np.concatenate((first, second)),
+                                                     np.concatenate((second, first)),
+                                                     np.concatenate((jacc, jacc)),
+                                                     max_neighbors)
+
+    neighbors_u: Dict[int, List[Tuple[int, float]]] = {}
+    pairs_to_neighbors(users, pair_rows, pair_cols, pair_sims, neighbors_u)
+    return neighbors_u
+
+
+def inverted_index_jaccard_neighbors(user_ratings: Dict[int, Dict[int, str]],
+                                     min_rating_num: int = 5,
+                                     max_neighbors: Optional[int] = None,
+                                     min_similarity: float = 0.0,
+                                     min_overlap: int = 1
+                                     ) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Compute the exact Jaccard coefficient only for the pairs of users sharing at least one token, found through an
+    inverted index from each `(movieId, polarity)` token to the users having it.
+
+    The users are processed by ascending number of tokens and probe the index with the tokens of the users
+    processed before them. Without `min_similarity`, the number of times each earlier user is met gives
+    the size of the intersection directly. With `min_similarity` set to `t`, the all-pairs similarity search
+    filters of the AllPairs algorithm apply:
+
+    - length bound: a user with `n` tokens can only match users having at least `ceil(t * n)` tokens, so the
+      smaller users are skipped at the front of every posting list.
+    - prefix filtering: with the tokens sorted from the rarest to the most frequent, two users with similarity
+      at least `t` share one of the first `n - ceil(t * n) + 1` tokens of each other, so only these prefixes are
+      indexed and probed, and the candidates found are verified exactly.
+
+    The work done is thus proportional to the actual overlaps between the users. The output is identical to the
+    one of `PreProcessor._get_user_neighbors`.
+
+    Args:
+        user_ratings (Dict[int, MovieRatings]): Ratings submitted by each user.
+        min_rating_num (int): Minimum number of ratings required for a comparison.
+        max_neighbors (Optional[int]): Maximum number of neighbors kept per user. Keeps all of them if `None`.
+        min_similarity (float): Minimum similarity required for a pair of users to be neighbors.
+        min_overlap (int): Minimum number of common ratings required for a pair of users to be neighbors.
+
+    Returns:
+        Dict[int, List[Tuple[int, float]]]: A dictionary mapping each user to a list of tuples containing neighbor
+            user IDs and their similarity scores.
+    """
+    logger.info("Calculating user Neighbors using the inverted index engine")
+    users, tokens = _build_token_matrix(user_ratings, min_rating_num)
+    sizes = np.diff(tokens.indptr)
+    min_overlap = max(min_overlap, 1)
+
+    # rename the tokens by ascending frequency, so that each sorted user starts with the rarest tokens
+    frequency = np.bincount(tokens.indices, minlength=tokens.shape[1])
+    token_rank = np.empty(tokens.shape[1], dtype=np.int64)
+    token_rank[np.argsort(frequency, kind='stable')] = np.arange(tokens.shape[1])
+    user_tokens = [np.sort(token_rank[tokens.indices[tokens.indptr[row]:tokens.indptr[row + 1]]])
+                   for row in range(len(users))]
+
+    postings: Dict[int, List[int]] = {}  # the users indexed under each token, by ascending size
+    posting_starts: Dict[int, int] = {}  # the first user of each posting list large enough for the probes
+    top_pairs = _TopPairs(len(users), max_neighbors)
+
+    for row in tqdm(np.argsort(sizes, kind='stable').tolist(), desc="Calculating User Neighbors"):
+        size = int(sizes[row])
+        if min_similarity > 0:
+            # the tolerance keeps the bound safe from rounding errors, e.g. 0.7 * 10 = 7.000000000000001
+            min_size = math.ceil(min_similarity * size - 1e-9)
+            prefix = user_tokens[row][:size - min_size + 1].tolist()
+        else:
+            min_size = 0
+            prefix = user_tokens[row].tolist()
+
+        probed: List[int] = []
+        for token in prefix:
+            posting = postings.setdefault(token, [])
+            start = posting_starts.get(token, 0)
+            while start < len(posting) and sizes[posting[start]] < min_size:
+                start += 1
+            posting_starts[token] = start
+            probed.extend(posting[start:])
+            posting.append(row)
+
+        if not probed:
+            continue
+        candidates, common = np.unique(np.asarray(probed, dtype=np.int64), return_counts=True)
+        if min_similarity > 0:
+            # the prefixes only reveal the candidates, so verify their whole intersection
+            common = np.asarray((tokens[candidates] @ tokens[row].T).todense()).ravel()
+        jacc = common / (size + sizes[candidates] - common)
+
+        keep = (common >= min_overlap) & (jacc >= min_similarity)
+        candidates, jacc = candidates[keep], jacc[keep]
+        rows = np.full(len(candidates), row, dtype=np.int64)
+        top_pairs.add(np.concatenate((rows, candidates)), np.concatenate((candidates, rows)),
+                      np.concatenate((jacc, jacc)))
+
+    neighbors_u: Dict[int, List[Tuple[int, float]]] = {}
+    pairs_to_neighbors(users, *top_pairs.result(), neighbors_u)
+    return neighbors_u
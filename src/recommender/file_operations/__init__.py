@@ -1,14 +1,36 @@
 """
 Module containing functions related to file operations (e.g. read write)
 """
+from recommender.file_operations.builders import (
+    build_model_arrays,
+    precompute_recommendations
+)
 from recommender.file_operations.readers import (
     DataHandler,
+    load_model,
+    load_model_arrays,
+    load_model_metadata,
+    load_movie_catalog,
+    load_precomputed_recommendations,
     pickle_object,
+    save_model_arrays,
     unpickle_object
 )
+from recommender.file_operations.store import (
+    ModelStore
+)
 
 __all__ = [
+    "build_model_arrays",
     "DataHandler",
+    "load_model",
+    "load_model_arrays",
+    "load_model_metadata",
+    "load_movie_catalog",
+    "load_precomputed_recommendations",
+    "ModelStore",
     "pickle_object",
+    "precompute_recommendations",
+    "save_model_arrays",
     "unpickle_object",
 ]
\ No newline at end of file
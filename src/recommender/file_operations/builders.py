@@ -0,0 +1,186 @@
+"""
+File containing the operations building the model files from the input data.
+"""
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from recommender.core.engine import PreProcessor, top_movies_batch
+from recommender.core.model import ModelArrays
+from recommender.file_operations.readers import (
+    DataHandler,
+    load_model,
+    save_model_arrays
+)
+
+logger = logging.getLogger(__name__)
+
+# columns of the precomputed recommendations
+RECOMMENDATIONS_SCHEMA = pa.schema([("userId", pa.int32()),
+                                    ("rank", pa.int16()),
+                                    ("movieId", pa.int32()),
+                                    ("score", pa.float32())])
+
+
+def build_model_arrays(input_folder: Path, model_folder: Path, **preprocessor_options: Any) -> Dict[str, int]:
+    """
+    Reads the ratings of a dataset, calculates the user neighbors, and the item neighbors and the embeddings if
+    enabled, and saves the model arrays together with the movie catalog of the dataset.
+
+    The function only exchanges paths and counts with its caller, so it can run in a separate process without
+    sending the model back: the caller memory-maps the saved arrays instead.
+
+    Args:
+        input_folder (Path): The folder with the `.csv` files of the dataset.
+        model_folder (Path): The folder where the model arrays will be saved.
+        **preprocessor_options (Any): The options of the `PreProcessor`.
+
+    Returns:
+        Dict[str, int]: The number of users with ratings and with neighbors.
+    """
+    logger.info(f"Building the model of {str(input_folder)} under {str(model_folder)}")
+    data_handler = DataHandler(input_folder=Path(input_folder))
+
+    preprocessor = PreProcessor(**preprocessor_options)
+    user_ratings, neighbors_u = preprocessor.preprocess(data_handler.iter_ratings())
+    model = ModelArrays.from_dicts(user_ratings, neighbors_u, preprocessor.polarity_weights)
+    model = preprocessor.add_factors(preprocessor.add_item_neighbors(model), data_handler.iter_ratings())
+    save_model_arrays(model, Path(model_folder), data_handler.movie_catalog)
+
+    return {"users": len(user_ratings), "users_with_neighbors": len(neighbors_u)}
+
+
+# model of a worker process, memory-mapped from the saved arrays, and its `model_id`
+_worker_model: Optional[ModelArrays] = None
+_worker_model_id: Optional[str] = None
+
+
+def _init_worker(model_folder: str) -> None:
+    """Attaches a worker process to the memory-mapped model, which is shared read-only by all workers."""
+    global _worker_model, _worker_model_id
+    _worker_model, metadata = load_model(Path(model_folder))
+    _worker_model_id = metadata.get("model_id")
+
+
+def _recommendations_chunk(users: np.ndarray,
+                           neighbor_num: int,
+                           rec_num: int,
+                           model: Optional[ModelArrays] = None,
+                           model_id: Optional[str] = None
+                           ) -> Dict[str, np.ndarray]:
+    """
+    Calculates the top-N recommendations of a chunk of users, as the columns of `RECOMMENDATIONS_SCHEMA`, with the
+    given model or the one of the worker process, which must have the given `model_id`.
+    """
+    if model is None:
+        if _worker_model_id != model_id:
+            error_msg = f"The model {model_id} was replaced by {_worker_model_id} before the worker loaded it"
+            logger.error(error_msg)
+            raise RuntimeError(error_msg)
+        model = _worker_model
+    columns: Dict[str, list] = {name: [] for name in RECOMMENDATIONS_SCHEMA.names}
+    for user, movie_ids, scores in top_movies_batch(users.tolist(), model, neighbor_num, rec_num):
+        columns["userId"].append(np.full(len(movie_ids), user))
+        columns["rank"].append(np.arange(1, len(movie_ids) + 1))
+        columns["movieId"].append(movie_ids)
+        columns["score"].append(np.round(scores, 3))
+    return {field.name: np.concatenate(columns[field.name] or [np.empty(0)]).astype(field.type.to_pandas_dtype())
+            for field in RECOMMENDATIONS_SCHEMA}
+
+
+def _ordered_results(executor: Executor,
+                     chunks: List[np.ndarray],
+                     window: int,
+                     *args: Any
+                     ) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Yields the recommendations of the chunks in their order, submitting at most `window` chunks ahead of the one
+    yielded, so that the results waiting for a slow chunk do not pile up in memory.
+    """
+    pending: Deque[Future] = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(_recommendations_chunk, chunk, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def precompute_recommendations(model_folder: Path,
+                               output_path: Path,
+                               users: Optional[Iterable[int]] = None,
+                               neighbor_num: int = 10,
+                               rec_num: int = 10,
+                               n_jobs: int = 1,
+                               chunk_size: int = 4096
+                               ) -> int:
+    """
+    Calculates the top-N recommendations of many users and writes them to a Parquet file, one row per
+    (user ID, rank, movie ID, score).
+
+    The users are split in chunks of `chunk_size`, which are scored by a pool of `n_jobs` processes sharing the
+    memory-mapped model. Each chunk is written as a row group as soon as it is ready, in the order of the users,
+    and at most `2 * n_jobs` chunks are submitted ahead of the one written, so only a few chunks are held in memory
+    at any time. The file is written next to `output_path` and renamed
+    once complete. The `model_id` of the model is stored in the file metadata, so that the API only serves the
+    table together with the model it was calculated from.
+
+    Args:
+        model_folder (Path): The folder of the model saved with `save_model_arrays`.
+        output_path (Path): The Parquet file where the recommendations will be written.
+        users (Optional[Iterable[int]]): The user IDs to calculate recommendations for. All the users of the
+            model if `None`.
+        neighbor_num (int): Number of most similar neighbors to consider.
+        rec_num (int): Number of recommendations to make per user.
+        n_jobs (int): Number of processes used. `-1` uses all the available cores.
+        chunk_size (int): Number of users per chunk.
+
+    Returns:
+        int: The number of rows written.
+
+    Raises:
+        RuntimeError: If the model is replaced before all the worker processes loaded it.
+    """
+    model_folder, output_path = Path(model_folder), Path(output_path)
+    model, model_metadata = load_model(model_folder)
+    users = model.user_ids if users is None else np.fromiter(users, dtype=np.int64)
+    chunks = [users[start:start + chunk_size] for start in range(0, len(users), chunk_size)]
+
+    metadata = {"model_id": model_metadata.get("model_id", ""),
+                "neighbor_num": neighbor_num,
+                "rec_num": rec_num}
+    schema = RECOMMENDATIONS_SCHEMA.with_metadata({"recommender": json.dumps(metadata)})
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    logger.info(f"Precomputing the recommendations of {len(users)} users in {len(chunks)} chunks with {n_jobs} "
+                f"processes")
+
+    tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+    tmp_path.parent.mkdir(parents=True, exist_ok=True)
+    rows = 0
+    with pq.ParquetWriter(tmp_path, schema) as writer, ExitStack() as stack:
+        if n_jobs == 1 or len(chunks) < 2:
+            results = (_recommendations_chunk(chunk, neighbor_num, rec_num, model) for chunk in chunks)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=n_jobs,
+                                                               initializer=_init_worker,
+                                                               initargs=(str(model_folder),)))
+            results = _ordered_results(executor, chunks, 2 * n_jobs, neighbor_num, rec_num, None,
+                                       metadata["model_id"])
+
+        for columns in results:
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            rows += len(columns["userId"])
+    tmp_path.replace(output_path)
+
+    logger.info(f"{rows} precomputed recommendations have been written to {str(output_path)}")
+    return rows
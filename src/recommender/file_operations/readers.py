@@ -1,26 +1,75 @@
 """
 File containing read operations.
 """
+import hashlib
+import json
 import logging
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import fields
 from functools import cached_property
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar
 import pickle
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from recommender.core.model import ModelArrays, MovieCatalog, PrecomputedRecommendations
+from recommender.utils.metrics import timer
+
 logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
+# number of times a model folder replaced while it is read is read again, see `_read_model_folder`
+_READ_ATTEMPTS = 5
+
 
 class DataHandler:
-    """Class to read the required data for the recommender."""
+    """
+    Class to read the required data for the recommender.
+
+    Only the columns used by the recommender are read, with compact dtypes: int32 IDs and float32 ratings.
+
+    The first time a `.csv` file is read, its columns are also written to a Parquet file in `cache_folder`, which
+    is read instead of parsing the `.csv` again. The cache is only used while the `.csv` file has the same size
+    and modification time it was written with, or the same content hash if only the modification time changed,
+    so it is transparently rebuilt when the source file changes.
+    """
+
+    # columns read from each file and their dtypes
+    movies_dtypes: Dict[str, Any] = {'movieId': np.int32, 'title': object, 'genres': object}
+    ratings_dtypes: Dict[str, Any] = {'userId': np.int32, 'movieId': np.int32, 'rating': np.float32}
 
     def __init__(self, input_folder: Path,
                  movies_file_name: str = 'movies.csv',
                  movies_index_col: Optional[str] = 'movieId',
                  ratings_file_name: str = 'ratings.csv',
-                 ratings_index_col: Optional[str] = None):
+                 ratings_index_col: Optional[str] = None,
+                 csv_engine: Optional[str] = None,
+                 cache_folder: Optional[Path] = None,
+                 use_cache: bool = True):
+        """
+        Args:
+            input_folder (Path): The folder with the `.csv` files.
+            movies_file_name (str): The name of the file with the movie details.
+            movies_index_col (Optional[str]): The column of the movies used as the index.
+            ratings_file_name (str): The name of the file with the ratings.
+            ratings_index_col (Optional[str]): The column of the ratings used as the index.
+            csv_engine (Optional[str]): The `pandas.read_csv` parser engine, e.g. `pyarrow` for a multithreaded
+                parser. The default pandas engine if `None`.
+            cache_folder (Optional[Path]): The folder of the Parquet cache of the `.csv` files. The `.cache`
+                subfolder of `input_folder` if `None`.
+            use_cache (bool): Whether to read and write the Parquet cache.
+        """
         # Validate that the file is indeed a
         self.input_folder: Path = input_folder
         assert isinstance(self.input_folder,
@@ -29,6 +78,9 @@ class DataHandler:
         self.movies_index_col: str = movies_index_col
         self.ratings_file_path: Path = self.input_folder / ratings_file_name
         self.ratings_index_col: str = ratings_index_col
+        self.csv_engine: Optional[str] = csv_engine
+        self.cache_folder: Path = self.input_folder / '.cache' if cache_folder is None else Path(cache_folder)
+        self.use_cache: bool = use_cache
 
         # verify that the files exist
         for file in [self.movies_file_path, self.ratings_file_path]:
@@ -42,15 +94,196 @@ class DataHandler:
             logger.exception(f"The required file was not found: {str(input_file)}.")
             raise FileNotFoundError(f"The required file was not found: {str(input_file)}.")
 
+    @staticmethod
+    def _read_options(dtypes: Dict[str, Any], index_col: Optional[str]) -> Dict[str, Any]:
+        """Returns the `pandas.read_csv` options reading only the given columns, and the index, with their dtypes."""
+        usecols = list(dtypes) if index_col is None or index_col in dtypes else [*dtypes, index_col]
+        return dict(usecols=usecols, dtype=dtypes, index_col=index_col)
+
+    @staticmethod
+    def _file_hash(input_file: Path) -> str:
+        """Returns the BLAKE2 hash of the content of a file."""
+        with open(input_file, 'rb') as f:
+            return hashlib.file_digest(f, 'blake2b').hexdigest()
+
+    def content_hash(self, input_file: Path) -> str:
+        """
+        Returns the content hash of one of the `.csv` files, taken from its cache if the file did not change since
+        it was cached, so that large files are not hashed on every start.
+        """
+        source_path = self._cache_paths(input_file)[1]
+        try:
+            with open(source_path) as f:
+                source = json.load(f)
+            stat = input_file.stat()
+            if (source.get("size"), source.get("mtime_ns")) == (stat.st_size, stat.st_mtime_ns) and "hash" in source:
+                return source["hash"]
+        except (OSError, ValueError):
+            pass
+        return self._file_hash(input_file)
+
+    def _cache_paths(self, input_file: Path) -> Tuple[Path, Path]:
+        """Returns the Parquet file caching the columns of a `.csv` file and the `.json` file describing its source."""
+        return self.cache_folder / f"{input_file.name}.parquet", self.cache_folder / f"{input_file.name}.json"
+
+    @staticmethod
+    def _cache_options(read_options: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns the read options a cache was written with, comparable to the ones stored in its `.json` file."""
+        return {"columns": {name: np.dtype(dtype).str for name, dtype in read_options["dtype"].items()},
+                "usecols": read_options["usecols"],
+                "index_col": read_options["index_col"]}
+
+    def _valid_cache(self, input_file: Path, read_options: Dict[str, Any]) -> Optional[Path]:
+        """Returns the Parquet cache of a `.csv` file if it was written from the current file with the same options."""
+        if not self.use_cache:
+            return None
+        cache_path, source_path = self._cache_paths(input_file)
+        try:
+            with open(source_path) as f:
+                source = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not cache_path.is_file() or source.get("read_options") != self._cache_options(read_options):
+            return None
+
+        stat = input_file.stat()
+        if source.get("size") != stat.st_size:
+            return None
+        if source.get("mtime_ns") != stat.st_mtime_ns:
+            # the file was touched or copied: it is only reused if its content did not change
+            if source.get("hash") != self._file_hash(input_file):
+                return None
+            source["mtime_ns"] = stat.st_mtime_ns
+            with open(source_path, 'w') as f:
+                json.dump(source, f)
+        return cache_path
+
+    @contextmanager
+    def _cache_writer(self, input_file: Path, read_options: Dict[str, Any]) -> Iterator[Callable[[pd.DataFrame], None]]:
+        """
+        Yields a function writing the chunks of a `.csv` file to its Parquet cache.
+
+        The cache is only kept if all the chunks are written: it is discarded if the reading is interrupted.
+        """
+        if not self.use_cache:
+            yield lambda chunk: None
+            return
+
+        cache_path, source_path = self._cache_paths(input_file)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+        preserve_index = read_options["index_col"] is not None
+        writer: Optional[pq.ParquetWriter] = None
+
+        def write(chunk: pd.DataFrame) -> None:
+            nonlocal writer
+            table = pa.Table.from_pandas(chunk, preserve_index=preserve_index)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            writer.write_table(table)
+
+        try:
+            self.cache_folder.mkdir(parents=True, exist_ok=True)
+            source_path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"The `.csv` files cannot be cached in {str(self.cache_folder)}: {e}")
+            yield lambda chunk: None
+            return
+
+        try:
+            yield write
+            if writer is not None:
+                writer.close()
+                tmp_path.replace(cache_path)
+                stat = input_file.stat()
+                with open(source_path, 'w') as f:
+                    json.dump({"size": stat.st_size,
+                               "mtime_ns": stat.st_mtime_ns,
+                               "hash": self._file_hash(input_file),
+                               "read_options": self._cache_options(read_options)}, f)
+                logger.info(f"Cached `{str(input_file)}` in {str(cache_path)}")
+        finally:
+            if writer is not None and tmp_path.exists():
+                writer.close()
+                tmp_path.unlink(missing_ok=True)
+
+    def _read_csv(self, input_file: Path, dtypes: Dict[str, Any], index_col: Optional[str]) -> pd.DataFrame:
+        """Reads the given columns of a `.csv` file, from its Parquet cache if it is still valid."""
+        read_options = self._read_options(dtypes, index_col)
+        with timer("csv_read"):
+            cache_path = self._valid_cache(input_file, read_options)
+            if cache_path is not None:
+                logger.info(f"Reading `{str(input_file)}` from the cache {str(cache_path)}")
+                return pq.read_table(cache_path).to_pandas()
+
+            frame = pd.read_csv(input_file, engine=self.csv_engine, **read_options)
+            with self._cache_writer(input_file, read_options) as write:
+                write(frame)
+            return frame
+
     @cached_property
     def movies_df(self) -> pd.DataFrame:
-        """Read and returns the `movie.csv` and `ratings.csv` in a pandas dataframe"""
-        return pd.read_csv(self.movies_file_path, index_col=self.movies_index_col)
+        """Read and returns the `movie.csv` in a pandas dataframe"""
+        return self._read_csv(self.movies_file_path, self.movies_dtypes, self.movies_index_col)
 
     @cached_property
     def ratings_df(self) -> pd.DataFrame:
-        """Read and returns the `movie.csv` and `ratings.csv` in a pandas dataframe"""
-        return pd.read_csv(self.ratings_file_path, index_col=self.ratings_index_col)
+        """Read and returns the `ratings.csv` in a pandas dataframe"""
+        return self._read_csv(self.ratings_file_path, self.ratings_dtypes, self.ratings_index_col)
+
+    def iter_ratings(self, chunk_size: int = 1_000_000) -> Iterator[pd.DataFrame]:
+        """
+        Reads the `ratings.csv` in chunks, so that it can be processed without holding the whole dataframe.
+
+        Args:
+            chunk_size (int): The number of rows per chunk. With the `pyarrow` engine, the chunks are blocks of
+                roughly this many rows, depending on the width of the lines.
+
+        Yields:
+            pd.DataFrame: The consecutive chunks of the ratings.
+        """
+        read_options = self._read_options(self.ratings_dtypes, self.ratings_index_col)
+        cache_path = self._valid_cache(self.ratings_file_path, read_options)
+        if cache_path is not None:
+            logger.info(f"Reading `{str(self.ratings_file_path)}` from the cache {str(cache_path)}")
+            parquet_file = pq.ParquetFile(cache_path)
+            for batch in parquet_file.iter_batches(batch_size=chunk_size):
+                yield pa.Table.from_batches([batch], schema=parquet_file.schema_arrow).to_pandas()
+            return
+
+        with self._cache_writer(self.ratings_file_path, read_options) as write:
+            for chunk in self._iter_csv_ratings(chunk_size, read_options):
+                write(chunk)
+                yield chunk
+
+    def _iter_csv_ratings(self, chunk_size: int, read_options: Dict[str, Any]) -> Iterator[pd.DataFrame]:
+        """Parses the `ratings.csv` in chunks."""
+        if self.csv_engine == 'pyarrow':
+            # pandas does not read in chunks with pyarrow, so stream the record batches of its csv reader
+            convert_options = pv.ConvertOptions(include_columns=read_options["usecols"],
+                                                column_types={name: pa.from_numpy_dtype(dtype)
+                                                              for name, dtype in read_options["dtype"].items()})
+            block_options = pv.ReadOptions(block_size=max(chunk_size * 32, 1 << 16))
+            for batch in pv.open_csv(self.ratings_file_path, read_options=block_options,
+                                     convert_options=convert_options):
+                chunk = batch.to_pandas()
+                yield chunk if read_options["index_col"] is None else chunk.set_index(read_options["index_col"])
+            return
+
+        yield from pd.read_csv(self.ratings_file_path, chunksize=chunk_size, **read_options)
+
+    def release_frames(self) -> None:
+        """
+        Drops the cached movies and ratings dataframes, e.g. once the model is built, so that a long-running process
+        does not keep them in memory. They are read again if accessed later. The `movie_catalog` is kept.
+        """
+        for name in ('movies_df', 'ratings_df'):
+            self.__dict__.pop(name, None)
+        logger.info("Released the cached movies and ratings dataframes")
+
+    @cached_property
+    def movie_catalog(self) -> MovieCatalog:
+        """Returns the movie details as an array-backed catalog, for fast lookups while recommending."""
+        return MovieCatalog.from_frame(self.movies_df)
 
 
 def pickle_object(obj: Any, filename: Path) -> None:
@@ -73,7 +306,7 @@ def pickle_object(obj: Any, filename: Path) -> None:
         # create the parent directory
         filename.parent.mkdir(exist_ok=True)
 
-        with open(filename, 'wb') as f:
+        with open(filename, 'wb') as f, timer("pickle"):
             pickle.dump(obj, f)
         logger.info(f"Object has been pickled and saved to {str(filename)}")
     except Exception as e:
@@ -95,10 +328,227 @@ def unpickle_object(filename: Path) -> Any:
     """
     try:
         filename = Path(filename)
-        with open(filename, 'rb') as f:
+        with open(filename, 'rb') as f, timer("unpickle"):
             obj = pickle.load(f)
         logger.info(f"Object has been unpickled from {str(filename)}")
         return obj
-    except FileNotFoundError:
+    except FileNotFoundError as e:
         logger.error(f"Error while unpickling object: {e}")
         raise FileNotFoundError
+
+
+def save_model_arrays(model: ModelArrays, folder: Path, movie_catalog: Optional[MovieCatalog] = None) -> None:
+    """
+    Save the arrays of a model as `.npy` files in a folder, so that they can be memory-mapped when loaded.
+
+    The arrays are first written to a temporary sibling folder. The previous model is then renamed aside, the new
+    one renamed into place and only then the previous one deleted, so `folder` is never partially written or
+    deleted, and is only missing between two renames. The loaders of this module read again a model replaced
+    while they read it. Every saved model gets a new `model_id` in its metadata, which identifies the files
+    derived from it.
+
+    Args:
+        model (ModelArrays): The model to save.
+        folder (Path): The folder where the arrays will be saved.
+        movie_catalog (Optional[MovieCatalog]): The movies of the dataset, saved in the `catalog` subfolder to be
+            memory-mapped with `load_movie_catalog`. The titles and genres are saved as fixed-width strings.
+
+    Returns:
+        None: This function does not return a value.
+    """
+    folder = Path(folder)
+    tmp_folder = folder.with_name(f"{folder.name}.tmp")
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tmp_folder.mkdir(parents=True)
+
+    with timer("model_save"):
+        for name in ModelArrays.array_names():
+            np.save(tmp_folder / f"{name}.npy", np.ascontiguousarray(getattr(model, name)))
+        if movie_catalog is not None:
+            (tmp_folder / "catalog").mkdir()
+            for catalog_field in fields(MovieCatalog):
+                array = getattr(movie_catalog, catalog_field.name)
+                np.save(tmp_folder / "catalog" / f"{catalog_field.name}.npy",
+                        array.astype(str) if array.dtype == object else np.ascontiguousarray(array))
+    with open(tmp_folder / "metadata.json", 'w') as f:
+        json.dump({"model_id": uuid.uuid4().hex,
+                   "users": len(model.user_ids),
+                   "movies": len(model.movie_ids),
+                   "ratings": int(model.ratings_indptr[-1]),
+                   "neighbors": int(model.neighbors_indptr[-1]),
+                   "item_neighbors": len(model.item_neighbors_items),
+                   "factors": model.item_factors.shape[1] if model.has_factors else 0}, f)
+
+    # processes still reading the memory-mapped arrays of the previous model keep them until they are done
+    old_folder = folder.with_name(f"{folder.name}.old")
+    shutil.rmtree(old_folder, ignore_errors=True)
+    if folder.exists():
+        folder.rename(old_folder)
+    tmp_folder.rename(folder)
+    shutil.rmtree(old_folder, ignore_errors=True)
+    logger.info(f"Model arrays have been saved to {str(folder)}")
+
+
+def _model_id(folder: Path) -> str:
+    """Returns the `model_id` of the model saved in a folder, raising a FileNotFoundError if there is none."""
+    with open(folder / "metadata.json") as f:
+        return json.load(f)["model_id"]
+
+
+def _read_model_folder(folder: Path, read: Callable[[Path], T]) -> T:
+    """
+    Reads a model folder with `read`, and reads it again if `save_model_arrays` replaced it meanwhile, so that all
+    the files read belong to the same model. A folder missing while it is replaced is waited for briefly.
+
+    Raises:
+        FileNotFoundError: If the folder still misses the files read after all the attempts.
+        RuntimeError: If the folder keeps being replaced while it is read.
+    """
+    for attempt in range(_READ_ATTEMPTS):
+        try:
+            model_id = _model_id(folder)
+            result = read(folder)
+            if _model_id(folder) == model_id:
+                return result
+        except FileNotFoundError as e:
+            if attempt == _READ_ATTEMPTS - 1:
+                logger.error(str(e))
+                raise
+        time.sleep(0.01 * 2 ** attempt)
+    error_msg = f"The model in {str(folder)} kept being replaced while it was read"
+    logger.error(error_msg)
+    raise RuntimeError(error_msg)
+
+
+def load_model_arrays(folder: Path, mmap_mode: Optional[str] = 'r') -> ModelArrays:
+    """
+    Load the arrays of a model saved with `save_model_arrays`.
+
+    By default the arrays are memory-mapped read-only, so loading is almost instant, only the pages used are
+    read from the disk and they are shared by all the processes using the same model. A model replaced by
+    `save_model_arrays` while it is loaded is loaded again, so the arrays always belong to the same model.
+
+    Args:
+        folder (Path): The folder where the arrays are saved.
+        mmap_mode (Optional[str]): The `numpy.load` memory-map mode. `None` reads the arrays in memory.
+
+    Returns:
+        ModelArrays: The loaded model.
+
+    Raises:
+        FileNotFoundError: If the folder does not contain a saved model.
+        RuntimeError: If the model keeps being replaced while it is loaded.
+    """
+    return load_model(folder, mmap_mode)[0]
+
+
+def load_model(folder: Path, mmap_mode: Optional[str] = 'r') -> Tuple[ModelArrays, Dict[str, Any]]:
+    """
+    Load the arrays of a model saved with `save_model_arrays` together with its metadata, see `load_model_arrays`.
+    Both are read from the same save of the model, so the `model_id` of the metadata identifies the arrays even if
+    the model is replaced meanwhile.
+
+    Args:
+        folder (Path): The folder where the arrays are saved.
+        mmap_mode (Optional[str]): The `numpy.load` memory-map mode. `None` reads the arrays in memory.
+
+    Returns:
+        A Tuple of:
+        - ModelArrays: The loaded model.
+        - Dict[str, Any]: Its metadata, as returned by `load_model_metadata`.
+
+    Raises:
+        FileNotFoundError: If the folder does not contain a saved model.
+        RuntimeError: If the model keeps being replaced while it is loaded.
+    """
+    def read(folder: Path) -> Tuple[ModelArrays, Dict[str, Any]]:
+        if not (folder / "metadata.json").is_file():
+            raise FileNotFoundError(f"No model arrays found in {str(folder)}")
+        with open(folder / "metadata.json") as f:
+            metadata = json.load(f)
+        # the optional arrays missing from models saved by older versions take their defaults
+        optional = ModelArrays.optional_array_names()
+        model = ModelArrays(**{name: np.load(folder / f"{name}.npy", mmap_mode=mmap_mode)
+                               for name in ModelArrays.array_names()
+                               if name not in optional or (folder / f"{name}.npy").is_file()})
+        return model, metadata
+
+    folder = Path(folder)
+    with timer("model_load"):
+        model, metadata = _read_model_folder(folder, read)
+    logger.info(f"Model arrays have been loaded from {str(folder)}")
+    return model, metadata
+
+
+def load_movie_catalog(folder: Path, mmap_mode: Optional[str] = 'r') -> MovieCatalog:
+    """
+    Load the movie catalog saved with a model by `save_model_arrays`.
+
+    By default its arrays are memory-mapped read-only, as the ones of the model, so all the processes serving the
+    same model share a single copy of the movie details.
+
+    Args:
+        folder (Path): The folder of the model.
+        mmap_mode (Optional[str]): The `numpy.load` memory-map mode. `None` reads the arrays in memory.
+
+    Returns:
+        MovieCatalog: The loaded catalog.
+
+    Raises:
+        FileNotFoundError: If the model was saved without its catalog.
+        RuntimeError: If the model keeps being replaced while it is loaded.
+    """
+    def read(folder: Path) -> MovieCatalog:
+        if not (folder / "catalog").is_dir():
+            raise FileNotFoundError(f"No movie catalog found in {str(folder)}")
+        return MovieCatalog(**{catalog_field.name: np.load(folder / "catalog" / f"{catalog_field.name}.npy",
+                                                           mmap_mode=mmap_mode)
+                               for catalog_field in fields(MovieCatalog)})
+
+    folder = Path(folder)
+    with timer("model_load"):
+        catalog = _read_model_folder(folder, read)
+    logger.info(f"Movie catalog has been loaded from {str(folder)}")
+    return catalog
+
+
+def load_model_metadata(folder: Path) -> Dict[str, Any]:
+    """
+    Load the metadata of a model saved with `save_model_arrays`, e.g. its `model_id` and number of users.
+
+    Raises:
+        FileNotFoundError: If the folder does not contain a saved model.
+    """
+    metadata_path = Path(folder) / "metadata.json"
+    if not metadata_path.is_file():
+        logger.error(f"No model arrays found in {str(folder)}")
+        raise FileNotFoundError(f"No model arrays found in {str(folder)}")
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+def load_precomputed_recommendations(path: Path) -> PrecomputedRecommendations:
+    """
+    Load the recommendations precomputed with `precompute_recommendations` from a Parquet file.
+
+    Args:
+        path (Path): The Parquet file of the recommendations.
+
+    Returns:
+        PrecomputedRecommendations: The recommendations, ready for lookups.
+
+    Raises:
+        FileNotFoundError: If the file does not exist.
+    """
+    path = Path(path)
+    if not path.is_file():
+        logger.error(f"No precomputed recommendations found in {str(path)}")
+        raise FileNotFoundError(f"No precomputed recommendations found in {str(path)}")
+
+    table = pq.read_table(path)
+    metadata = json.loads(table.schema.metadata[b"recommender"])
+    recommendations = PrecomputedRecommendations.from_columns(
+        *(table.column(name).to_numpy() for name in ("userId", "rank", "movieId", "score")), **metadata)
+    logger.info(f"Precomputed recommendations of {len(recommendations.user_ids)} users have been loaded from "
+                f"{str(path)}")
+    return recommendations
@@ -0,0 +1,180 @@
+"""
+File containing the store of the built models, keyed by the data and options they were built from.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterable, Iterator, List, Optional
+
+from recommender.core.engine import PreProcessor
+from recommender.file_operations.builders import build_model_arrays
+from recommender.file_operations.readers import DataHandler
+
+logger = logging.getLogger(__name__)
+
+# version of the layout of the saved models, part of the fingerprints so that older models are never reused
+MODEL_FORMAT_VERSION: int = 2
+
+
+class ModelStore:
+    """
+    Stores each built model in a folder named after the fingerprint of its ratings file and preprocessing options.
+
+    A model is only built when no model with the same fingerprint exists, so switching between datasets or options
+    reuses the models built before instead of serving a model of another dataset or recalculating it. The
+    modification time of each folder records when the model was last used, and only the `max_models` most
+    recently used models are kept.
+
+    Named pointers of the store, e.g. to the latest model of a chain of rating deltas, point to one of its models,
+    which is then never evicted.
+
+    The store can be shared by several processes, e.g. the workers of the API: the models are built under an
+    exclusive lock of the store, so the processes missing the same model wait for the first one to build it, and
+    then memory-map the same files.
+    """
+
+    def __init__(self, root: Path = Path("./data/models/store"), max_models: Optional[int] = 5):
+        """
+        Args:
+            root (Path): The folder of the stored models.
+            max_models (Optional[int]): Maximum number of models kept. Keeps all of them if `None`.
+        """
+        if max_models is not None and max_models < 1:
+            raise ValueError(f"`max_models` must be a positive integer, but got {max_models}")
+        self.root: Path = Path(root)
+        self.max_models: Optional[int] = max_models
+
+    def fingerprint(self, input_folder: Path, *extra: Any, **preprocessor_options: Any) -> str:
+        """
+        Returns the fingerprint of the model built from a dataset with the given options.
+
+        Args:
+            input_folder (Path): The folder with the `.csv` files of the dataset.
+            *extra (Any): Any other JSON serializable inputs of the model, e.g. the hash of a file of new ratings.
+            **preprocessor_options (Any): The options of the `PreProcessor`. Missing options take their defaults.
+
+        Returns:
+            str: The hexadecimal fingerprint.
+        """
+        data_handler = DataHandler(input_folder=Path(input_folder))
+        key = {"format": MODEL_FORMAT_VERSION,
+               "ratings": data_handler.content_hash(data_handler.ratings_file_path),
+               "movies": data_handler.content_hash(data_handler.movies_file_path),
+               "options": PreProcessor(**preprocessor_options).model_options(),
+               "extra": list(extra)}
+        return hashlib.blake2b(json.dumps(key, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def model_folder(self, fingerprint: str) -> Path:
+        """Returns the folder of the model with the given fingerprint."""
+        return self.root / fingerprint
+
+    def lookup(self, fingerprint: str) -> Optional[Path]:
+        """Returns the folder of the model with the given fingerprint, marking it as used, or `None` if missing."""
+        folder = self.model_folder(fingerprint)
+        if not (folder / "metadata.json").is_file():
+            return None
+        os.utime(folder)
+        logger.info(f"Found the model {fingerprint} in the store")
+        return folder
+
+    def get_or_build(self, input_folder: Path, force: bool = False, **preprocessor_options: Any) -> Path:
+        """
+        Returns the folder of the model of a dataset with the given options, building it only if it is missing.
+
+        Args:
+            input_folder (Path): The folder with the `.csv` files of the dataset.
+            force (bool): Whether to build the model even if it exists.
+            **preprocessor_options (Any): The options of the `PreProcessor`.
+
+        Returns:
+            Path: The folder of the model, to be loaded with `load_model_arrays`.
+        """
+        fingerprint = self.fingerprint(input_folder, **preprocessor_options)
+        folder = None if force else self.lookup(fingerprint)
+        if folder is None:
+            with self.build_lock():
+                # another process may have built the model while this one was waiting for the lock
+                folder = None if force else self.lookup(fingerprint)
+                if folder is None:
+                    logger.warning(f"Building the model {fingerprint} of {str(input_folder)}")
+                    folder = self.model_folder(fingerprint)
+                    build_model_arrays(input_folder, folder, **preprocessor_options)
+                    self.evict(keep=[folder])
+        return folder
+
+    def _pointer_path(self, name: str) -> Path:
+        """Returns the file of a named pointer of the store."""
+        return self.root / "pointers" / name
+
+    def current(self, name: str) -> Optional[Path]:
+        """
+        Returns the folder of the model a named pointer points to, or `None` if the pointer or its model are missing.
+        It is cheap enough to be polled, e.g. by the processes serving the model a pointer points to.
+        """
+        try:
+            fingerprint = self._pointer_path(name).read_text().strip()
+        except FileNotFoundError:
+            return None
+        folder = self.model_folder(fingerprint)
+        return folder if (folder / "metadata.json").is_file() else None
+
+    def set_current(self, name: str, folder: Path) -> None:
+        """
+        Points a named pointer to a model folder of the store. The pointer is replaced atomically, so the processes
+        reading it see either the previous model or the new one.
+        """
+        path = self._pointer_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{name}.{os.getpid()}.tmp")
+        tmp_path.write_text(Path(folder).name)
+        os.replace(tmp_path, path)
+        logger.info(f"Pointed {name} to the model {Path(folder).name}")
+
+    def _pointed_folders(self) -> List[Path]:
+        """Returns the model folders the named pointers point to."""
+        pointers = self.root / "pointers"
+        if not pointers.is_dir():
+            return []
+        return [self.model_folder(path.read_text().strip()) for path in pointers.iterdir() if not path.suffix]
+
+    @contextmanager
+    def build_lock(self) -> Iterator[None]:
+        """Holds an exclusive lock of the store, shared by all the processes using the same `root`."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        descriptor = os.open(self.root, os.O_RDONLY)
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(descriptor)  # also releases the lock
+
+    def evict(self, keep: Iterable[Path] = ()) -> List[Path]:
+        """
+        Removes the least recently used models beyond `max_models`.
+
+        Args:
+            keep (Iterable[Path]): Model folders never removed, e.g. the ones in use. The models of the named
+                pointers are never removed either.
+
+        Returns:
+            List[Path]: The removed model folders.
+        """
+        if self.max_models is None or not self.root.is_dir():
+            return []
+        keep = {Path(folder).resolve() for folder in [*keep, *self._pointed_folders()]}
+        # the `.tmp` and `.old` folders of the models being saved are left to `save_model_arrays`
+        models = sorted((folder for folder in self.root.iterdir()
+                         if not folder.suffix and (folder / "metadata.json").is_file()),
+                        key=lambda folder: folder.stat().st_mtime_ns, reverse=True)
+
+        evicted = [folder for folder in models[self.max_models:] if folder.resolve() not in keep]
+        for folder in evicted:
+            # processes still reading the memory-mapped arrays of the model keep them until they are done
+            shutil.rmtree(folder, ignore_errors=True)
+            logger.info(f"Evicted the model {folder.name} from the store")
+        return evicted
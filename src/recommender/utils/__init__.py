@@ -1,6 +1,10 @@
 """
 Utils folder for the recommender system app.
 """
+from recommender.utils.cache import (
+    LRUCache
+)
+
 from recommender.utils.input_args import (
     RecArgumentParser,
     InputArguments,
@@ -10,8 +14,23 @@ from recommender.utils.logger_config import (
     setup_logging
 )
 
+from recommender.utils.metrics import (
+    MetricsRegistry,
+    metrics,
+    timer
+)
+
+from recommender.utils.synthetic import (
+    generate_ratings
+)
+
 __all__ = [
+    "generate_ratings",
+    "LRUCache",
+    "metrics",
+    "MetricsRegistry",
     "RecArgumentParser",
     "InputArguments",
     "setup_logging",
+    "timer",
 ]
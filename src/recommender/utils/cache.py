@@ -0,0 +1,72 @@
+"""
+Thread-safe LRU cache with optional expiry, e.g. for recommendations keyed by model version.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """
+    Thread-safe Least Recently Used cache whose entries also expire after a Time To Live.
+
+    The cache holds at most `max_size` entries, evicting the least recently used one when full, and counts its
+    hits and misses.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: Optional[float] = 600.0,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            max_size (int): Maximum number of entries kept.
+            ttl (Optional[float]): Seconds after which an entry expires. Entries never expire if `None`.
+            clock (Callable[[], float]): The function returning the current time in seconds.
+        """
+        if max_size < 1:
+            raise ValueError(f"`max_size` must be a positive integer, but got {max_size}")
+        self.max_size: int = max_size
+        self.ttl: Optional[float] = ttl
+        self.clock: Callable[[], float] = clock
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Returns the value cached under `key`, or `None` if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and self.clock() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Caches `value` under `key`, evicting the least recently used entry if the cache is full."""
+        with self._lock:
+            self._entries[key] = (self.clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Removes all the entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the size of the cache and its hit and miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries),
+                    "max_size": self.max_size,
+                    "ttl": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
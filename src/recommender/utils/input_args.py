@@ -31,6 +31,64 @@ class RecArgumentParser:
                                       'files exist',
                                  required=False,
                                  default=False)
+        self.parser.add_argument('--neighbor-engine', '-e',
+                                 type=str,
+                                 choices=['pairwise', 'sparse', 'minhash', 'inverted'],
+                                 help='Engine used to calculate the user neighbors.',
+                                 required=False,
+                                 default='pairwise')
+        self.parser.add_argument('--similarity', '-s',
+                                 type=str,
+                                 choices=['jaccard', 'cosine', 'adjusted_cosine', 'pearson', 'weighted_jaccard'],
+                                 help='Similarity metric of the users. The metrics other than `jaccard` compare the '
+                                      'raw ratings with matrix products, whatever the engine.',
+                                 required=False,
+                                 default='jaccard')
+        self.parser.add_argument('--item-neighbors',
+                                 type=int,
+                                 help='Number of similar movies stored for each movie, to recommend movies similar '
+                                      'to the ones rated by the user instead of the ones of the user neighbors. '
+                                      'Disabled if 0.',
+                                 required=False,
+                                 default=0)
+        self.parser.add_argument('--factors',
+                                 type=int,
+                                 help='Dimension of the user and movie embeddings of a matrix factorization of the '
+                                      'ratings, to recommend the movies with the best predicted ratings instead. '
+                                      'Disabled if 0.',
+                                 required=False,
+                                 default=0)
+        self.parser.add_argument('--max-neighbors', '-k',
+                                 type=int,
+                                 help='Maximum number of neighbors stored for each user. Stores all of them if '
+                                      'not provided.',
+                                 required=False,
+                                 default=None)
+        self.parser.add_argument('--n-jobs', '-j',
+                                 type=int,
+                                 help='Number of processes used by the `sparse` engine and the precomputation. '
+                                      '-1 uses all the cores.',
+                                 required=False,
+                                 default=1)
+        self.parser.add_argument('--ratings-delta',
+                                 type=str,
+                                 help='Path of a `.csv` file with new or changed ratings. Only the neighbors affected '
+                                      'by them are recalculated. Each delta is applied on top of the ones applied '
+                                      'before to the same data and options.',
+                                 required=False,
+                                 default=None)
+        self.parser.add_argument('--precompute', '-p',
+                                 type=str,
+                                 help='Path of a `.parquet` file where the recommendations of all the users are '
+                                      'precomputed, instead of recommending movies to a single user.',
+                                 required=False,
+                                 default=None)
+        self.parser.add_argument('--users-file',
+                                 type=str,
+                                 help='Path of a text file with one user ID per line, to precompute the '
+                                      'recommendations of these users only.',
+                                 required=False,
+                                 default=None)
         return self.parser.parse_args()
 
 
@@ -40,6 +98,15 @@ class InputArguments:
     neighbors_num: int
     recommendations_num: int
     force_calculate: bool
+    neighbor_engine: str = 'pairwise'
+    similarity: str = 'jaccard'
+    item_neighbors: int = 0
+    factors: int = 0
+    max_neighbors: Optional[int] = None
+    n_jobs: int = 1
+    ratings_delta: Optional[str] = None
+    precompute: Optional[str] = None
+    users_file: Optional[str] = None
 
     def __post_init__(self):
         """Convert data_path to a Path object."""
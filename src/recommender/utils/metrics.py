@@ -0,0 +1,173 @@
+"""
+Stage timing metrics for the recommender, exposed in the Prometheus text format.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import ContextManager, Dict, List, Sequence, Tuple
+
+# upper bounds, in seconds, of the buckets of the stage durations: from sub-millisecond request phases up to
+# preprocessing stages of several minutes
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                                      0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_DISABLED_TIMER = nullcontext()
+
+
+class _Histogram:
+    """The count per bucket (not cumulative), sum and count of the observed durations of one stage."""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, num_buckets: int):
+        self.counts: List[int] = [0] * (num_buckets + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+
+class _StageTimer:
+    """Context manager observing the duration of its block as a stage of a `MetricsRegistry`."""
+    __slots__ = ('registry', 'stage', 'start')
+
+    def __init__(self, registry: 'MetricsRegistry', stage: str):
+        self.registry = registry
+        self.stage = stage
+
+    def __enter__(self) -> '_StageTimer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.registry.observe(self.stage, time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    """
+    Records the durations of the stages of the pipeline and of the requests, plus counters and gauges, and renders
+    them in the Prometheus text format.
+
+    The durations are kept as one histogram per stage, `recsys_stage_duration_seconds{stage="..."}`. While the
+    registry is disabled, `timer` returns a shared no-op context manager and nothing is recorded, so the
+    instrumented code only pays for a method call.
+    """
+
+    def __init__(self, enabled: bool = False, buckets: Sequence[float] = DEFAULT_BUCKETS, prefix: str = 'recsys'):
+        """
+        Args:
+            enabled (bool): Whether to record the metrics.
+            buckets (Sequence[float]): The sorted upper bounds of the buckets of the durations, in seconds.
+            prefix (str): The prefix of the names of the metrics.
+        """
+        self.enabled: bool = enabled
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+        self.prefix: str = prefix
+        self._histograms: Dict[str, _Histogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._gauges: Dict[str, Tuple[float, str]] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def timer(self, stage: str) -> ContextManager:
+        """Returns a context manager recording the duration of its block as `stage`."""
+        if not self.enabled:
+            return _DISABLED_TIMER
+        return _StageTimer(self, stage)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """Records a duration of a stage."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = _Histogram(len(self.buckets))
+            histogram.counts[bisect_left(self.buckets, seconds)] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def increment(self, name: str, value: float = 1.0, help_text: str = '', **labels: str) -> None:
+        """Adds `value` to the counter `name` with the given labels."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+            if help_text:
+                self._help[name] = help_text
+
+    def set_gauge(self, name: str, value: float, help_text: str = '') -> None:
+        """Sets the value of the gauge `name`."""
+        with self._lock:
+            self._gauges[name] = (value, help_text)
+
+    def reset(self) -> None:
+        """Removes all the recorded metrics."""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+    def stage_summary(self) -> Dict[str, Dict[str, float]]:
+        """Returns the number of observations and the total duration of each stage."""
+        with self._lock:
+            return {stage: {"count": histogram.count, "seconds": histogram.sum}
+                    for stage, histogram in self._histograms.items()}
+
+    def render(self) -> str:
+        """Returns all the metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            name = f"{self.prefix}_stage_duration_seconds"
+            if self._histograms:
+                lines += [f"# HELP {name} Duration of the stages of the pipeline and of the requests.",
+                          f"# TYPE {name} histogram"]
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip((*map(_format_value, self.buckets), '+Inf'), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{_escape(stage)}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{_escape(stage)}"}} {_format_value(histogram.sum)}')
+                lines.append(f'{name}_count{{stage="{_escape(stage)}"}} {histogram.count}')
+
+            counter_names = sorted({counter for counter, _ in self._counters})
+            for counter in counter_names:
+                full_name = f"{self.prefix}_{counter}"
+                if counter in self._help:
+                    lines.append(f"# HELP {full_name} {self._help[counter]}")
+                lines.append(f"# TYPE {full_name} counter")
+                for (other, labels), value in sorted(self._counters.items()):
+                    if other == counter:
+                        lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+
+            for gauge, (value, help_text) in sorted(self._gauges.items()):
+                full_name = f"{self.prefix}_{gauge}"
+                if help_text:
+                    lines.append(f"# HELP {full_name} {help_text}")
+                lines += [f"# TYPE {full_name} gauge", f"{full_name} {_format_value(value)}"]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    """Escapes a label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    """Formats the labels of a sample, e.g. `{endpoint="recommendations"}`."""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    """Formats a sample value, without a trailing `.0` for integers."""
+    return repr(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# the metrics of the process, disabled until an application enables them
+metrics = MetricsRegistry(enabled=False)
+
+
+def timer(stage: str) -> ContextManager:
+    """Returns a context manager recording the duration of its block as `stage` in the process `metrics`."""
+    return metrics.timer(stage)
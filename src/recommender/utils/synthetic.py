@@ -0,0 +1,66 @@
+"""
+Synthetic MovieLens-shaped datasets, e.g. to benchmark the recommender at sizes beyond the sample data.
+"""
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def generate_ratings(num_users: int,
+                     num_movies: int,
+                     ratings_per_user: int = 100,
+                     skew: float = 1.0,
+                     seed: int = 0
+                     ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Generates random ratings with the shape of the MovieLens datasets.
+
+    - The number of ratings of each user follows a log-normal distribution with mean `ratings_per_user`, with at
+      least 5 ratings per user.
+    - The rated movies follow a Zipf distribution with exponent `skew`, so that a few movies get most of the
+      ratings. `0` rates all the movies equally often.
+    - The ratings are half stars from 0.5 to 5.0, around a per movie and per user bias.
+
+    A user never rates a movie twice, so with a strong skew the users with many ratings can get fewer of them
+    than drawn.
+
+    Args:
+        num_users (int): Number of users.
+        num_movies (int): Number of movies.
+        ratings_per_user (int): Mean number of ratings per user.
+        skew (float): The exponent of the popularity of the movies.
+        seed (int): The seed of the random generator.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: The ratings, with the columns 'userId', 'movieId', 'rating' and
+            'timestamp', and the movies, with the movie IDs as the index and the columns 'title' and 'genres'.
+    """
+    rng = np.random.default_rng(seed)
+
+    sigma = 0.8
+    counts = rng.lognormal(np.log(ratings_per_user) - sigma ** 2 / 2, sigma, size=num_users)
+    counts = np.clip(counts.round().astype(np.int64), 5, num_movies)
+
+    # popular movies are scattered over the IDs, as in MovieLens. Twice the needed movies are drawn for each user,
+    # and the first distinct ones are kept, since popular movies are drawn several times
+    popularity = 1.0 / np.arange(1, num_movies + 1) ** skew
+    movie_ids = rng.permutation(num_movies).astype(np.int32) + 1
+    users = np.repeat(np.arange(1, num_users + 1, dtype=np.int32), 2 * counts)
+    movies = movie_ids[rng.choice(num_movies, size=len(users), p=popularity / popularity.sum())]
+    drawn = pd.DataFrame({'userId': users, 'movieId': movies}).drop_duplicates()
+    drawn = drawn[drawn.groupby('userId').cumcount().to_numpy() < counts[drawn['userId'].to_numpy() - 1]]
+    users, movies = drawn['userId'].to_numpy(), drawn['movieId'].to_numpy()
+
+    movie_bias = rng.normal(0.0, 0.5, size=num_movies + 1)
+    user_bias = rng.normal(0.0, 0.4, size=num_users + 1)
+    ratings = 3.5 + movie_bias[movies] + user_bias[users] + rng.normal(0.0, 0.8, size=len(users))
+    ratings = np.clip(np.round(ratings * 2) / 2, 0.5, 5.0).astype(np.float32)
+
+    ratings_df = pd.DataFrame({'userId': users, 'movieId': movies, 'rating': ratings,
+                               'timestamp': rng.integers(828124615, 1537799250, size=len(users))})
+
+    movies_df = pd.DataFrame({'movieId': np.arange(1, num_movies + 1, dtype=np.int32),
+                              'title': [f'Movie {movie}' for movie in range(1, num_movies + 1)],
+                              'genres': 'Drama'}).set_index('movieId')
+    return ratings_df, movies_df
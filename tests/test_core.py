@@ -1,11 +1,26 @@
 """
 Generated using ChatGPT
 """
+import numpy as np
 import pytest
 import pandas as pd
 
 
-from recommender.core import PreProcessor, recommend_ub
+from recommender.core import (
+    IncrementalNeighbors,
+    ModelArrays,
+    MovieCatalog,
+    PreProcessor,
+    recommend_ib,
+    recommend_mf,
+    recommend_ub,
+    recommend_ub_arrays,
+    recommend_ub_batch
+)
+from recommender.core.factorization import als_factorize
+from recommender.core.kernels import build_rating_matrix
+from recommender.core.model import POLARITIES
+from recommender.core.similarity import item_jaccard_neighbors, sparse_jaccard_neighbors
 
 
 @pytest.fixture
@@ -34,6 +49,17 @@ def test_discretize_rating():
     assert preprocessor.discretize_rating(2.5) == 'N'  # Negative
 
 
+def test_discretize_ratings():
+    """Test that the vectorized discretizer gives the polarity codes of `discretize_rating`."""
+    preprocessor = PreProcessor()
+    ratings = np.arange(0.5, 5.5, 0.5, dtype=np.float32)
+
+    codes = preprocessor.discretize_ratings(ratings)
+    assert codes.dtype == np.int8
+    assert [POLARITIES[code] for code in codes.tolist()] == [preprocessor.discretize_rating(r) for r in ratings]
+    assert np.array_equal(preprocessor.rating_codes(ratings, 'discretize_rating'), codes)
+
+
 def test_load_user_ratings(sample_ratings_df, preprocessor):
     """Test the _load_user_ratings method."""
     user_ratings = preprocessor._load_user_ratings(sample_ratings_df)
@@ -46,6 +72,35 @@ def test_load_user_ratings(sample_ratings_df, preprocessor):
     assert user_ratings[1][102] == 'N'  # Rating 2.0 -> 'N'
 
 
+def per_user_ratings(ratings_df, preprocessor):
+    """The ratings of each user, loaded one user at a time as `_load_user_ratings` originally did."""
+    user_ratings = {}
+    for user in set(ratings_df['userId']):
+        my_ratings = ratings_df[ratings_df['userId'] == user][['movieId', 'rating']]
+        user_ratings[user] = dict(zip(my_ratings['movieId'], my_ratings['rating'].apply(preprocessor.discretize_rating)))
+    return user_ratings
+
+
+@pytest.mark.parametrize("discretize_func", ['discretize_ratings', 'discretize_rating'])
+@pytest.mark.parametrize("chunk_size", [None, 800, 113])
+def test_load_user_ratings_matches_per_user(discretize_func, chunk_size):
+    """Test that the vectorized loading matches the per-user one, in full or in chunks, with duplicate ratings."""
+    rng = np.random.default_rng(7)
+    ratings_df = pd.DataFrame({'userId': rng.integers(1, 30, 800),
+                               'movieId': rng.integers(1, 40, 800),
+                               'rating': rng.choice(np.arange(0.5, 5.5, 0.5), 800)})
+    assert ratings_df.duplicated(['userId', 'movieId']).any()
+    expected = per_user_ratings(ratings_df, PreProcessor())
+
+    chunks = ratings_df if chunk_size is None else \
+        (ratings_df.iloc[start:start + chunk_size] for start in range(0, len(ratings_df), chunk_size))
+    user_ratings = PreProcessor(discretize_func=discretize_func)._load_user_ratings(chunks)
+
+    assert user_ratings == expected
+    # the movies of each user keep the order of their first rating, with the polarity of their last one
+    assert all(list(user_ratings[user].items()) == list(ratings.items()) for user, ratings in expected.items())
+
+
 def test_get_user_neighbors(sample_ratings_df, preprocessor):
     """Test the _get_user_neighbors method."""
     user_ratings = preprocessor._load_user_ratings(sample_ratings_df)
@@ -59,6 +114,193 @@ def test_get_user_neighbors(sample_ratings_df, preprocessor):
     assert len(neighbors[1]) > 0  # Should have neighbors based on Jaccard similarity
 
 
+@pytest.fixture
+def random_ratings_df():
+    """Fixture to create a larger, random ratings DataFrame."""
+    rng = np.random.default_rng(42)
+    pairs = {(int(u), int(m)) for u, m in zip(rng.integers(1, 40, 600), rng.integers(1, 60, 600))}
+    users, movies = zip(*sorted(pairs))
+    ratings = rng.choice(np.arange(0.5, 5.5, 0.5), len(users))
+    return pd.DataFrame({'userId': users, 'movieId': movies, 'rating': ratings})
+
+
+@pytest.fixture
+def random_movies_df(random_ratings_df):
+    """Fixture to create the details of the movies of the random ratings, with movie IDs as the index."""
+    movie_ids = np.unique(random_ratings_df['movieId'])
+    return pd.DataFrame({'movieId': movie_ids,
+                         'title': [f'Movie {i}' for i in movie_ids],
+                         'genres': 'Drama'}).set_index('movieId')
+
+
+@pytest.fixture
+def catalog(random_movies_df):
+    """Fixture to create the catalog of the movies of the random ratings."""
+    return MovieCatalog.from_frame(random_movies_df)
+
+
+@pytest.mark.parametrize("engine", ['sparse', 'inverted'])
+def test_exact_engines_match_pairwise(random_ratings_df, engine):
+    """Test that the exact engines return exactly the same neighbors as the pairwise one."""
+    preprocessor = PreProcessor(min_rating_num=5)
+    user_ratings = preprocessor._load_user_ratings(random_ratings_df)
+
+    expected = PreProcessor._get_user_neighbors(user_ratings, 5)
+    neighbors = PreProcessor(min_rating_num=5, neighbor_engine=engine).get_user_neighbors(user_ratings)
+
+    assert neighbors == expected
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        dict(max_neighbors=3),
+        dict(min_similarity=0.1),
+        dict(min_similarity=0.25),
+        dict(min_overlap=3),
+        dict(max_neighbors=2, min_similarity=0.05, min_overlap=2),
+    ]
+)
+def test_neighbor_retention(random_ratings_df, options):
+    """Test that the pruned neighbors are the head of the full neighbor lists, for every engine."""
+    user_ratings = PreProcessor()._load_user_ratings(random_ratings_df)
+    full = PreProcessor._get_user_neighbors(user_ratings, 5)
+
+    pruned = PreProcessor(min_rating_num=5, **options).get_user_neighbors(user_ratings)
+    for engine in ('sparse', 'inverted'):
+        engine_pruned = PreProcessor(min_rating_num=5, neighbor_engine=engine, **options).get_user_neighbors(user_ratings)
+        assert pruned == engine_pruned
+
+    for user, neighbors in pruned.items():
+        expected = [(neighbor, sim) for neighbor, sim in full[user]
+                    if sim >= options.get('min_similarity', 0.0)
+                    and len(set(user_ratings[user].items()) & set(user_ratings[neighbor].items()))
+                    >= options.get('min_overlap', 1)]
+        assert neighbors == expected[:options.get('max_neighbors')]
+
+
+@pytest.mark.parametrize("max_neighbors", [None, 3])
+def test_parallel_sparse_engine(random_ratings_df, max_neighbors):
+    """Test that splitting the users in blocks, serially or over a process pool, gives the same neighbors."""
+    user_ratings = PreProcessor()._load_user_ratings(random_ratings_df)
+
+    expected = PreProcessor._get_user_neighbors(user_ratings, 5, max_neighbors=max_neighbors)
+    neighbors = sparse_jaccard_neighbors(user_ratings, 5, max_neighbors=max_neighbors, block_size=7, n_jobs=2)
+
+    assert neighbors == expected
+    assert sparse_jaccard_neighbors(user_ratings, 5, max_neighbors=max_neighbors, block_size=7) == expected
+
+
+def test_minhash_engine(random_ratings_df):
+    """Test that the approximate engine returns a subset of the exact neighbors, with their exact similarity."""
+    user_ratings = PreProcessor()._load_user_ratings(random_ratings_df)
+    user_ratings[1000] = dict(user_ratings[1])  # an identical user is always found
+    expected = PreProcessor._get_user_neighbors(user_ratings, 5)
+
+    neighbors = PreProcessor(min_rating_num=5, neighbor_engine='minhash',
+                             lsh_bands=16, lsh_rows=2).get_user_neighbors(user_ratings)
+
+    assert neighbors[1000][0] == (1, 1.0)
+    for user, user_neighbors in neighbors.items():
+        exact = dict(expected[user])
+        assert all(exact[neighbor] == sim for neighbor, sim in user_neighbors)
+        assert [sim for _, sim in user_neighbors] == sorted((sim for _, sim in user_neighbors), reverse=True)
+
+
+@pytest.mark.parametrize("options", [dict(), dict(max_neighbors=3, min_similarity=0.05, min_overlap=2)])
+def test_incremental_neighbors(random_ratings_df, options):
+    """Test that applying a delta of ratings gives the same neighbors as recalculating them from scratch."""
+    preprocessor = PreProcessor(min_rating_num=5, **options)
+    user_ratings = preprocessor._load_user_ratings(random_ratings_df)
+    state = preprocessor.incremental_neighbors(user_ratings)
+    assert isinstance(state, IncrementalNeighbors)
+    assert state.neighbors_u == PreProcessor._get_user_neighbors(user_ratings, 5, **options)
+
+    delta_df = pd.DataFrame({
+        'userId': [1, 1, 2, 7, 50, 50, 50, 50, 50],
+        'movieId': [1, 2, 3, 4, 1, 2, 3, 4, 5],
+        'rating': [5.0, 1.0, 3.0, 0.5, 5.0, 1.0, 3.0, 0.5, 4.0]  # changed and new ratings, and a new user
+    })
+    affected = state.apply_delta(preprocessor._load_user_ratings(delta_df))
+
+    updated_ratings = {user: dict(ratings) for user, ratings in user_ratings.items()}
+    for user, movie, rating in delta_df.itertuples(index=False):
+        updated_ratings.setdefault(user, {})[movie] = preprocessor.discretize_rating(rating)
+    assert state.user_ratings == updated_ratings
+    assert state.neighbors_u == PreProcessor._get_user_neighbors(updated_ratings, 5, **options)
+    assert {1, 2, 7, 50} <= affected
+
+    # single changed ratings, moving a user within the neighbors of the others
+    rng = np.random.default_rng(0)
+    for user, movie, rating in zip(rng.choice(list(updated_ratings), 10), rng.integers(1, 20, 10),
+                                   rng.choice([0.5, 3.0, 5.0], 10)):
+        state.apply_delta({int(user): {int(movie): preprocessor.discretize_rating(rating)}})
+        updated_ratings[int(user)][int(movie)] = preprocessor.discretize_rating(rating)
+        assert state.neighbors_u == PreProcessor._get_user_neighbors(updated_ratings, 5, **options)
+
+
+def test_unknown_neighbor_engine():
+    """Test that an unsupported engine is rejected."""
+    with pytest.raises(ValueError):
+        PreProcessor(neighbor_engine='unknown')
+
+
+def _pair_similarity(a, b, metric, movie_means):
+    """The similarity of two `{movieId: rating}` dictionaries, calculated one movie at a time."""
+    common = sorted(set(a) & set(b))
+    if metric == 'cosine':
+        return sum(a[m] * b[m] for m in common) / np.sqrt(sum(x * x for x in a.values()) *
+                                                         sum(x * x for x in b.values()))
+    if metric == 'adjusted_cosine':
+        norm_a = np.sqrt(sum((x - movie_means[m]) ** 2 for m, x in a.items()))
+        norm_b = np.sqrt(sum((x - movie_means[m]) ** 2 for m, x in b.items()))
+        dot = sum((a[m] - movie_means[m]) * (b[m] - movie_means[m]) for m in common)
+        return dot / (norm_a * norm_b) if norm_a and norm_b else 0.0
+    if metric == 'pearson':
+        x, y = np.array([a[m] for m in common]), np.array([b[m] for m in common])
+        return np.corrcoef(x, y)[0, 1] if len(common) > 1 and x.std() and y.std() else 0.0
+    movies = set(a) | set(b)
+    return (sum(min(a.get(m, 0), b.get(m, 0)) for m in movies) /
+            sum(max(a.get(m, 0), b.get(m, 0)) for m in movies))
+
+
+@pytest.mark.parametrize("metric", ['cosine', 'adjusted_cosine', 'pearson', 'weighted_jaccard'])
+def test_similarity_kernels(random_ratings_df, metric):
+    """Test that the matrix kernels match the similarities calculated pair by pair over the raw ratings."""
+    ratings = {user: dict(zip(group['movieId'], group['rating']))
+               for user, group in random_ratings_df.groupby('userId')}
+    movie_means = random_ratings_df.groupby('movieId')['rating'].mean().to_dict()
+    preprocessor = PreProcessor(min_rating_num=5, similarity=metric, min_overlap=2)
+    _, neighbors_u = preprocessor.preprocess(random_ratings_df)
+
+    expected = {}
+    for user in ratings:
+        for other in ratings:
+            if user == other or len(ratings[user]) < 5 or len(ratings[other]) < 5 or \
+                    len(set(ratings[user]) & set(ratings[other])) < 2:
+                continue
+            similarity = _pair_similarity(ratings[user], ratings[other], metric, movie_means)
+            if similarity > 1e-9:
+                expected[(user, other)] = similarity
+    found = {(user, other): sim for user, neighbors in neighbors_u.items() for other, sim in neighbors}
+    assert found.keys() == expected.keys()
+    assert np.allclose([found[pair] for pair in expected], list(expected.values()))
+    for neighbors in neighbors_u.values():
+        assert neighbors == sorted(neighbors, key=lambda neighbor: (-neighbor[1], neighbor[0]))
+
+    top = PreProcessor(min_rating_num=5, similarity=metric, min_overlap=2, max_neighbors=3).preprocess(
+        random_ratings_df)[1]
+    assert top == {user: neighbors[:3] for user, neighbors in neighbors_u.items()}
+
+
+def test_unknown_similarity():
+    """Test that an unsupported similarity is rejected, and is not maintained incrementally."""
+    with pytest.raises(ValueError):
+        PreProcessor(similarity='unknown')
+    with pytest.raises(ValueError):
+        PreProcessor(similarity='cosine').incremental_neighbors({})
+
+
 def test_preprocess(sample_ratings_df, preprocessor):
     """Test the full preprocess method."""
     user_ratings, neighbors_u = preprocessor.preprocess(sample_ratings_df)
@@ -100,6 +342,253 @@ def test_recommend_ub(sample_ratings_df):
     assert recommendations[1]['movieId'] == 104  # Movie C
 
 
+def test_model_arrays_views(random_ratings_df):
+    """Test that the array-backed model gives back the ratings and neighbors it was built from."""
+    user_ratings, neighbors_u = PreProcessor(neighbor_engine='sparse').preprocess(random_ratings_df)
+    model = ModelArrays.from_dicts(user_ratings, neighbors_u)
+
+    assert model.ratings_codes.dtype == np.int8
+    assert model.neighbors_sims.dtype == np.float32
+    assert dict(model.user_ratings) == user_ratings
+    assert set(model.neighbors_u) == set(neighbors_u)
+    for user, neighbors in neighbors_u.items():
+        assert [n for n, _ in model.neighbors_u[user]] == [n for n, _ in neighbors]
+        assert np.allclose([s for _, s in model.neighbors_u[user]], [s for _, s in neighbors])
+    assert model.neighbors_u.get(-1, []) == []
+
+
+@pytest.mark.parametrize("neighbor_num", [1, 5, 100])
+def test_recommend_ub_arrays(random_ratings_df, random_movies_df, neighbor_num):
+    """
+    Test that the vectorized recommendations match `recommend_ub` up to the float32 similarities, which can change
+    the last rounded decimal of a score, and the order of the tied movies.
+    """
+    model = ModelArrays.from_dicts(*PreProcessor(neighbor_engine='sparse').preprocess(random_ratings_df))
+
+    for user in [1, 7, 20, 39]:
+        expected = recommend_ub(user, random_movies_df, model.neighbors_u, model.user_ratings, neighbor_num, rec_num=100)
+        expected_scores = {r['movieId']: r['recommendedScore'] for r in expected}
+        recommendations = recommend_ub_arrays(user, random_movies_df, model, neighbor_num, rec_num=100)
+        assert {r['movieId'] for r in recommendations} == set(expected_scores)
+        for r in recommendations:
+            assert r['recommendedScore'] == pytest.approx(expected_scores[r['movieId']], abs=1.001e-3)
+
+        top = recommend_ub_arrays(user, MovieCatalog.from_frame(random_movies_df), model, neighbor_num, rec_num=3)
+        assert [r['recommendedScore'] for r in top] == \
+               pytest.approx([r['recommendedScore'] for r in expected[:3]], abs=1.001e-3)
+
+    assert recommend_ub_arrays(-1, random_movies_df, model, neighbor_num, rec_num=3) == []
+
+
+def test_polarity_weights(random_ratings_df, catalog):
+    """Test that the configured polarity weights are used by all the scoring paths."""
+    preprocessor = PreProcessor(neighbor_engine='sparse', polarity_weights={'A': 0.5})
+    assert preprocessor.polarity_weights.tolist() == [-2.0, 0.5, 2.0]
+    model = ModelArrays.from_dicts(*preprocessor.preprocess(random_ratings_df), preprocessor.polarity_weights)
+
+    for user in [1, 7, 20]:
+        expected = recommend_ub(user, catalog, model.neighbors_u, model.user_ratings, 5, rec_num=100,
+                                polarity_weights=preprocessor.polarity_weights)
+        recommendations = recommend_ub_arrays(user, catalog, model, 5, rec_num=100)
+        assert sorted((r['movieId'], r['recommendedScore']) for r in recommendations) == \
+               sorted((r['movieId'], r['recommendedScore']) for r in expected)
+        (_, batch), = recommend_ub_batch([user], catalog, model, neighbor_num=5, rec_num=100)
+        assert [r['recommendedScore'] for r in batch] == [r['recommendedScore'] for r in recommendations]
+
+    with pytest.raises(ValueError):
+        PreProcessor(polarity_weights={'X': 1.0})
+
+
+def test_item_jaccard_neighbors(random_ratings_df):
+    """Test that the item neighbors match the Jaccard coefficients of the (user, polarity) tokens of the movies."""
+    model = ModelArrays.from_dicts(*PreProcessor(neighbor_engine='sparse').preprocess(random_ratings_df))
+    users = np.repeat(np.arange(len(model.user_ids)), np.diff(model.ratings_indptr))
+    tokens = [set() for _ in model.movie_ids]
+    for user, movie, code in zip(users, model.ratings_movies, model.ratings_codes):
+        tokens[movie].add((user, code))
+
+    indptr, items, sims = item_jaccard_neighbors(model.ratings_indptr, model.ratings_movies, model.ratings_codes,
+                                                 len(model.movie_ids), max_neighbors=4, min_overlap=2, block_size=7)
+    for movie, movie_tokens in enumerate(tokens):
+        expected = sorted(((other, len(movie_tokens & other_tokens) / len(movie_tokens | other_tokens))
+                           for other, other_tokens in enumerate(tokens)
+                           if other != movie and len(movie_tokens & other_tokens) >= 2),
+                          key=lambda neighbor: (-neighbor[1], neighbor[0]))[:4]
+        assert items[indptr[movie]:indptr[movie + 1]].tolist() == [other for other, _ in expected]
+        assert np.allclose(sims[indptr[movie]:indptr[movie + 1]], [sim for _, sim in expected])
+
+
+@pytest.mark.parametrize("neighbor_num", [1, 3, 100])
+def test_recommend_ib(random_ratings_df, catalog, neighbor_num):
+    """Test the item-based recommendations against the scores summed over the similar movies of each rating."""
+    preprocessor = PreProcessor(neighbor_engine='sparse', item_neighbors=20)
+    model = ModelArrays.from_dicts(*preprocessor.preprocess(random_ratings_df))
+    with pytest.raises(ValueError):
+        recommend_ib(1, catalog, model, neighbor_num, rec_num=10)
+    model = preprocessor.add_item_neighbors(model)
+    assert model.has_item_neighbors
+
+    for user in [1, 7, 20, 39]:
+        index = model.user_index(user)
+        start, end = model.ratings_indptr[index], model.ratings_indptr[index + 1]
+        scores = {}
+        for movie, code in zip(model.ratings_movies[start:end], model.ratings_codes[start:end]):
+            first = model.item_neighbors_indptr[movie]
+            last = min(model.item_neighbors_indptr[movie + 1], first + neighbor_num)
+            for other, sim in zip(model.item_neighbors_items[first:last], model.item_neighbors_sims[first:last]):
+                scores[other] = scores.get(other, 0.0) + model.polarity_weights[code] * sim
+        expected = sorted(((model.movie_ids[other], round(score, 3)) for other, score in scores.items()
+                           if other not in set(model.ratings_movies[start:end])))
+
+        recommendations = recommend_ib(user, catalog, model, neighbor_num, rec_num=1000)
+        assert sorted((r['movieId'], r['recommendedScore']) for r in recommendations) == expected
+        scores = [r['recommendedScore'] for r in recommendations]
+        assert scores == sorted(scores, reverse=True)
+        assert recommend_ib(user, catalog, model, neighbor_num, rec_num=3) == recommendations[:3]
+
+    assert recommend_ib(-1, catalog, model, neighbor_num, rec_num=3) == []
+
+
+def test_als_factorize(random_ratings_df):
+    """Test that the item factors solve their regularized least squares, and fit the ratings better than biases."""
+    _, ratings = build_rating_matrix(random_ratings_df['userId'].to_numpy(), random_ratings_df['movieId'].to_numpy(),
+                                     random_ratings_df['rating'].to_numpy(), min_rating_num=1)
+    user_factors, item_factors, item_biases = als_factorize(ratings, factors=4, iterations=5, regularization=0.1)
+    assert user_factors.dtype == item_factors.dtype == item_biases.dtype == np.float32
+    assert user_factors.shape == (ratings.shape[0], 4) and item_factors.shape == (ratings.shape[1], 4)
+
+    by_movie = ratings.T.tocsr()
+    for movie in range(ratings.shape[1]):
+        users = by_movie.indices[by_movie.indptr[movie]:by_movie.indptr[movie + 1]]
+        residuals = by_movie.data[by_movie.indptr[movie]:by_movie.indptr[movie + 1]] - item_biases[movie]
+        factors = user_factors[users].astype(np.float64)
+        expected = np.linalg.solve(factors.T @ factors + 0.1 * len(users) * np.eye(4), factors.T @ residuals)
+        assert np.allclose(item_factors[movie], expected, atol=1e-4)
+
+    rows = np.repeat(np.arange(ratings.shape[0]), np.diff(ratings.indptr))
+    predictions = item_biases[ratings.indices] + np.sum(user_factors[rows] * item_factors[ratings.indices], axis=1)
+    assert np.mean((predictions - ratings.data) ** 2) < np.mean((item_biases[ratings.indices] - ratings.data) ** 2)
+
+
+def test_recommend_mf(random_ratings_df, catalog):
+    """Test that the factorization recommendations are the unrated movies with the best predicted ratings."""
+    preprocessor = PreProcessor(neighbor_engine='sparse', factors=4, als_iterations=3)
+    model = ModelArrays.from_dicts(*preprocessor.preprocess(random_ratings_df))
+    with pytest.raises(ValueError):
+        recommend_mf(1, catalog, model, neighbor_num=10, rec_num=10)
+    model = preprocessor.add_factors(model, random_ratings_df)
+    assert model.has_factors
+
+    for user in [1, 7, 20, 39]:
+        index = model.user_index(user)
+        rated = set(model.ratings_movies[model.ratings_indptr[index]:model.ratings_indptr[index + 1]].tolist())
+        scores = model.item_factors @ model.user_factors[index] + model.item_biases
+        expected = sorted((movie for movie in range(len(model.movie_ids)) if movie not in rated),
+                          key=lambda movie: (-scores[movie], movie))[:5]
+
+        recommendations = recommend_mf(user, catalog, model, neighbor_num=10, rec_num=5)
+        assert [r['movieId'] for r in recommendations] == model.movie_ids[expected].tolist()
+        assert [r['recommendedScore'] for r in recommendations] == \
+               [round(min(max(float(scores[m]), 0.5), 5.0), 3) for m in expected]
+
+    assert recommend_mf(-1, catalog, model, neighbor_num=10, rec_num=3) == []
+    with pytest.raises(ValueError):
+        preprocessor.add_factors(model, random_ratings_df[random_ratings_df['userId'] != 1])
+
+
+def test_recommend_mf_rating_range(random_ratings_df, catalog):
+    """Test that the predicted ratings stay within the rating range, and the rarely rated movies keep no factors."""
+    preprocessor = PreProcessor(neighbor_engine='sparse', factors=8, als_regularization=0.001, als_min_item_ratings=12)
+    model = preprocessor.add_factors(ModelArrays.from_dicts(*preprocessor.preprocess(random_ratings_df)),
+                                     random_ratings_df)
+    assert model.rating_range.tolist() == [0.5, 5.0]
+
+    counts = random_ratings_df.groupby('movieId').size().to_numpy()
+    assert 0 < np.sum(counts < 12) < len(counts)
+    assert not model.item_factors[counts < 12].any() and model.item_factors[counts >= 12].any()
+
+    predictions = model.user_factors @ model.item_factors.T + model.item_biases
+    assert predictions.max() > 5.0 or predictions.min() < 0.5  # the weak regularization overshoots
+    for user in model.user_ids.tolist():
+        scores = [r['recommendedScore'] for r in recommend_mf(user, catalog, model, neighbor_num=10, rec_num=100)]
+        assert scores and all(0.5 <= score <= 5.0 for score in scores)
+        assert scores == sorted(scores, reverse=True)
+
+
+@pytest.mark.parametrize("rec_num", [3, 1000])
+def test_recommend_ub_batch(random_ratings_df, catalog, rec_num):
+    """Test that the batched recommendations match the ones of each user."""
+    model = ModelArrays.from_dicts(*PreProcessor(neighbor_engine='sparse').preprocess(random_ratings_df))
+    users = [3, -1, 1, 20, 39, 7]
+
+    results = list(recommend_ub_batch(users, catalog, model, neighbor_num=5, rec_num=rec_num, batch_size=4))
+
+    assert [user for user, _ in results] == users
+    for user, recommendations in results:
+        expected = recommend_ub_arrays(user, catalog, model, neighbor_num=5, rec_num=rec_num)
+        assert [r['recommendedScore'] for r in recommendations] == [r['recommendedScore'] for r in expected]
+        assert [r['movieId'] for r in recommendations] == [r['movieId'] for r in expected]
+
+
+@pytest.mark.parametrize("rec_num", [0, -1])
+def test_non_positive_rec_num(random_ratings_df, catalog, rec_num):
+    """Test that all the recommenders recommend no movie when asked for none."""
+    model = ModelArrays.from_dicts(*PreProcessor(neighbor_engine='sparse').preprocess(random_ratings_df))
+    model = PreProcessor(item_neighbors=10, factors=4, als_iterations=2).add_item_neighbors(model)
+    model = PreProcessor(factors=4, als_iterations=2).add_factors(model, random_ratings_df)
+
+    assert recommend_ub(1, catalog, model.neighbors_u, model.user_ratings, 5, rec_num) == []
+    for recommend in (recommend_ub_arrays, recommend_ib, recommend_mf):
+        assert recommend(1, catalog, model, 5, rec_num) == []
+    assert list(recommend_ub_batch([1, 7], catalog, model, 5, rec_num)) == [(1, []), (7, [])]
+
+
+def test_negative_neighbor_num(random_ratings_df, catalog):
+    """Test that a negative number of neighbors recommends no movie instead of failing."""
+    model = ModelArrays.from_dicts(*PreProcessor(neighbor_engine='sparse').preprocess(random_ratings_df))
+    model = PreProcessor(item_neighbors=10).add_item_neighbors(model)
+
+    assert recommend_ub_arrays(1, catalog, model, -1, 5) == []
+    assert recommend_ib(1, catalog, model, -1, 5) == []
+    assert list(recommend_ub_batch([1, 7], catalog, model, -1, 5)) == [(1, []), (7, [])]
+
+
+def test_movie_catalog():
+    """Test the array-backed movie lookups."""
+    movies_df = pd.DataFrame({'movieId': [104, 101, 103],
+                              'title': ['Movie D', 'Movie A', 'Movie C'],
+                              'genres': ['Action', 'Action', 'Drama']}).set_index('movieId')
+    catalog = MovieCatalog.from_frame(movies_df)
+
+    assert catalog.movie(103) == ('Movie C', 'Drama')
+    assert catalog.titles[catalog.index(np.array([104, 101]))].tolist() == ['Movie D', 'Movie A']
+    with pytest.raises(KeyError):
+        catalog.movie(102)
+    with pytest.raises(KeyError):
+        catalog.index(np.array([101, 1000]))
+
+
+def test_movie_catalog_of_frame(monkeypatch):
+    """Test that the catalog of a movies DataFrame is built once for all the calls given the same frame."""
+    from recommender.core import engine
+
+    movies_df = pd.DataFrame({'movieId': [101, 102], 'title': ['Movie A', 'Movie B'], 'genres': 'Drama'}
+                             ).set_index('movieId')
+    builds = []
+    from_frame = MovieCatalog.from_frame
+    monkeypatch.setattr(MovieCatalog, 'from_frame', lambda frame: builds.append(frame) or from_frame(frame))
+
+    neighbors_u, user_ratings = {1: [(2, 1.0)]}, {1: {101: 'P'}, 2: {101: 'P', 102: 'P'}}
+    for _ in range(3):
+        assert [r['movieId'] for r in recommend_ub(1, movies_df, neighbors_u, user_ratings, 1, 5)] == [102]
+    assert len(builds) == 1
+
+    # the catalog is dropped with its frame
+    key = id(movies_df)
+    del movies_df, builds[:]
+    assert key not in engine._frame_catalogs
+
+
 # You can also include tests for edge cases such as:
 # - No similar neighbors found
 # - User has rated all movies
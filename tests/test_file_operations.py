@@ -0,0 +1,311 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from recommender.core import ModelArrays, MovieCatalog, PreProcessor, recommend_precomputed, recommend_ub_batch
+from recommender.file_operations import (
+    DataHandler,
+    ModelStore,
+    build_model_arrays,
+    load_model,
+    load_model_arrays,
+    load_model_metadata,
+    load_movie_catalog,
+    load_precomputed_recommendations,
+    precompute_recommendations,
+    save_model_arrays
+)
+from recommender.file_operations import store as store_module
+
+
+@pytest.fixture
+def ratings_df():
+    """Fixture to create a small ratings DataFrame."""
+    return pd.DataFrame({
+        'userId': [1, 1, 2, 2, 3, 3],
+        'movieId': [101, 102, 101, 103, 102, 104],
+        'rating': [4.5, 2.0, 4.0, 5.0, 2.0, 1.5]
+    })
+
+
+@pytest.fixture
+def data_folder(ratings_df, tmp_path):
+    """Fixture to write the ratings, with an unused timestamp, and the movies in `.csv` files."""
+    ratings_df.assign(timestamp=964982703).to_csv(tmp_path / 'ratings.csv', index=False)
+    pd.DataFrame({'movieId': [101, 102, 103, 104], 'title': ['A', 'B', 'C', 'D'], 'genres': ['X'] * 4}
+                 ).to_csv(tmp_path / 'movies.csv', index=False)
+    return tmp_path
+
+
+@pytest.fixture
+def model(ratings_df):
+    """Fixture to create a small array-backed model."""
+    return ModelArrays.from_dicts(*PreProcessor(min_rating_num=1).preprocess(ratings_df))
+
+
+def test_save_and_load_model_arrays(model, tmp_path):
+    """Test that the saved arrays are loaded memory-mapped and unchanged."""
+    save_model_arrays(model, tmp_path / 'model')
+    loaded = load_model_arrays(tmp_path / 'model')
+
+    for name in ModelArrays.array_names():
+        assert isinstance(getattr(loaded, name), np.memmap)
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(model, name))
+    assert dict(loaded.user_ratings) == dict(model.user_ratings)
+    assert not (tmp_path / 'model.tmp').exists()
+
+    # models saved without polarity weights score with the default ones
+    (tmp_path / 'model' / 'polarity_weights.npy').unlink()
+    np.testing.assert_array_equal(load_model_arrays(tmp_path / 'model').polarity_weights, [-2.0, -1.0, 2.0])
+
+
+def test_save_and_load_item_neighbors(model, tmp_path):
+    """Test that the item neighbors are saved with the model, and are optional when loading it."""
+    model = PreProcessor(item_neighbors=2, item_min_overlap=1).add_item_neighbors(model)
+    assert model.has_item_neighbors
+    save_model_arrays(model, tmp_path / 'model')
+    loaded = load_model_arrays(tmp_path / 'model')
+    assert loaded.has_item_neighbors
+    for name in ('item_neighbors_indptr', 'item_neighbors_items', 'item_neighbors_sims'):
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(model, name))
+
+        (tmp_path / 'model' / f'{name}.npy').unlink()
+    assert not load_model_arrays(tmp_path / 'model').has_item_neighbors
+
+
+def test_save_and_load_factors(ratings_df, model, tmp_path):
+    """Test that the embeddings are saved with the model as float32 arrays, memory-mapped when loaded."""
+    model = PreProcessor(min_rating_num=1, factors=2, als_iterations=2).add_factors(model, ratings_df)
+    save_model_arrays(model, tmp_path / 'model')
+    loaded = load_model_arrays(tmp_path / 'model')
+
+    assert loaded.has_factors
+    for name in ('user_factors', 'item_factors', 'item_biases', 'rating_range'):
+        assert isinstance(getattr(loaded, name), np.memmap)
+        assert getattr(loaded, name).dtype == np.float32
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(model, name))
+
+
+def test_load_model_replaced_while_loading(ratings_df, model, tmp_path, monkeypatch):
+    """Test that a model replaced while it is loaded is loaded again, and that replacing it leaves no other folder."""
+    from recommender.file_operations import readers
+
+    save_model_arrays(model, tmp_path / 'model')
+    replacement = ModelArrays.from_dicts(*PreProcessor(min_rating_num=1).preprocess(ratings_df.iloc[:4]))
+    np_load = np.load
+    loads = []
+
+    def replacing_load(*args, **kwargs):
+        if not loads:
+            save_model_arrays(replacement, tmp_path / 'model')
+        loads.append(args[0])
+        return np_load(*args, **kwargs)
+
+    monkeypatch.setattr(readers.np, 'load', replacing_load)
+    loaded, metadata = load_model(tmp_path / 'model')
+    np.testing.assert_array_equal(loaded.user_ids, replacement.user_ids)
+    assert metadata == load_model_metadata(tmp_path / 'model')
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['model']
+
+
+def test_load_missing_model_arrays(tmp_path):
+    """Test that a missing model raises a FileNotFoundError."""
+    with pytest.raises(FileNotFoundError):
+        load_model_arrays(tmp_path / 'missing')
+
+
+@pytest.mark.parametrize("csv_engine", [None, 'pyarrow'])
+def test_data_handler(ratings_df, data_folder, csv_engine):
+    """Test that only the used columns are read, with compact dtypes, in full or in chunks."""
+    data_handler = DataHandler(data_folder, csv_engine=csv_engine)
+
+    assert data_handler.ratings_df.dtypes.to_dict() == {'userId': np.int32, 'movieId': np.int32, 'rating': np.float32}
+    assert data_handler.movies_df.index.dtype == np.int32
+    assert list(data_handler.movies_df.columns) == ['title', 'genres']
+    chunks = list(data_handler.iter_ratings(chunk_size=4))
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), data_handler.ratings_df)
+
+    preprocessor = PreProcessor(min_rating_num=1)
+    assert preprocessor._load_user_ratings(iter(chunks)) == preprocessor._load_user_ratings(ratings_df)
+
+    data_handler.release_frames()
+    assert 'ratings_df' not in vars(data_handler) and 'movies_df' not in vars(data_handler)
+
+
+def test_build_model_arrays(model, data_folder):
+    """Test that the model built from the `.csv` files matches the one built in memory."""
+    tmp_path = data_folder
+    counts = build_model_arrays(tmp_path, tmp_path / 'model', min_rating_num=1)
+    loaded = load_model_arrays(tmp_path / 'model')
+
+    assert counts == {"users": len(model.user_ids), "users_with_neighbors": len(model.neighbors_u)}
+    for name in ModelArrays.array_names():
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(model, name))
+
+    # the movies are saved with the model, memory-mapped when loaded
+    catalog = load_movie_catalog(tmp_path / 'model')
+    assert isinstance(catalog.titles, np.memmap) and isinstance(catalog.rows, np.memmap)
+    assert [catalog.movie(movie) for movie in [101, 104]] == [('A', 'X'), ('D', 'X')]
+    assert isinstance(catalog.titles[catalog.index(np.array([103]))].tolist()[0], str)
+    with pytest.raises(FileNotFoundError):
+        load_movie_catalog(tmp_path)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_precompute_recommendations(model, tmp_path, n_jobs):
+    """Test that the precomputed recommendations match the ones calculated on demand."""
+    save_model_arrays(model, tmp_path / 'model')
+    catalog = MovieCatalog.from_frame(pd.DataFrame({'movieId': model.movie_ids,
+                                                    'title': [f'Movie {i}' for i in model.movie_ids],
+                                                    'genres': 'Drama'}).set_index('movieId'))
+
+    rows = precompute_recommendations(tmp_path / 'model', tmp_path / 'recs.parquet', users=[3, 1, 99],
+                                      neighbor_num=2, rec_num=3, n_jobs=n_jobs, chunk_size=1)
+    table = load_precomputed_recommendations(tmp_path / 'recs.parquet')
+
+    assert rows == len(table.movie_ids)
+    assert table.model_id == load_model_metadata(tmp_path / 'model')['model_id']
+    assert (table.neighbor_num, table.rec_num) == (2, 3)
+    for user, expected in recommend_ub_batch([3, 1], catalog, model, neighbor_num=2, rec_num=2):
+        assert recommend_precomputed(user, catalog, table, rec_num=2) == expected
+    assert recommend_precomputed(99, catalog, table, rec_num=2) is None
+    assert recommend_precomputed(1, catalog, table, rec_num=0) == []
+    assert recommend_precomputed(1, catalog, table, rec_num=4) is None
+
+
+def test_precompute_window(model, monkeypatch):
+    """Test that the chunks are yielded in order, with a bounded number of them submitted ahead."""
+    from recommender.file_operations import builders
+
+    submitted = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            submitted.append(args[0])
+            return super().submit(fn, *args, **kwargs)
+
+    chunks = [np.array([user]) for user in model.user_ids.tolist()] * 3
+    with RecordingExecutor(max_workers=2) as executor:
+        results = builders._ordered_results(executor, chunks, 2, 2, 3, model)
+        for yielded, columns in enumerate(results, start=1):
+            assert len(submitted) <= min(yielded + 1, len(chunks))
+            assert set(columns['userId'].tolist()) <= {chunks[yielded - 1][0]}
+    assert len(submitted) == len(chunks)
+
+
+def test_precompute_model_replaced(ratings_df, model, tmp_path, monkeypatch):
+    """Test that the precomputed recommendations are stamped with the model they were calculated from."""
+    from recommender.file_operations import builders
+
+    save_model_arrays(model, tmp_path / 'model')
+    model_id = load_model_metadata(tmp_path / 'model')['model_id']
+    replacement = ModelArrays.from_dicts(*PreProcessor(min_rating_num=1).preprocess(ratings_df.iloc[:4]))
+    builders_load_model = builders.load_model
+
+    def load_and_replace(*args, **kwargs):
+        loaded = builders_load_model(*args, **kwargs)
+        save_model_arrays(replacement, tmp_path / 'model')
+        return loaded
+
+    monkeypatch.setattr(builders, 'load_model', load_and_replace)
+    precompute_recommendations(tmp_path / 'model', tmp_path / 'recs.parquet', users=[3, 1], neighbor_num=2, rec_num=3)
+    table = load_precomputed_recommendations(tmp_path / 'recs.parquet')
+    assert table.model_id == model_id != load_model_metadata(tmp_path / 'model')['model_id']
+    assert table.lookup(3) is not None
+
+    # the worker processes load the replacement, which does not match the model of the table
+    with pytest.raises(RuntimeError):
+        precompute_recommendations(tmp_path / 'model', tmp_path / 'recs.parquet', users=[3, 1], neighbor_num=2,
+                                   rec_num=3, n_jobs=2, chunk_size=1)
+
+
+def test_load_missing_precomputed_recommendations(tmp_path):
+    """Test that missing precomputed recommendations raise a FileNotFoundError."""
+    with pytest.raises(FileNotFoundError):
+        load_precomputed_recommendations(tmp_path / 'missing.parquet')
+
+
+def test_data_handler_cache(data_folder):
+    """Test that the `.csv` files are read from their cache until they change."""
+    ratings_df = DataHandler(data_folder).ratings_df
+    data_handler = DataHandler(data_folder)
+    read_options = data_handler._read_options(data_handler.ratings_dtypes, data_handler.ratings_index_col)
+    assert data_handler._valid_cache(data_handler.ratings_file_path, read_options) is not None
+    pd.testing.assert_frame_equal(data_handler.ratings_df, ratings_df)
+    pd.testing.assert_frame_equal(DataHandler(data_folder).movies_df, DataHandler(data_folder).movies_df)
+
+    # a touched file keeps its cache, a changed one does not
+    os.utime(data_handler.ratings_file_path, ns=(0, 0))
+    assert data_handler._valid_cache(data_handler.ratings_file_path, read_options) is not None
+    with open(data_handler.ratings_file_path, 'a') as f:
+        f.write('4,101,3.0,964982703\n')
+    assert data_handler._valid_cache(data_handler.ratings_file_path, read_options) is None
+    assert len(DataHandler(data_folder).ratings_df) == len(ratings_df) + 1
+    assert len(pd.concat(DataHandler(data_folder).iter_ratings(chunk_size=2))) == len(ratings_df) + 1
+    assert not DataHandler(data_folder, use_cache=False)._valid_cache(data_handler.ratings_file_path, read_options)
+
+
+def test_model_store(data_folder, tmp_path):
+    """Test that the stored models are reused for the same data and options and evicted when unused."""
+    store = ModelStore(root=tmp_path / 'store', max_models=2)
+
+    folder = store.get_or_build(data_folder, min_rating_num=1)
+    model_id = load_model_metadata(folder)['model_id']
+    assert store.get_or_build(data_folder, min_rating_num=1, n_jobs=2) == folder
+    assert load_model_metadata(folder)['model_id'] == model_id
+    assert store.get_or_build(data_folder, force=True, min_rating_num=1) == folder
+    assert load_model_metadata(folder)['model_id'] != model_id
+
+    # other options or ratings are other models, and the least recently used one is evicted
+    other = store.get_or_build(data_folder, min_rating_num=2)
+    assert other != folder
+    store.lookup(folder.name)
+    with open(data_folder / 'ratings.csv', 'a') as f:
+        f.write('4,101,3.0,964982703\n')
+    changed = store.get_or_build(data_folder, min_rating_num=1)
+    assert changed not in (folder, other)
+    assert sorted(path.name for path in store.root.iterdir()) == sorted([folder.name, changed.name])
+
+    # a model being saved is not evicted
+    save_model_arrays(load_model_arrays(changed), store.root / 'saving.tmp')
+    assert store.evict() == []
+
+
+def test_model_store_pointers(data_folder, tmp_path):
+    """Test that a named pointer points to a model of the store, which is never evicted."""
+    store = ModelStore(root=tmp_path / 'store', max_models=1)
+    assert store.current('latest') is None
+
+    folder = store.get_or_build(data_folder, min_rating_num=1)
+    store.set_current('latest', folder)
+    assert store.current('latest') == folder
+    other = store.get_or_build(data_folder, min_rating_num=2)
+    assert folder.is_dir() and other.is_dir()
+
+    store.set_current('latest', other)
+    assert store.current('latest') == other
+    assert store.evict(keep=[other]) == [folder]
+    store.set_current('latest', folder)
+    assert store.current('latest') is None
+
+
+def test_model_store_concurrent_builds(data_folder, tmp_path, monkeypatch):
+    """Test that the processes missing the same model wait for a single build of it."""
+    builds = []
+
+    def build(*args, **kwargs):
+        builds.append(args)
+        time.sleep(0.2)
+        return build_model_arrays(*args, **kwargs)
+
+    monkeypatch.setattr(store_module, 'build_model_arrays', build)
+    stores = [ModelStore(root=tmp_path / 'store') for _ in range(3)]
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        folders = list(executor.map(lambda store: store.get_or_build(data_folder, min_rating_num=1), stores))
+
+    assert len(builds) == 1
+    assert len(set(folders)) == 1
@@ -0,0 +1,110 @@
+import pandas as pd
+import pytest
+
+from recommender.utils import LRUCache, MetricsRegistry, generate_ratings
+
+
+class FakeClock:
+    """A clock moved forward manually."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """Test that the least recently used entry is evicted once the cache is full."""
+    cache = LRUCache(max_size=2, ttl=None)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # 'b' becomes the least recently used
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['size'] == 2
+
+
+def test_lru_cache_expires_entries():
+    """Test that the entries expire after their time to live."""
+    clock = FakeClock()
+    cache = LRUCache(max_size=10, ttl=5, clock=clock)
+    cache.put('a', 1)
+
+    clock.now = 5
+    assert cache.get('a') == 1
+    clock.now = 5.1
+    assert cache.get('a') is None
+
+
+def test_lru_cache_stats_and_clear():
+    """Test the hit/miss counters and the invalidation of all the entries."""
+    cache = LRUCache(max_size=10)
+    cache.put('a', 1)
+    cache.get('a')
+    cache.get('b')
+    cache.clear()
+
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (1, 2, 0)
+
+
+def test_lru_cache_invalid_size():
+    """Test that the cache needs room for at least one entry."""
+    with pytest.raises(ValueError):
+        LRUCache(max_size=0)
+
+
+def test_generate_ratings():
+    """Test the shape of the synthetic ratings."""
+    ratings_df, movies_df = generate_ratings(num_users=200, num_movies=500, ratings_per_user=20, seed=1)
+
+    assert list(ratings_df.columns) == ['userId', 'movieId', 'rating', 'timestamp']
+    assert not ratings_df.duplicated(['userId', 'movieId']).any()
+    assert ratings_df['userId'].nunique() == 200
+    assert ratings_df.groupby('userId').size().min() >= 5
+    assert abs(len(ratings_df) / 200 - 20) < 5
+    assert ratings_df['movieId'].isin(movies_df.index).all()
+    assert set(ratings_df['rating'].unique()) <= {r / 2 for r in range(1, 11)}
+
+    # popular movies get most of the ratings
+    counts = ratings_df['movieId'].value_counts()
+    assert counts.iloc[:50].sum() > counts.iloc[50:].sum()
+    pd.testing.assert_frame_equal(ratings_df, generate_ratings(200, 500, 20, seed=1)[0])
+
+
+def test_metrics_registry_renders_prometheus_text():
+    """Test that the stage durations, counters and gauges are rendered in the Prometheus text format."""
+    registry = MetricsRegistry(enabled=True, buckets=(0.1, 1.0))
+    registry.observe('scoring', 0.05)
+    registry.observe('scoring', 0.5)
+    with registry.timer('ranking'):
+        pass
+    registry.increment('requests_total', endpoint='recommendations')
+    registry.increment('requests_total', endpoint='recommendations')
+    registry.set_gauge('model_users', 610, 'Number of users.')
+
+    text = registry.render()
+    assert 'recsys_stage_duration_seconds_bucket{stage="scoring",le="0.1"} 1' in text
+    assert 'recsys_stage_duration_seconds_bucket{stage="scoring",le="1"} 2' in text
+    assert 'recsys_stage_duration_seconds_bucket{stage="scoring",le="+Inf"} 2' in text
+    assert 'recsys_stage_duration_seconds_count{stage="ranking"} 1' in text
+    assert 'recsys_requests_total{endpoint="recommendations"} 2' in text
+    assert '# TYPE recsys_model_users gauge\nrecsys_model_users 610' in text
+    assert registry.stage_summary()['scoring'] == {"count": 2, "seconds": pytest.approx(0.55)}
+
+
+def test_metrics_registry_disabled():
+    """Test that a disabled registry records nothing and hands out a shared no-op timer."""
+    registry = MetricsRegistry(enabled=False)
+    assert registry.timer('scoring') is registry.timer('ranking')
+    with registry.timer('scoring'):
+        pass
+    registry.observe('scoring', 1.0)
+    registry.increment('requests_total')
+    assert registry.stage_summary() == {}
+    assert 'recsys_stage_duration_seconds' not in registry.render()